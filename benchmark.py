@@ -0,0 +1,234 @@
+import argparse
+import itertools
+import json
+import sys
+import numpy as np
+from colorama import Fore, Style
+
+from simulation_core import SimulationCore, COLOR_PROFILES, PARTICLE_MODES, NBODY_MODE, DEFAULT_N_BODIES
+from emitters import N_EMITTER_MODES
+from exceptions import ParticleSystemException
+
+DEFAULT_N_PARTICLES = ( 10000, 100000, 1000000 )
+DEFAULT_THRESHOLD = 0.10
+DEFAULT_NBODY_N_PARTICLES = ( 16384, 65536 )
+DEFAULT_WORK_GROUP_SIZES = ( 16, 32, 64, 128, 256, 512 )
+EMITTER_RING_RADIUS = 2.0
+
+
+def event_duration_ns(event):
+	return event.profile.end - event.profile.start
+
+def summarize(kernel, n_particles, durations_ns):
+	durations_ns = np.array(durations_ns, dtype=np.float64)
+	median_ns = float(np.median(durations_ns))
+	p99_ns = float(np.percentile(durations_ns, 99))
+	return {
+		'kernel': kernel,
+		'samples': len(durations_ns),
+		'median_ns': median_ns,
+		'p99_ns': p99_ns,
+		'median_particles_per_sec': n_particles / median_ns * 1e9,
+		'p99_particles_per_sec': n_particles / p99_ns * 1e9,
+		}
+
+def config_key(result):
+	return (result['n_particles'], result['particle_mode'], result['color_profile'],
+		result['is_gravity_on'], result['is_decaying'], result['kernel'],
+		result.get('n_bodies'), result.get('work_group_size'), result.get('n_emitters', 1))
+
+# Emitters besides the generator, on a ring around it, cycling through the modes emitters can run
+def add_emitters(core, n_emitters):
+	for i in range(1, n_emitters):
+		angle = 2.0 * np.pi * i / (n_emitters - 1)
+		position = ( EMITTER_RING_RADIUS * np.cos(angle), EMITTER_RING_RADIUS * np.sin(angle), 0.0 )
+		core.emitters.add(position, i % N_EMITTER_MODES, i % len(COLOR_PROFILES), bool(i % 2))
+
+# Time init, update and change_color from device-side profiling events, for one configuration
+def benchmark_config(core, n_warmup, n_repeats):
+	init_events = []
+	update_events = []
+	change_color_events = []
+
+	for _ in range(n_repeats):
+		init_events.append(core.init())
+	for _ in range(n_warmup):
+		core.update()
+	for _ in range(n_repeats):
+		update_events.append(core.update())
+	for _ in range(n_repeats):
+		change_color_events.append(core.change_color())
+	core.finish()
+	core.pop_events()			# already kept above
+
+	return [summarize(kernel, core.n_particles, [event_duration_ns(event) for event in events])
+		for kernel, events in (('init', init_events), ('update', update_events), ('change_color', change_color_events))]
+
+def run_sweep(args):
+	results = []
+	device = None
+
+	for n_particles in args.n_particles or DEFAULT_N_PARTICLES:
+		core = SimulationCore(n_particles, profiling=True, specialize=not args.generic, compact=args.compact)
+		device = core.context.devices[0]
+		add_emitters(core, args.emitters)
+
+		for particle_mode_id, color_profile_id, is_gravity_on, is_decaying in itertools.product(
+				args.modes, args.colors, (False, True), (False, True)):
+			core.particle_mode_id = particle_mode_id
+			core.color_profile_id = color_profile_id
+			core.is_gravity_on = is_gravity_on
+			core.is_decaying = is_decaying
+
+			for summary in benchmark_config(core, args.warmup, args.repeats):
+				summary.update({
+					'n_particles': n_particles,
+					'particle_mode': PARTICLE_MODES[particle_mode_id],
+					'color_profile': COLOR_PROFILES[color_profile_id],
+					'is_gravity_on': is_gravity_on,
+					'is_decaying': is_decaying,
+					'n_emitters': args.emitters,
+					})
+				results.append(summary)
+				if summary['kernel'] == 'update':
+					print('%9d  %-18s %-20s gravity=%-5s decay=%-5s  %.3e particles/s (p99 %.3e)' % (
+						n_particles, summary['particle_mode'], summary['color_profile'],
+						is_gravity_on, is_decaying,
+						summary['median_particles_per_sec'], summary['p99_particles_per_sec']))
+
+	return {
+		'specialized': not args.generic,
+		'compact': args.compact,
+		'device': device.name if device is not None else None,
+		'driver_version': device.driver_version if device is not None else None,
+		'results': results,
+		}
+
+# Time the N-body force kernel alone, once per work-group size (tile size) of the direct sum.
+# Interactions are particles times bodies, so Barnes-Hut reports the direct-sum equivalent.
+def run_nbody_sweep(args):
+	results = []
+	device = None
+	kernel = 'nbody_barnes_hut' if args.barnes_hut else 'nbody_tiled'
+	work_group_sizes = ( None, ) if args.barnes_hut else args.work_group_sizes
+
+	for n_particles in args.n_particles or DEFAULT_NBODY_N_PARTICLES:
+		core = SimulationCore(n_particles, profiling=True, specialize=not args.generic, compact=args.compact)
+		device = core.context.devices[0]
+		core.particle_mode_id = NBODY_MODE
+		core.n_bodies = args.bodies
+		core.barnes_hut = args.barnes_hut
+		core.init()
+
+		for work_group_size in work_group_sizes:
+			core.nbody_work_group_size = work_group_size
+			try:
+				for _ in range(args.warmup):
+					core.compute_nbody_forces()
+			except ParticleSystemException as e:
+				print(Style.BRIGHT + Fore.YELLOW + 'SKIPPED: ' + Style.RESET_ALL + Fore.RESET + str(e))
+				continue
+			events = [ core.compute_nbody_forces() for _ in range(args.repeats) ]
+			core.finish()
+			core.pop_events()			# already kept above
+
+			summary = summarize(kernel, n_particles, [ event_duration_ns(event) for event in events ])
+			n_interactions = n_particles * core.get_n_bodies()
+			summary.update({
+				'n_particles': n_particles,
+				'n_bodies': core.get_n_bodies(),
+				'work_group_size': work_group_size,
+				'particle_mode': PARTICLE_MODES[NBODY_MODE],
+				'color_profile': COLOR_PROFILES[core.color_profile_id],
+				'is_gravity_on': core.is_gravity_on,
+				'is_decaying': core.is_decaying,
+				'median_interactions_per_sec': n_interactions / summary['median_ns'] * 1e9,
+				'p99_interactions_per_sec': n_interactions / summary['p99_ns'] * 1e9,
+				})
+			results.append(summary)
+			print('%9d particles %9d bodies  work-group %-5s %.3e interactions/s (p99 %.3e)' % (
+				n_particles, summary['n_bodies'], work_group_size or '-',
+				summary['median_interactions_per_sec'], summary['p99_interactions_per_sec']))
+
+	return {
+		'specialized': not args.generic,
+		'compact': args.compact,
+		'barnes_hut': args.barnes_hut,
+		'device': device.name if device is not None else None,
+		'driver_version': device.driver_version if device is not None else None,
+		'results': results,
+		}
+
+# Flag every configuration whose median throughput dropped by more than threshold against the baseline
+def compare(report, baseline, threshold):
+	baseline_results = { config_key(result): result for result in baseline['results'] }
+	regressions = []
+
+	for result in report['results']:
+		reference = baseline_results.get(config_key(result))
+		if reference is None:
+			continue
+		ratio = result['median_particles_per_sec'] / reference['median_particles_per_sec']
+		if ratio < 1.0 - threshold:
+			regressions.append((result, ratio))
+			print(Style.BRIGHT + Fore.RED + 'REGRESSION: ' + Style.RESET_ALL + Fore.RESET +
+				'%s %d %s %s gravity=%s decay=%s: %.1f%% of baseline' % (
+				result['kernel'], result['n_particles'], result['particle_mode'], result['color_profile'],
+				result['is_gravity_on'], result['is_decaying'], ratio * 100))
+
+	if baseline.get('device') != report.get('device'):
+		print(Style.BRIGHT + Fore.YELLOW + 'WARNING: ' + Style.RESET_ALL + Fore.RESET +
+			'baseline was recorded on ' + str(baseline.get('device')))
+	return regressions
+
+def parse_args():
+	parser = argparse.ArgumentParser(description='Benchmark the particle system kernels headlessly.')
+	parser.add_argument('--n-particles', type=int, nargs='+',
+		help='particle counts (default %s, or %s with --nbody)' % (DEFAULT_N_PARTICLES, DEFAULT_NBODY_N_PARTICLES))
+	parser.add_argument('--modes', type=int, nargs='+', default=range(len(PARTICLE_MODES)),
+		help='particle mode ids (0-%d)' % (len(PARTICLE_MODES) - 1))
+	parser.add_argument('--colors', type=int, nargs='+', default=range(len(COLOR_PROFILES)),
+		help='color profile ids (0-%d)' % (len(COLOR_PROFILES) - 1))
+	parser.add_argument('--warmup', type=int, default=10)
+	parser.add_argument('--repeats', type=int, default=50)
+	parser.add_argument('--generic', action='store_true',
+		help='use the generic kernels instead of mode-specialized variants')
+	parser.add_argument('--compact', action='store_true',
+		help='use the compact particle layout')
+	parser.add_argument('--emitters', type=int, default=1,
+		help='emitters stepped by every dispatch, the generator included (default 1)')
+	parser.add_argument('--nbody', action='store_true',
+		help='benchmark the N-body force kernel over work-group sizes instead')
+	parser.add_argument('--work-group-sizes', type=int, nargs='+', default=DEFAULT_WORK_GROUP_SIZES,
+		help='tile sizes of the N-body direct sum')
+	parser.add_argument('--bodies', type=int, default=DEFAULT_N_BODIES,
+		help='attracting bodies, 0 for every particle (default %d)' % DEFAULT_N_BODIES)
+	parser.add_argument('--barnes-hut', action='store_true',
+		help='benchmark the Barnes-Hut octree instead of the direct sum')
+	parser.add_argument('--output', help='write results to this JSON file')
+	parser.add_argument('--compare', metavar='BASELINE', help='flag regressions against this JSON file')
+	parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+		help='allowed fractional drop in median throughput (default %.2f)' % DEFAULT_THRESHOLD)
+	return parser.parse_args()
+
+def main():
+	args = parse_args()
+
+	try:
+		report = run_nbody_sweep(args) if args.nbody else run_sweep(args)
+	except ParticleSystemException as e:
+		print(Style.BRIGHT + Fore.RED + 'ParticleSystemException: ' + Style.RESET_ALL + Fore.RESET + str(e))
+		sys.exit(2)
+
+	if args.output:
+		with open(args.output, 'w') as file:
+			json.dump(report, file, indent='\t')
+
+	if args.compare:
+		with open(args.compare, 'r') as file:
+			baseline = json.load(file)
+		if compare(report, baseline, args.threshold):
+			sys.exit(1)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,206 @@
+from OpenGL.GL import *
+import collections
+import ctypes
+import multiprocessing
+import os
+import numpy as np
+from multiprocessing import shared_memory
+from colorama import Style
+
+from exceptions import ParticleSystemException
+from frame_encoder import encode_frame, assemble_gif
+
+CAPTURE_FORMATS = ( 'png', 'gif' )
+
+DEFAULT_N_PBOS = 3				# glReadPixels into one while older ones finish, never waiting on the current frame
+NOMINAL_FRAME_RATE = 60			# GIF timing, one captured frame every k of these
+FRAME_FILENAME = 'frame_%06d.'
+
+
+# Reads the framebuffer every k-th frame through a round-robin of pixel buffer objects.
+# A PBO is mapped only once it is DEFAULT_N_PBOS - 1 captures old, its pixels go through shared memory
+# to a pool of worker processes that encode PNG frames, or GIF frames assembled into one GIF at close().
+class FrameCapture:
+
+	def __init__(self, directory, width, height, every=1, image_format='png', n_pbos=DEFAULT_N_PBOS, n_workers=None):
+		if image_format not in CAPTURE_FORMATS:
+			raise ParticleSystemException('Capture format must be one of ' + ', '.join(CAPTURE_FORMATS))
+		try:
+			os.makedirs(directory, exist_ok=True)
+		except OSError as e:
+			raise ParticleSystemException('Cannot create capture directory ' + directory + '\n' + str(e))
+
+		self.directory = directory
+		self.width = width
+		self.height = height
+		self.every = every
+		self.image_format = image_format
+		self.frame_bytes = width * height * 4
+		self.filenames = []
+
+		self.pbos = glGenBuffers(n_pbos)
+		for pbo in self.pbos:
+			glBindBuffer(GL_PIXEL_PACK_BUFFER, pbo)
+			glBufferData(GL_PIXEL_PACK_BUFFER, self.frame_bytes, None, GL_STREAM_READ)
+		glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+		self.__in_flight = collections.deque()			# (pbo, capture index), oldest first
+		self.__n_frames = 0
+		self.__n_captures = 0
+
+		# Spawned workers, so they don't inherit the GL and CL state of this process.
+		# Two shared memory slots per worker, a slot is reused once its frame is encoded.
+		self.n_workers = n_workers if n_workers is not None else (os.cpu_count() or 1)
+		self.pool = multiprocessing.get_context('spawn').Pool(processes=self.n_workers)
+		self.n_slots = 2 * self.n_workers
+		self.shm = shared_memory.SharedMemory(create=True, size=self.n_slots * self.frame_bytes)
+		self.__results = [ None ] * self.n_slots
+
+	# After drawing a frame and before swapping, reads the bound read framebuffer
+	def capture(self):
+		frame = self.__n_frames
+		self.__n_frames += 1
+		if frame % self.every:
+			return
+
+		pbo = self.pbos[self.__n_captures % len(self.pbos)]
+		glBindBuffer(GL_PIXEL_PACK_BUFFER, pbo)
+		glReadPixels(0, 0, self.width, self.height, GL_RGBA, GL_UNSIGNED_BYTE, ctypes.c_void_p(0))
+		glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+		self.__in_flight.append((pbo, self.__n_captures))
+		self.__n_captures += 1
+
+		if len(self.__in_flight) == len(self.pbos):
+			self.__drain()
+
+	# Encode what is still in flight, and wait for the workers
+	def close(self):
+		try:
+			while self.__in_flight:
+				self.__drain()
+			for result in self.__results:
+				if result is not None:
+					result.get()
+
+			if self.image_format == 'gif' and self.filenames:
+				output_filename = os.path.join(self.directory, 'capture.gif')
+				self.pool.apply(assemble_gif, (self.filenames, output_filename, self.every * 1000 // NOMINAL_FRAME_RATE))
+				for filename in self.filenames:
+					os.remove(filename)
+		except OSError as e:
+			raise ParticleSystemException('Capture to ' + self.directory + ' failed\n' + str(e))
+		finally:
+			self.pool.close()
+			self.pool.join()
+			self.shm.close()
+			self.shm.unlink()
+			glDeleteBuffers(len(self.pbos), self.pbos)
+
+		print(Style.BRIGHT + 'CAPTURE: \t' + Style.RESET_ALL, '%d frames in %s' % (self.__n_captures, self.directory))
+
+	# Map the oldest PBO, copy it into a free shared memory slot and hand it to a worker
+	def __drain(self):
+		pbo, index = self.__in_flight.popleft()
+		slot = index % self.n_slots
+		if self.__results[slot] is not None:
+			self.__results[slot].get()
+
+		glBindBuffer(GL_PIXEL_PACK_BUFFER, pbo)
+		pixels = glMapBufferRange(GL_PIXEL_PACK_BUFFER, 0, self.frame_bytes, GL_MAP_READ_BIT)
+		destination = np.ndarray(self.frame_bytes, dtype=np.uint8, buffer=self.shm.buf, offset=slot * self.frame_bytes)
+		ctypes.memmove(destination.ctypes.data, pixels, self.frame_bytes)
+		del destination
+		glUnmapBuffer(GL_PIXEL_PACK_BUFFER)
+		glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+
+		filename = os.path.join(self.directory, FRAME_FILENAME % index + self.image_format)
+		self.filenames.append(filename)
+		self.__results[slot] = self.pool.apply_async(encode_frame,
+			(self.shm.name, slot * self.frame_bytes, self.width, self.height, filename, self.image_format))
+
+
+# GL context without a window or display, rendering into a framebuffer object.
+# The platform is PyOpenGL's, PYOPENGL_PLATFORM=egl or osmesa must be set before OpenGL is first imported.
+class OffscreenTarget:
+
+	def __init__(self, width, height):
+		self.width = width
+		self.height = height
+
+		platform = os.environ.get('PYOPENGL_PLATFORM')
+		if platform == 'egl':
+			self.__init_egl()
+		elif platform == 'osmesa':
+			self.__init_osmesa()
+		else:
+			raise ParticleSystemException('Offscreen rendering needs PYOPENGL_PLATFORM=egl or osmesa')
+		self.__init_framebuffer()
+
+	# Default display (NVIDIA without X), else Mesa's surfaceless platform. No surface, the FBO is the target.
+	def __init_egl(self):
+		from OpenGL import EGL
+		EGL_PLATFORM_SURFACELESS_MESA = 0x31DD
+
+		major, minor = EGL.EGLint(), EGL.EGLint()
+		self.display = EGL.eglGetDisplay(EGL.EGL_DEFAULT_DISPLAY)
+		try:
+			EGL.eglInitialize(self.display, ctypes.pointer(major), ctypes.pointer(minor))
+		except EGL.EGLError:
+			self.display = EGL.eglGetPlatformDisplay(EGL_PLATFORM_SURFACELESS_MESA, EGL.EGL_DEFAULT_DISPLAY, None)
+			try:
+				EGL.eglInitialize(self.display, ctypes.pointer(major), ctypes.pointer(minor))
+			except EGL.EGLError as e:
+				raise ParticleSystemException('No EGL display\n' + str(e))
+
+		# Any config will do, or none at all (EGL_KHR_no_config_context)
+		config = EGL.EGLConfig()
+		n_configs = EGL.EGLint()
+		config_attributes = (EGL.EGLint * 3)(EGL.EGL_RENDERABLE_TYPE, EGL.EGL_OPENGL_BIT, EGL.EGL_NONE)
+		EGL.eglChooseConfig(self.display, config_attributes, ctypes.pointer(config), 1, ctypes.pointer(n_configs))
+		if n_configs.value == 0:
+			config = EGL.EGLConfig()
+
+		EGL.eglBindAPI(EGL.EGL_OPENGL_API)
+		context_attributes = (EGL.EGLint * 7)(
+			EGL.EGL_CONTEXT_MAJOR_VERSION, 4,
+			EGL.EGL_CONTEXT_MINOR_VERSION, 0,
+			EGL.EGL_CONTEXT_OPENGL_PROFILE_MASK, EGL.EGL_CONTEXT_OPENGL_CORE_PROFILE_BIT,
+			EGL.EGL_NONE)
+		try:
+			self.context = EGL.eglCreateContext(self.display, config, EGL.EGL_NO_CONTEXT, context_attributes)
+			EGL.eglMakeCurrent(self.display, EGL.EGL_NO_SURFACE, EGL.EGL_NO_SURFACE, self.context)
+		except EGL.EGLError as e:
+			raise ParticleSystemException('Cannot create an OpenGL 4.0 core EGL context\n' + str(e))
+
+	def __init_osmesa(self):
+		from OpenGL import osmesa, arrays
+
+		attributes = [
+			osmesa.OSMESA_FORMAT, osmesa.OSMESA_RGBA,
+			osmesa.OSMESA_DEPTH_BITS, 24,
+			osmesa.OSMESA_PROFILE, osmesa.OSMESA_CORE_PROFILE,
+			osmesa.OSMESA_CONTEXT_MAJOR_VERSION, 4,
+			osmesa.OSMESA_CONTEXT_MINOR_VERSION, 0,
+			0,
+			]
+		self.context = osmesa.OSMesaCreateContextAttribs(attributes, None)
+		if not self.context:
+			raise ParticleSystemException('Cannot create an OpenGL 4.0 core OSMesa context')
+		self.buffer = arrays.GLubyteArray.zeros((self.height, self.width, 4))
+		if not osmesa.OSMesaMakeCurrent(self.context, self.buffer, GL_UNSIGNED_BYTE, self.width, self.height):
+			raise ParticleSystemException('OSMesaMakeCurrent() failed')
+
+	def __init_framebuffer(self):
+		self.framebuffer = glGenFramebuffers(1)
+		glBindFramebuffer(GL_FRAMEBUFFER, self.framebuffer)
+
+		self.color_renderbuffer, self.depth_renderbuffer = glGenRenderbuffers(2)
+		glBindRenderbuffer(GL_RENDERBUFFER, self.color_renderbuffer)
+		glRenderbufferStorage(GL_RENDERBUFFER, GL_RGBA8, self.width, self.height)
+		glFramebufferRenderbuffer(GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT0, GL_RENDERBUFFER, self.color_renderbuffer)
+		glBindRenderbuffer(GL_RENDERBUFFER, self.depth_renderbuffer)
+		glRenderbufferStorage(GL_RENDERBUFFER, GL_DEPTH_COMPONENT24, self.width, self.height)
+		glFramebufferRenderbuffer(GL_FRAMEBUFFER, GL_DEPTH_ATTACHMENT, GL_RENDERBUFFER, self.depth_renderbuffer)
+
+		if glCheckFramebufferStatus(GL_FRAMEBUFFER) != GL_FRAMEBUFFER_COMPLETE:
+			raise ParticleSystemException('Offscreen framebuffer is incomplete')
+		glViewport(0, 0, self.width, self.height)
@@ -0,0 +1,130 @@
+import json
+import re
+
+from exceptions import ParticleSystemException
+
+FIRST_CUSTOM_MODE = 10			# after the built-in modes, like PARTICLE_FIRST_CUSTOM in kernels/kernel.cl
+MAX_CUSTOM_MODES = 64
+
+SPLICE_MARKER = '/* CUSTOM MODES */'	# in kernels/kernel.cl, where the generated source goes
+
+IDENTIFIER = re.compile(r'[A-Za-z_][A-Za-z0-9_]*$')
+
+# Arguments of the generated functions, snippets can't shadow them with parameters
+UPDATE_ARGUMENTS = ( ('float4*', 'position'), ('float4*', 'velocity'), ('rng_t*', 'rng'), ('float4', 'generator_position'),
+	('bool', 'is_gravity_on'), ('float', 'time_scale') )
+INIT_ARGUMENTS = UPDATE_ARGUMENTS[:4]
+
+UPDATE_TEMPLATE = 'custom_update_%d'
+INIT_TEMPLATE = 'custom_init_%d'
+
+
+def get_signature(arguments):
+	return ', '.join(type_name + ' ' + name for type_name, name in arguments)
+
+def get_call(function, arguments):
+	return function + '(' + ', '.join(name for _, name in arguments) + ')'
+
+# Snippets go inside a function body, so they must not close it early
+def check_balanced(name, source):
+	for opening, closing in ( '{}', '()', '[]' ):
+		depth = 0
+		for character in source:
+			depth += (character == opening) - (character == closing)
+			if depth < 0:
+				break
+		if depth != 0:
+			raise ParticleSystemException('Custom mode ' + name + ': unbalanced ' + opening + closing)
+	if '__kernel' in source or SPLICE_MARKER in source:
+		raise ParticleSystemException('Custom mode ' + name + ': snippets are function bodies, not kernels')
+
+
+# A particle mode written in OpenCL C. update runs every substep of a live particle, init when it spawns,
+# after its position and color are set. Both see position, velocity, rng, generator_position,
+# and update also is_gravity_on and time_scale, like update_particle() and init_particle() in kernels/kernel.cl.
+# parameters become float constants of both, changing them builds a new program.
+class CustomMode:
+
+	def __init__(self, name, update, init='', parameters=None):
+		self.name = name
+		self.update = update
+		self.init = init
+		self.parameters = dict(parameters or {})
+
+		check_balanced(name, update)
+		check_balanced(name, init)
+		reserved = { argument for _, argument in UPDATE_ARGUMENTS }
+		for parameter, value in self.parameters.items():
+			if not IDENTIFIER.match(parameter) or parameter in reserved:
+				raise ParticleSystemException('Custom mode ' + name + ': bad parameter name ' + repr(parameter))
+			try:
+				self.parameters[parameter] = float(value)
+			except (TypeError, ValueError):
+				raise ParticleSystemException('Custom mode ' + name + ': parameter ' + parameter + ' must be a number')
+
+	def get_source(self, mode_id):
+		constants = ''.join('\tconst float %s = %.9ef;\n' % item for item in self.parameters.items())
+		return ('// %s\n' % self.name +
+			'static void %s(%s)\n{\n%s%s\n}\n\n' % (UPDATE_TEMPLATE % mode_id, get_signature(UPDATE_ARGUMENTS), constants, self.update) +
+			'static void %s(%s)\n{\n%s%s\n}\n\n' % (INIT_TEMPLATE % mode_id, get_signature(INIT_ARGUMENTS), constants, self.init))
+
+
+# Registered modes get the ids after the built-in ones, in order, and the kernels are rebuilt with them.
+# The program cache keys builds by source hash, so the same snippets never compile twice.
+class CustomModes:
+
+	def __init__(self):
+		self.modes = []
+		self.version = 0			# bumped by every registration, simulations rebuild their kernels when it changes
+
+	def __len__(self):
+		return len(self.modes)
+
+	# Returns the id of the mode, a mode registered again under its name is replaced and keeps its id
+	def register(self, name, update, init='', parameters=None):
+		mode = CustomMode(name, update, init, parameters)
+		names = self.get_names()
+		if name in names:
+			index = names.index(name)
+			self.modes[index] = mode
+		elif len(self.modes) == MAX_CUSTOM_MODES:
+			raise ParticleSystemException('No more than %d custom modes' % MAX_CUSTOM_MODES)
+		else:
+			index = len(self.modes)
+			self.modes.append(mode)
+		self.version += 1
+		return FIRST_CUSTOM_MODE + index
+
+	# A JSON list of { "name", "update", "init", "parameters" }
+	def load(self, filename):
+		try:
+			with open(filename, 'r') as file:
+				modes = json.load(file)
+			return [ self.register(**mode) for mode in modes ]
+		except (OSError, ValueError, TypeError) as e:
+			raise ParticleSystemException('Cannot load custom modes from ' + filename + '\n' + str(e))
+
+	def get_names(self):
+		return tuple(mode.name for mode in self.modes)
+
+	def is_custom(self, mode_id):
+		return FIRST_CUSTOM_MODE <= mode_id < FIRST_CUSTOM_MODE + len(self.modes)
+
+	# The program source with the functions of every mode and their switch cases at SPLICE_MARKER
+	def splice(self, source):
+		if not self.modes:
+			return source
+		if SPLICE_MARKER not in source:
+			raise ParticleSystemException('No ' + SPLICE_MARKER + ' in the kernel source')
+
+		ids = range(FIRST_CUSTOM_MODE, FIRST_CUSTOM_MODE + len(self.modes))
+		generated = ''.join(mode.get_source(mode_id) for mode_id, mode in zip(ids, self.modes))
+		generated += '# define\tCUSTOM_UPDATE_CASES\t' + ' '.join('case %d: %s; break;' % (mode_id,
+			get_call(UPDATE_TEMPLATE % mode_id, UPDATE_ARGUMENTS)) for mode_id in ids) + '\n'
+		generated += '# define\tCUSTOM_INIT_CASES\t' + ' '.join('case %d: %s; break;' % (mode_id,
+			get_call(INIT_TEMPLATE % mode_id, INIT_ARGUMENTS)) for mode_id in ids) + '\n'
+		return source.replace(SPLICE_MARKER, generated, 1)
+
+
+# Shared by every simulation, like the program cache
+custom_modes = CustomModes()
@@ -0,0 +1,87 @@
+import pyopencl as cl
+import numpy as np
+
+from exceptions import ParticleSystemException
+from file_to_string import file_to_string
+
+SORT_KERNEL_FILENAME = 'kernels/sort.cl'
+
+MAX_WORK_GROUP_SIZE = 256
+
+
+# Back-to-front particle order on the device, a bitonic sort of view-space depth keys.
+# The order is kept between calls, so the following frames can refine it with a few odd-even passes.
+class DepthSort:
+
+	def __init__(self, context, program_cache):
+		self.context = context
+		try:
+			program = program_cache.build(context, file_to_string(SORT_KERNEL_FILENAME))
+		except cl.RuntimeError as e:
+			raise ParticleSystemException('Error compiling ' + SORT_KERNEL_FILENAME + '\n' + str(e))
+
+		self.kernels = { name: cl.Kernel(program, name) for name in ('depth_keys', 'depth_keys_ordered',
+			'bitonic_sort_local', 'bitonic_merge_global', 'bitonic_merge_local', 'odd_even_pass') }
+
+		# Largest power of two the device and kernels allow
+		device = context.devices[0]
+		limit = min(MAX_WORK_GROUP_SIZE, device.max_work_group_size, device.local_mem_size // 16,
+			*(self.kernels[name].get_work_group_info(cl.kernel_work_group_info.WORK_GROUP_SIZE, device)
+			for name in ('bitonic_sort_local', 'bitonic_merge_local')))
+		self.max_work_group_size = 1 << (limit.bit_length() - 1)
+
+		self.n_padded = 0
+		self.keys = None
+		self.order = None
+
+	# Writes the n_particles indices, farthest first, into index_buffer, or only into self.order if None. positions are every `stride` floats,
+	# lifetimes every `lifetime_stride` floats from lifetime_offset. view_z is the view matrix row giving depth.
+	# Without `full`, refines the last order with n_passes odd-even passes instead. Returns the last event.
+	def __call__(self, queue, positions, lifetimes, stride, lifetime_offset, lifetime_stride, n_particles, view_z,
+			index_buffer, full=True, n_passes=0):
+		geometry = ( np.uint32(stride), np.uint32(lifetime_offset), np.uint32(lifetime_stride) )
+		view_z = cl.cltypes.make_float4(*view_z)
+		n_padded = max(2, 1 << (n_particles - 1).bit_length())
+		if n_padded != self.n_padded:
+			self.__init_buffers(n_padded)
+			full = True
+
+		if full:
+			self.kernels['depth_keys'](queue, (n_padded,), None,
+				positions, lifetimes, *geometry, np.uint32(n_particles), view_z, self.keys, self.order)
+			event = self.__sort(queue)
+		else:
+			event = self.kernels['depth_keys_ordered'](queue, (n_particles,), None,
+				positions, lifetimes, *geometry, view_z, self.order, self.keys)
+			n_pairs = max(n_particles // 2, 1)
+			for i in range(n_passes):
+				event = self.kernels['odd_even_pass'](queue, (n_pairs,), None,
+					self.keys, self.order, np.uint32(n_particles), np.uint32(i & 1))
+
+		if index_buffer is None:
+			return event
+		return cl.enqueue_copy(queue, index_buffer, self.order, byte_count=n_particles * 4)
+
+	def __sort(self, queue):
+		n = self.n_padded
+		work_group_size = min(self.max_work_group_size, n // 2)
+		block_size = 2 * work_group_size
+		global_size = (n // 2,)
+		local_size = (work_group_size,)
+		scratch = ( cl.LocalMemory(block_size * 4), cl.LocalMemory(block_size * 4) )
+
+		event = self.kernels['bitonic_sort_local'](queue, global_size, local_size, self.keys, self.order, *scratch)
+		k = 2 * block_size
+		while k <= n:
+			j = k // 2
+			while j >= block_size:
+				self.kernels['bitonic_merge_global'](queue, global_size, None, self.keys, self.order, np.uint32(k), np.uint32(j))
+				j //= 2
+			event = self.kernels['bitonic_merge_local'](queue, global_size, local_size, self.keys, self.order, np.uint32(k), *scratch)
+			k *= 2
+		return event
+
+	def __init_buffers(self, n_padded):
+		self.n_padded = n_padded
+		self.keys = cl.Buffer(self.context, cl.mem_flags.READ_WRITE, n_padded * 4)
+		self.order = cl.Buffer(self.context, cl.mem_flags.READ_WRITE, n_padded * 4)
@@ -0,0 +1,112 @@
+import pyopencl as cl
+import numpy as np
+
+from exceptions import ParticleSystemException
+
+REBALANCE_INTERVAL = 30			# updates between throughput measurements
+THROUGHPUT_SMOOTHING = 0.5		# weight of the newest measurement
+
+
+# n_partitions devices of one platform, or sub-devices of a CPU device split with device fission
+def get_partition_devices(n_partitions):
+	try:
+		platforms = cl.get_platforms()
+	except cl.Error as e:
+		raise ParticleSystemException('No OpenCL platform available\n' + str(e))
+
+	for platform in platforms:
+		devices = platform.get_devices()
+		if len(devices) >= n_partitions:
+			return devices[:n_partitions]
+
+	for platform in platforms:
+		for device in platform.get_devices():
+			if device.partition_max_sub_devices < n_partitions:
+				continue
+			if cl.device_partition_property.EQUALLY not in device.partition_properties:
+				continue
+			compute_units = max(1, device.max_compute_units // n_partitions)
+			return device.create_sub_devices([ cl.device_partition_property.EQUALLY, compute_units ])[:n_partitions]
+
+	raise ParticleSystemException('No platform with %d devices, and no device that splits into %d sub-devices'
+		% (n_partitions, n_partitions))
+
+def create_partitioned_context(n_partitions):
+	return cl.Context(get_partition_devices(n_partitions))
+
+
+# Splits the particle range across devices, one queue and one sub-buffer range per device.
+# Shares start proportional to compute units, then follow the measured update throughput.
+class DevicePartitions:
+
+	def __init__(self, context, n_particles, devices=None):
+		self.context = context
+		self.n_particles = n_particles
+		devices = devices if devices is not None else context.devices
+
+		# Profiling is what measures the throughput
+		self.queues = [ cl.CommandQueue(context, device, cl.command_queue_properties.PROFILING_ENABLE)
+			for device in devices ]
+
+		# Sub-buffer origins must be aligned to every device's base address alignment,
+		# a multiple of that many particles is aligned whatever the per-particle size
+		self.granule = max(device.mem_base_addr_align // 8 for device in devices)
+
+		# Fraction of the particles each device gets
+		estimate = np.array([ float(device.max_compute_units * max(device.max_clock_frequency, 1)) for device in devices ])
+		self.shares = estimate / np.sum(estimate)
+		self.ranges = self.__split()
+		self.__sub_buffers = {}
+		self.__n_updates = 0
+
+	# [ (queue, start, count) ], partitions with nothing to do are left out
+	def get_ranges(self):
+		return [ (queue, start, count) for queue, (start, count) in zip(self.queues, self.ranges) if count > 0 ]
+
+	# Sub-buffer of parent over a partition's range, for element_size bytes per particle
+	def get_sub_buffer(self, parent, element_size, start, count):
+		key = (parent.int_ptr, element_size, start, count)
+		sub_buffer = self.__sub_buffers.get(key)
+		if sub_buffer is None:
+			sub_buffer = parent.get_sub_region(start * element_size, count * element_size)
+			self.__sub_buffers[key] = sub_buffer
+		return sub_buffer
+
+	# Update events of one dispatch, in partition order. Every REBALANCE_INTERVAL updates,
+	# waits for them and moves the ranges toward each device's measured throughput.
+	def record(self, events):
+		self.__n_updates += 1
+		if self.__n_updates % REBALANCE_INTERVAL or len(self.queues) == 1:
+			return
+
+		cl.wait_for_events(events)
+		throughput = np.zeros(len(self.queues))
+		partitions = [ i for i, (start, count) in enumerate(self.ranges) if count > 0 ]
+		for i, event in zip(partitions, events):
+			duration_ns = max(event.profile.end - event.profile.start, 1)
+			throughput[i] = self.ranges[i][1] / duration_ns
+
+		# Devices left without particles keep their previous share
+		measured = throughput > 0.0
+		measured_shares = self.shares.copy()
+		measured_shares[measured] = throughput[measured] / np.sum(throughput[measured]) * np.sum(self.shares[measured])
+		self.shares = THROUGHPUT_SMOOTHING * measured_shares + (1.0 - THROUGHPUT_SMOOTHING) * self.shares
+
+		ranges = self.__split()
+		if ranges != self.ranges:
+			self.ranges = ranges
+			self.__sub_buffers = {}
+
+	# Contiguous (start, count) per device, proportional to its share and rounded to the granule
+	def __split(self):
+		ranges = []
+		start = 0
+		for i, share in enumerate(self.shares):
+			if i == len(self.shares) - 1:
+				count = self.n_particles - start
+			else:
+				count = int(round(share * self.n_particles / self.granule)) * self.granule
+				count = min(count, self.n_particles - start)
+			ranges.append((start, count))
+			start += count
+		return ranges
@@ -0,0 +1,57 @@
+import os
+import tempfile
+
+CACHE_ROOT = os.path.join(
+	os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache')),
+	'particle_system')
+
+
+# Directory of one cache, like programs or textures, under $XDG_CACHE_HOME/particle_system
+def get_cache_directory(name):
+	return os.path.join(CACHE_ROOT, name)
+
+# Writes to a temporary file first, so a crash can't leave a half-written entry behind.
+# Raises OSError if it fails, the temporary file is removed then.
+def write_atomically(path, data):
+	directory = os.path.dirname(path)
+	os.makedirs(directory, exist_ok=True)
+	fd, temp_path = tempfile.mkstemp(dir=directory)
+	try:
+		with os.fdopen(fd, 'wb') as file:
+			file.write(data)
+		os.replace(temp_path, path)
+	except BaseException:
+		remove(temp_path)
+		raise
+
+# Marks an entry as recently used
+def touch(path):
+	try:
+		os.utime(path)
+	except OSError:
+		pass
+
+def remove(path):
+	try:
+		os.remove(path)
+	except OSError:
+		pass
+
+# Removes the least recently used entries ending in suffix once their total size exceeds max_bytes
+def evict(directory, suffix, max_bytes):
+	entries = []
+	for name in os.listdir(directory):
+		if name.endswith(suffix):
+			path = os.path.join(directory, name)
+			try:
+				stat = os.stat(path)
+			except OSError:
+				continue			# removed by another process meanwhile
+			entries.append((stat.st_mtime, stat.st_size, path))
+
+	# Newest first, everything past the size bound goes
+	total_bytes = 0
+	for _, size, path in sorted(entries, reverse=True):
+		total_bytes += size
+		if total_bytes > max_bytes:
+			remove(path)
@@ -0,0 +1,116 @@
+import json
+import numpy as np
+
+from exceptions import ParticleSystemException
+from custom_modes import custom_modes
+
+MAX_EMITTERS = 256					# particles carry their emitter index as a uchar
+N_EMITTER_MODES = 6					# Stationary to Vortex Attractor, the modes update steps per particle
+
+DEFAULT_LIFETIME = 1.0 / 0.6		# seconds, life decays by 0.01 every 1/60 s
+DEFAULT_RATE = 6000.0				# particles per second of the generator, unless there is an emission rate
+
+# Like emitter_t in kernels/kernel.cl, 48 bytes
+EMITTER_DTYPE = np.dtype({
+	'names': [ 'position', 'particle_mode_id', 'color_profile_id', 'spawn_in_cube', 'decay', 'rate', 'first', 'n_emit' ],
+	'formats': [ (np.float32, (4,)), np.int32, np.int32, np.int32, np.float32, np.float32, np.uint32, np.uint32 ],
+	'offsets': [ 0, 16, 20, 24, 28, 32, 36, 40 ],
+	'itemsize': 48,
+	})
+
+
+# Modes update steps per particle, which any emitter can run
+def is_emitter_mode(particle_mode_id):
+	return 0 <= particle_mode_id < N_EMITTER_MODES or custom_modes.is_custom(particle_mode_id)
+
+
+# Emitters of one simulation, uploaded as a struct buffer so a single dispatch serves all of them.
+# Emitter 0 is the generator and follows the simulation's own generator_position, modes and emission rate.
+# Each emitter owns a contiguous range of particles, sized by rate times lifetime, its share of the live particles.
+class EmitterTable:
+
+	def __init__(self):
+		self.table = np.zeros(MAX_EMITTERS, dtype=EMITTER_DTYPE)
+		self.n_emitters = 1
+		self.table[0]['decay'] = 1.0 / DEFAULT_LIFETIME
+
+		# Particles not emitted yet, a fraction carried to the next step
+		self.budgets = np.zeros(MAX_EMITTERS)
+
+	def __len__(self):
+		return self.n_emitters
+
+	# Returns the index of the new emitter
+	def add(self, position, particle_mode_id=0, color_profile_id=0, spawn_in_cube=False, rate=DEFAULT_RATE,
+			lifetime=DEFAULT_LIFETIME):
+		if self.n_emitters == MAX_EMITTERS:
+			raise ParticleSystemException('No more than %d emitters' % MAX_EMITTERS)
+		if not is_emitter_mode(particle_mode_id):
+			raise ParticleSystemException('Emitters run particle modes 0-%d and custom modes, interacting and N-body modes use the generator'
+				% (N_EMITTER_MODES - 1))
+		if rate <= 0.0 or lifetime <= 0.0:
+			raise ParticleSystemException('Emitter rate and lifetime must be positive')
+
+		emitter = self.table[self.n_emitters]
+		emitter['position'] = ( *position[:3], 1.0 )
+		emitter['particle_mode_id'] = particle_mode_id
+		emitter['color_profile_id'] = color_profile_id
+		emitter['spawn_in_cube'] = spawn_in_cube
+		emitter['rate'] = rate
+		emitter['decay'] = 1.0 / lifetime
+		self.budgets[self.n_emitters] = 0.0
+		self.n_emitters += 1
+		return self.n_emitters - 1
+
+	# The generator can't be removed
+	def remove(self, index):
+		if not 0 < index < self.n_emitters:
+			raise ParticleSystemException('No emitter %d to remove' % index)
+		self.table[index:self.n_emitters - 1] = self.table[index + 1:self.n_emitters]
+		self.budgets[index:self.n_emitters - 1] = self.budgets[index + 1:self.n_emitters]
+		self.n_emitters -= 1
+
+	# A JSON list of { "position", "particle_mode_id", "color_profile_id", "spawn_in_cube", "rate", "lifetime" }
+	def load(self, filename):
+		try:
+			with open(filename, 'r') as file:
+				emitters = json.load(file)
+			for emitter in emitters:
+				self.add(**emitter)
+		except (OSError, ValueError, TypeError) as e:
+			raise ParticleSystemException('Cannot load emitters from ' + filename + '\n' + str(e))
+
+	def sync_generator(self, simulation):
+		generator = self.table[0]
+		generator['position'] = simulation.generator_position
+		generator['particle_mode_id'] = simulation.particle_mode_id
+		generator['color_profile_id'] = simulation.color_profile_id
+		generator['spawn_in_cube'] = simulation.spawn_in_cube
+		generator['rate'] = simulation.emission_rate if simulation.emission_rate is not None else DEFAULT_RATE
+
+	# Writes every emitter's first particle, and returns the emitter index of each particle
+	def assign(self, n_particles):
+		emitters = self.table[:self.n_emitters]
+		weights = emitters['rate'].astype(np.float64) / emitters['decay']
+		ends = np.floor(np.cumsum(weights) / np.sum(weights) * n_particles).astype(np.int64)
+		ends[-1] = n_particles
+		emitters['first'] = np.concatenate(([ 0 ], ends[:-1]))
+		return np.repeat(np.arange(self.n_emitters, dtype=np.uint8), np.diff(np.concatenate(([ 0 ], ends))))
+
+	# What assign() depends on, it only has to run again when this changes
+	def get_assignment_key(self, n_particles):
+		emitters = self.table[:self.n_emitters]
+		return (n_particles, emitters['rate'].tobytes(), emitters['decay'].tobytes())
+
+	# Writes how many particles each emitter respawns over the next `seconds`, and returns the total
+	def next_emission(self, seconds):
+		emitters = self.table[:self.n_emitters]
+		budgets = self.budgets[:self.n_emitters]
+		budgets += emitters['rate'] * seconds
+		n_emit = np.floor(budgets)
+		budgets -= n_emit
+		emitters['n_emit'] = n_emit
+		return int(np.sum(n_emit))
+
+	def get_table(self):
+		return self.table[:self.n_emitters]
@@ -0,0 +1,144 @@
+import pyopencl as cl
+import numpy as np
+from collections import OrderedDict
+
+from exceptions import ParticleSystemException
+
+FIELD_KINDS = ( 'curl', 'wind', 'vortex' )		# built-in fields, anything else is a .npy file
+
+DEFAULT_RESOLUTION = 32			# voxels per side
+FIELD_EXTENT = 2.0				# world units covered by one period of a field, it repeats beyond
+DEFAULT_STRENGTH = 0.01			# displacement per 1/60 s at unit field magnitude
+CURL_NOISE_CUTOFF = 4			# wavenumbers kept in the curl noise potential, lower is smoother
+MAX_CACHED_FIELDS = 8
+
+
+# Curl of a smooth random vector potential, divergence-free so particles swirl without bunching up.
+# Low-pass filtered in the frequency domain, so it tiles seamlessly.
+def build_curl_noise(resolution, seed):
+	rng = np.random.default_rng(seed)
+	frequencies = np.fft.fftfreq(resolution) * resolution
+	kz, ky, kx = np.meshgrid(frequencies, frequencies, frequencies, indexing='ij')
+	low_pass = np.exp(-(kx ** 2 + ky ** 2 + kz ** 2) / (2.0 * CURL_NOISE_CUTOFF ** 2))
+	potential = [ np.fft.ifftn(np.fft.fftn(rng.standard_normal((resolution,) * 3)) * low_pass).real for _ in range(3) ]
+
+	# Central differences with wrap-around, arrays are indexed [z, y, x]
+	def derivative(field, axis):
+		return (np.roll(field, -1, axis) - np.roll(field, 1, axis)) * 0.5
+
+	px, py, pz = potential
+	return np.stack((
+		derivative(pz, 1) - derivative(py, 0),
+		derivative(px, 0) - derivative(pz, 2),
+		derivative(py, 2) - derivative(px, 1),
+		), axis=-1)
+
+# A steady breeze along x, with gusts rolling through it
+def build_wind(resolution, seed):
+	rng = np.random.default_rng(seed)
+	phase = rng.uniform(0.0, 2.0 * np.pi, 3)
+	z, y, x = np.meshgrid(*(np.arange(resolution) * 2.0 * np.pi / resolution,) * 3, indexing='ij')
+	gust = 0.5 + 0.5 * np.sin(x + phase[0]) * np.cos(z + phase[1])
+	return np.stack((
+		gust,
+		0.2 * np.sin(y + z + phase[2]),
+		0.2 * np.cos(x + y + phase[2]),
+		), axis=-1)
+
+# A lattice of counter-rotating vortex cells (Taylor-Green), two per period on every axis
+def build_vortex_lattice(resolution, seed):
+	z, y, x = np.meshgrid(*(np.arange(resolution) * 2.0 * np.pi / resolution,) * 3, indexing='ij')
+	return np.stack((
+		np.sin(x) * np.cos(y) * np.cos(z),
+		-np.cos(x) * np.sin(y) * np.cos(z),
+		np.zeros_like(x),
+		), axis=-1)
+
+FIELD_BUILDERS = {
+	'curl': build_curl_noise,
+	'wind': build_wind,
+	'vortex': build_vortex_lattice,
+	}
+
+# A (depth, height, width, 3 or 4) array indexed [z, y, x], used as is
+def load_field(filename):
+	try:
+		field = np.load(filename)
+	except (OSError, ValueError) as e:
+		raise ParticleSystemException('Cannot load force field from ' + filename + '\n' + str(e))
+	if field.ndim != 4 or field.shape[3] not in (3, 4) or min(field.shape[:3]) < 1:
+		raise ParticleSystemException('Force field ' + filename + ' must have shape (depth, height, width, 3 or 4), not '
+			+ str(field.shape))
+	return field[..., :3]
+
+# (depth, height, width, 4) float32 vectors, built-in fields scaled to a largest magnitude of 1
+def build_field(name, resolution=DEFAULT_RESOLUTION, seed=0):
+	if name in FIELD_BUILDERS:
+		field = FIELD_BUILDERS[name](resolution, seed)
+		field /= max(np.max(np.linalg.norm(field, axis=-1)), 1e-12)
+	else:
+		field = load_field(name)
+	padding = np.zeros(field.shape[:3] + (1,))
+	return np.ascontiguousarray(np.concatenate((field, padding), axis=-1), dtype=np.float32)
+
+# Trilinear filtering with repeat addressing, like an OpenCL sampler with normalized coordinates,
+# CLK_ADDRESS_REPEAT and CLK_FILTER_LINEAR. coordinates are (n, 3) in periods of the field.
+def sample_field(field, coordinates):
+	size = np.array(field.shape[2::-1], dtype=np.float32)		# width, height, depth
+	u = (coordinates - np.floor(coordinates)) * size - np.float32(0.5)
+	i0 = np.floor(u)
+	a = u - i0
+	i0 = i0.astype(np.int64) % size.astype(np.int64)
+	i1 = (i0 + 1) % size.astype(np.int64)
+
+	result = np.zeros((len(coordinates), 4), dtype=np.float32)
+	for corner in range(8):
+		x, y, z = (( i1 if corner >> axis & 1 else i0 )[:, axis] for axis in range(3))
+		weight = np.prod([ a[:, axis] if corner >> axis & 1 else 1.0 - a[:, axis] for axis in range(3) ], axis=0)
+		result += weight[:, np.newaxis] * field[z, y, x]
+	return result
+
+
+# Fields by name, resolution and seed, built once and kept in an LRU so switching back to a field is free.
+# With an OpenCL context, the fields are also uploaded as float4 image3d_t volumes.
+class ForceFieldCache:
+
+	def __init__(self, context=None, max_fields=MAX_CACHED_FIELDS):
+		self.context = context
+		self.max_fields = max_fields
+		self.__fields = OrderedDict()			# key: (host array, cl.Image or None)
+
+	def get_data(self, name, resolution=DEFAULT_RESOLUTION, seed=0):
+		return self.__get(name, resolution, seed)[0]
+
+	def get_image(self, name, resolution=DEFAULT_RESOLUTION, seed=0):
+		key = (name, resolution, seed)
+		data, image = self.__get(*key)
+		if image is None:
+			image = self.__upload(data)
+			self.__fields[key] = (data, image)
+		return image
+
+	def __get(self, name, resolution, seed):
+		key = (name, resolution, seed)
+		entry = self.__fields.get(key)
+		if entry is not None:
+			self.__fields.move_to_end(key)
+			return entry
+
+		entry = (build_field(name, resolution, seed), None)
+		self.__fields[key] = entry
+		if len(self.__fields) > self.max_fields:
+			self.__fields.popitem(last=False)
+		return entry
+
+	def __upload(self, data):
+		device = self.context.devices[0]
+		if not device.image_support:
+			raise ParticleSystemException('Force fields need image support, which ' + device.name + ' lacks')
+		image_format = cl.ImageFormat(cl.channel_order.RGBA, cl.channel_type.FLOAT)
+		try:
+			return cl.Image(self.context, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR, image_format,
+				shape=data.shape[2::-1], hostbuf=data)
+		except cl.Error as e:
+			raise ParticleSystemException('Cannot create a %dx%dx%d force field image\n' % data.shape[2::-1] + str(e))
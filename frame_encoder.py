@@ -0,0 +1,31 @@
+import numpy as np
+from multiprocessing import shared_memory
+from PIL import Image
+
+# Worker side of FrameCapture, kept free of OpenGL and OpenCL so spawned workers import quickly
+
+
+# RGBA rows as read by glReadPixels, bottom row first, from a shared memory block
+def read_frame(shm_name, offset, width, height):
+	shm = shared_memory.SharedMemory(name=shm_name)
+	try:
+		# Copied out, the view must be gone before the block is closed
+		pixels = np.flipud(np.ndarray((height, width, 4), dtype=np.uint8, buffer=shm.buf, offset=offset)).copy()
+	finally:
+		shm.close()
+	return Image.fromarray(pixels, 'RGBA')
+
+def encode_frame(shm_name, offset, width, height, filename, image_format):
+	image = read_frame(shm_name, offset, width, height)
+	if image_format == 'gif':
+		# Palette quantization is the slow part of GIF encoding, every frame gets its own palette here
+		image.convert('RGB').quantize(colors=256).save(filename)
+	else:
+		image.save(filename)
+
+# Frames written by encode_frame() as single-frame GIFs, into one looping GIF
+def assemble_gif(filenames, output_filename, frame_duration_ms):
+	frames = [ Image.open(filename) for filename in filenames ]
+	frames[0].save(output_filename, save_all=True, append_images=frames[1:], duration=frame_duration_ms, loop=0)
+	for frame in frames:
+		frame.close()
@@ -0,0 +1,182 @@
+from OpenGL.GL import *
+import numpy as np
+import contextlib
+import json
+import time
+from colorama import Style
+
+import pyopencl as cl
+
+# Host phases are timed with perf_counter, acquire/kernel/copy/release with OpenCL events, draw with GL_TIME_ELAPSED
+PHASES = ( 'input', 'compute', 'sort', 'cull', 'acquire', 'kernel', 'copy', 'release', 'clear', 'draw', 'capture', 'swap', 'frame' )
+
+DEFAULT_CAPACITY = 4096			# frames kept in the ring buffer
+N_GL_QUERIES = 4				# draw timings are read a few frames late, so the GPU never stalls
+REPORT_INTERVAL = 2.0			# seconds between terminal reports
+PERCENTILES = ( 50, 95, 99 )
+
+NO_PHASE = contextlib.nullcontext()
+
+
+# Per-frame phase timings in a preallocated ring buffer, all in seconds.
+# Device timings arrive asynchronously, and are written back into the row of their frame.
+class FrameProfiler:
+
+	def __init__(self, capacity=DEFAULT_CAPACITY, enabled=True):
+		self.capacity = capacity
+		self.enabled = enabled
+
+		self.samples = np.full((capacity, len(PHASES)), np.nan)
+		self.timestamps = np.full(capacity, np.nan)
+		self.n_frames = 0
+
+		self.__columns = { name: column for column, name in enumerate(PHASES) }
+		self.__frame_start = 0.0
+		self.__last_report = time.perf_counter()
+		self.__pending_events = []			# (frame, phase, cl.Event)
+		self.__gl_queries = None
+		self.__pending_queries = {}			# query slot: (frame, phase)
+
+	def begin_frame(self):
+		if not self.enabled:
+			return
+		row = self.n_frames % self.capacity
+		self.samples[row] = np.nan
+		self.__frame_start = time.perf_counter()
+		self.timestamps[row] = self.__frame_start
+
+	def end_frame(self):
+		if not self.enabled:
+			return
+		self.__add(self.n_frames, 'frame', time.perf_counter() - self.__frame_start)
+		self.__resolve_events()
+		self.__resolve_gl_queries(wait=False)
+		self.n_frames += 1
+
+		if time.perf_counter() - self.__last_report >= REPORT_INTERVAL:
+			self.__last_report = time.perf_counter()
+			self.report()
+
+	# with profiler.phase('swap'): ...
+	def phase(self, name):
+		if not self.enabled:
+			return NO_PHASE
+		return self.__host_phase(name)
+
+	# (phase, cl.Event) pairs from a profiling-enabled queue
+	def add_events(self, events):
+		if not self.enabled:
+			return
+		for name, event in events:
+			self.__pending_events.append((self.n_frames, name, event))
+
+	def begin_gl_query(self, name):
+		if not self.enabled:
+			return
+		if self.__gl_queries is None:
+			self.__gl_queries = glGenQueries(N_GL_QUERIES)
+
+		slot = self.n_frames % N_GL_QUERIES
+		if slot in self.__pending_queries:
+			# Still unread after N_GL_QUERIES frames, wait for it rather than lose it
+			self.__resolve_gl_queries(wait=True)
+		self.__pending_queries[slot] = (self.n_frames, name)
+		glBeginQuery(GL_TIME_ELAPSED, self.__gl_queries[slot])
+
+	def end_gl_query(self):
+		if not self.enabled:
+			return
+		glEndQuery(GL_TIME_ELAPSED)
+
+	# Rolling { phase: (p50, p95, p99) } over the frames in the ring buffer, phases never timed are left out
+	def percentiles(self):
+		samples = self.__ordered_samples()
+		summary = {}
+		for column, name in enumerate(PHASES):
+			values = samples[:, column]
+			values = values[~np.isnan(values)]
+			if len(values):
+				summary[name] = tuple(float(p) for p in np.percentile(values, PERCENTILES))
+		return summary
+
+	def report(self):
+		print(Style.BRIGHT + 'FRAME PROFILE: \t' + Style.RESET_ALL, '%d frames, milliseconds p50 / p95 / p99' % self.n_frames)
+		for name, values in self.percentiles().items():
+			print('\t%-8s %8.3f %8.3f %8.3f' % (name, *(value * 1e3 for value in values)))
+
+	# Write the ring buffer as CSV, or JSON when filename ends in .json, in milliseconds
+	def dump(self, filename):
+		self.__resolve_events()
+		self.__resolve_gl_queries(wait=True)
+
+		n_rows = min(self.n_frames, self.capacity)
+		frames = np.arange(self.n_frames - n_rows, self.n_frames)
+		timestamps = self.__ordered(self.timestamps)
+		samples = self.__ordered_samples() * 1e3
+
+		if filename.endswith('.json'):
+			report = {
+				'phases': PHASES,
+				'percentiles': PERCENTILES,
+				'summary_ms': { name: [ value * 1e3 for value in values ] for name, values in self.percentiles().items() },
+				'frames': [
+					dict(frame_index=int(frame), time=float(timestamp), **{ name: (None if np.isnan(value) else float(value))
+						for name, value in zip(PHASES, row) })
+					for frame, timestamp, row in zip(frames, timestamps, samples)
+					],
+				}
+			with open(filename, 'w') as file:
+				json.dump(report, file, indent='\t')
+		else:
+			table = np.column_stack((frames, timestamps, samples))
+			np.savetxt(filename, table, delimiter=',', fmt=[ '%d' ] + [ '%.6f' ] * (table.shape[1] - 1), header=','.join(('frame_index', 'time', *PHASES)), comments='')
+
+		print(Style.BRIGHT + 'FRAME PROFILE: \t' + Style.RESET_ALL, 'wrote %d frames to %s' % (n_rows, filename))
+
+	@contextlib.contextmanager
+	def __host_phase(self, name):
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.__add(self.n_frames, name, time.perf_counter() - start)
+
+	# Phases timed more than once in a frame add up
+	def __add(self, frame, name, seconds):
+		if self.n_frames - frame >= self.capacity:
+			return
+		row = frame % self.capacity
+		column = self.__columns[name]
+		previous = self.samples[row, column]
+		self.samples[row, column] = seconds if np.isnan(previous) else previous + seconds
+
+	def __resolve_events(self):
+		pending = []
+		for frame, name, event in self.__pending_events:
+			if event.command_execution_status != cl.command_execution_status.COMPLETE:
+				pending.append((frame, name, event))
+				continue
+			self.__add(frame, name, (event.profile.end - event.profile.start) * 1e-9)
+		self.__pending_events = pending
+
+	def __resolve_gl_queries(self, wait):
+		available = np.zeros(1, dtype=np.int32)
+		elapsed_ns = GLuint64(0)			# PyOpenGL can't map a uint64 array to a GL type
+
+		for slot, (frame, name) in list(self.__pending_queries.items()):
+			if not wait:
+				glGetQueryObjectiv(self.__gl_queries[slot], GL_QUERY_RESULT_AVAILABLE, available)
+				if not available[0]:
+					continue
+			glGetQueryObjectui64v(self.__gl_queries[slot], GL_QUERY_RESULT, elapsed_ns)
+			self.__add(frame, name, elapsed_ns.value * 1e-9)
+			del self.__pending_queries[slot]
+
+	# Ring buffer rows from oldest to newest
+	def __ordered(self, array):
+		if self.n_frames <= self.capacity:
+			return array[:self.n_frames]
+		return np.roll(array, -(self.n_frames % self.capacity), axis=0)
+
+	def __ordered_samples(self):
+		return self.__ordered(self.samples)
@@ -0,0 +1,94 @@
+import pyopencl as cl
+import numpy as np
+
+from exceptions import ParticleSystemException
+from file_to_string import file_to_string
+
+CULL_KERNEL_FILENAME = 'kernels/cull.cl'
+
+LOD_TILE_SIZE = 8				# pixels, the screen is binned into tiles this wide for the level of detail
+
+
+# The same visibility on the host, for host backends: a bool per particle
+def get_visible(position, lifetime, view_projection, viewport, point_size, lod_budget):
+	clip = np.c_[position[:, :3], np.ones(len(position), dtype=np.float32)] @ np.asarray(view_projection, dtype=np.float32).T
+	x, y, z, w = clip.T
+	margin = np.float32(point_size) / np.array(viewport, dtype=np.float32)
+	visible = (lifetime > 0.0) & (w > 0.0) & (np.abs(x) <= w * (1.0 + margin[0])) & (np.abs(y) <= w * (1.0 + margin[1])) & \
+		(np.abs(z) <= w)
+	if not lod_budget:
+		return visible
+
+	n_tiles = np.array([ -(-size // LOD_TILE_SIZE) for size in viewport ])
+	with np.errstate(divide='ignore', invalid='ignore'):
+		ndc = np.clip(clip[:, :2] / w[:, np.newaxis] * 0.5 + 0.5, 0.0, 1.0)
+	ndc = np.nan_to_num(ndc)
+	tile_xy = np.minimum((ndc * n_tiles).astype(np.int64), n_tiles - 1)
+	tile = tile_xy[:, 1] * n_tiles[0] + tile_xy[:, 0]
+	counts = np.bincount(tile[visible], minlength=n_tiles[0] * n_tiles[1])[tile]
+	return visible & ((counts <= lod_budget) | (get_lod_fraction(np.arange(len(position))) * counts < lod_budget))
+
+# Like get_lod_fraction() in kernels/cull.cl
+def get_lod_fraction(index):
+	index = index.astype(np.uint32)
+	index ^= index >> 16
+	index *= np.uint32(0x7FEB352D)
+	index ^= index >> 15
+	index *= np.uint32(0x846CA68B)
+	index ^= index >> 16
+	return (index >> 8).astype(np.float32) * np.float32(1.0 / 16777216.0)
+
+
+# Indices of the particles on screen for an indirect draw, in the order given, and their count.
+# With a LOD budget, no screen tile gets many more than that many particles.
+class FrustumCull:
+
+	def __init__(self, context, program_cache, prefix_sum):
+		self.context = context
+		self.prefix_sum = prefix_sum
+		try:
+			program = program_cache.build(context, file_to_string(CULL_KERNEL_FILENAME))
+		except cl.RuntimeError as e:
+			raise ParticleSystemException('Error compiling ' + CULL_KERNEL_FILENAME + '\n' + str(e))
+
+		self.bin_tiles = cl.Kernel(program, 'bin_tiles')
+		self.flag_visible = cl.Kernel(program, 'flag_visible')
+		self.compact_visible = cl.Kernel(program, 'compact_visible')
+
+		self.n_particles = 0
+		self.is_visible = None
+		self.visible_rank = None
+		self.tile_counts = None
+		self.n_tiles = None
+
+	# positions are every `stride` floats, lifetimes every `lifetime_stride` floats from lifetime_offset.
+	# view_projection is row-major, viewport is (width, height) in pixels, point_size in pixels too.
+	# order holds the particle to visit at each position, None for index order. Returns the last event.
+	def __call__(self, queue, positions, lifetimes, stride, lifetime_offset, lifetime_stride, n_particles,
+			view_projection, viewport, point_size, lod_budget, index_buffer, command_buffer, order=None):
+		if n_particles != self.n_particles:
+			self.__init_buffers(n_particles)
+		n_tiles = tuple(-(-size // LOD_TILE_SIZE) for size in viewport)
+		if n_tiles != self.n_tiles:
+			self.tile_counts = cl.Buffer(self.context, cl.mem_flags.READ_WRITE, n_tiles[0] * n_tiles[1] * 4)
+			self.n_tiles = n_tiles
+
+		view = ( positions, lifetimes, np.uint32(stride), np.uint32(lifetime_offset), np.uint32(lifetime_stride),
+			order, np.uint32(order is not None),
+			cl.cltypes.make_float16(*np.asarray(view_projection, dtype=np.float32).ravel()),
+			cl.cltypes.make_float2(point_size / viewport[0], point_size / viewport[1]),
+			cl.cltypes.make_uint2(*n_tiles) )
+		n = (n_particles,)
+
+		if lod_budget:
+			cl.enqueue_fill_buffer(queue, self.tile_counts, np.uint32(0), 0, self.tile_counts.size)
+			self.bin_tiles(queue, n, None, *view, self.tile_counts)
+		self.flag_visible(queue, n, None, *view, self.tile_counts, np.uint32(lod_budget), self.is_visible)
+		self.prefix_sum(queue, self.is_visible, self.visible_rank, n_particles)
+		return self.compact_visible(queue, n, None, np.uint32(n_particles), order, np.uint32(order is not None),
+			self.is_visible, self.visible_rank, index_buffer, command_buffer)
+
+	def __init_buffers(self, n_particles):
+		self.n_particles = n_particles
+		self.is_visible = cl.Buffer(self.context, cl.mem_flags.READ_WRITE, n_particles * 4)
+		self.visible_rank = cl.Buffer(self.context, cl.mem_flags.READ_WRITE, n_particles * 4)
@@ -0,0 +1,48 @@
+import pyopencl as cl
+from collections import OrderedDict
+
+MAX_VARIANTS = 64				# every mode and color profile of a benchmark sweep, 50, fits
+
+KERNEL_NAMES = ( 'init', 'update', 'change_color', 'record_trail', 'count_cells', 'scatter_particles', 'compute_density', 'interact',
+	'gather_bodies', 'nbody_tiled', 'bin_bodies', 'scatter_bodies', 'sum_leaves', 'sum_children', 'nbody_barnes_hut',
+	'integrate_nbody', 'flag_dead', 'compact_live' )
+
+
+def get_options(key):
+	return [ '-D%s=%d' % (macro, value) for macro, value in key ]
+
+
+# Programs compiled with -D FIXED_<NAME>=<value> options, built on first use and kept in an LRU
+class KernelVariants:
+
+	def __init__(self, context, source, program_cache, max_variants=MAX_VARIANTS):
+		self.context = context
+		self.source = source
+		self.program_cache = program_cache
+		self.max_variants = max_variants
+		self.__variants = OrderedDict()
+		self.__pending = {}			# key: future of the program, see prebuild()
+
+	# key is a tuple of (macro, value) pairs, returns { kernel name: cl.Kernel }
+	def get(self, key):
+		kernels = self.__variants.get(key)
+		if kernels is not None:
+			self.__variants.move_to_end(key)
+			return kernels
+
+		# A build started by prebuild() is waited for, its errors are raised here
+		pending = self.__pending.pop(key, None)
+		program = pending.result() if pending is not None else self.program_cache.build(self.context, self.source, get_options(key))
+
+		# Retrieve each kernel once, program.<name> makes a new kernel object on every access
+		kernels = { name: cl.Kernel(program, name) for name in KERNEL_NAMES }
+		self.__variants[key] = kernels
+		if len(self.__variants) > self.max_variants:
+			self.__variants.popitem(last=False)
+		return kernels
+
+	# Starts building the variant on a startup worker thread (see startup.py), get(key) waits for it
+	def prebuild(self, key, startup):
+		if key in self.__variants or key in self.__pending:
+			return
+		self.__pending[key] = startup.submit('kernel build', self.program_cache.build, self.context, self.source, get_options(key))
@@ -0,0 +1,121 @@
+/*
+	Frustum culling of the particles drawn, with an optional screen-space level of detail.
+	Particles are visited in draw order, the depth sorted order when there is one. A live particle whose
+	point sprite overlaps the view volume is visible. With a LOD budget, bin_tiles counts the visible
+	particles of every screen tile, and flag_visible keeps about budget of them per tile, always the same
+	ones by a hash of their index, so thinned tiles don't flicker. compact_visible packs the visible indices,
+	in order, into the element buffer of the indirect draw and writes their count.
+*/
+
+inline uint get_particle(__global const uint* order, uint is_ordered, uint id)
+{
+	return is_ordered ? order[id] : id;
+}
+
+// Clip-space position of a live particle inside the view volume grown by margin (NDC units), else 0
+inline int get_clip_position(
+	__global const float* positions,
+	__global const float* lifetimes,
+	uint stride,
+	uint lifetime_offset,
+	uint lifetime_stride,
+	uint index,
+	float16 view_projection,
+	float2 margin,
+	float4* clip)
+{
+	if (lifetimes[index * lifetime_stride + lifetime_offset] <= 0.0f)
+		return 0;
+
+	__global const float* p = positions + index * stride;
+	float4 position = (float4)(p[0], p[1], p[2], 1.0f);
+	*clip = (float4)(dot(view_projection.s0123, position), dot(view_projection.s4567, position),
+		dot(view_projection.s89ab, position), dot(view_projection.scdef, position));
+
+	float w = clip->w;
+	return w > 0.0f && fabs(clip->x) <= w * (1.0f + margin.x) && fabs(clip->y) <= w * (1.0f + margin.y) && fabs(clip->z) <= w;
+}
+
+inline uint get_tile(float4 clip, uint2 n_tiles)
+{
+	float2 ndc = clamp(clip.xy / clip.w * 0.5f + 0.5f, 0.0f, 1.0f);
+	uint2 tile = min(convert_uint2(ndc * convert_float2(n_tiles)), n_tiles - 1);
+
+	return tile.y * n_tiles.x + tile.x;
+}
+
+// A fixed pseudo-random fraction per particle
+inline float get_lod_fraction(uint index)
+{
+	index ^= index >> 16;
+	index *= 0x7FEB352Du;
+	index ^= index >> 15;
+	index *= 0x846CA68Bu;
+	index ^= index >> 16;
+	return (index >> 8) * (1.0f / 16777216.0f);
+}
+
+__kernel void bin_tiles(
+	__global const float* positions,
+	__global const float* lifetimes,
+	uint stride,
+	uint lifetime_offset,
+	uint lifetime_stride,
+	__global const uint* order,
+	uint is_ordered,
+	float16 view_projection,
+	float2 margin,
+	uint2 n_tiles,
+	__global uint* tile_counts)
+{
+	uint index = get_particle(order, is_ordered, get_global_id(0));
+	float4 clip;
+
+	if (get_clip_position(positions, lifetimes, stride, lifetime_offset, lifetime_stride, index, view_projection, margin, &clip))
+		atomic_inc(&tile_counts[get_tile(clip, n_tiles)]);
+}
+
+__kernel void flag_visible(
+	__global const float* positions,
+	__global const float* lifetimes,
+	uint stride,
+	uint lifetime_offset,
+	uint lifetime_stride,
+	__global const uint* order,
+	uint is_ordered,
+	float16 view_projection,
+	float2 margin,
+	uint2 n_tiles,
+	__global const uint* tile_counts,
+	uint lod_budget,
+	__global uint* is_visible)
+{
+	size_t id = get_global_id(0);
+	uint index = get_particle(order, is_ordered, id);
+	float4 clip;
+	uint visible = get_clip_position(positions, lifetimes, stride, lifetime_offset, lifetime_stride, index, view_projection, margin, &clip);
+
+	if (visible && lod_budget)
+	{
+		uint count = tile_counts[get_tile(clip, n_tiles)];
+		visible = count <= lod_budget || get_lod_fraction(index) * count < lod_budget;
+	}
+	is_visible[id] = visible;
+}
+
+__kernel void compact_visible(
+	uint n_particles,
+	__global const uint* order,
+	uint is_ordered,
+	__global const uint* is_visible,
+	__global const uint* visible_rank,
+	__global uint* indices,
+	__global uint* draw_command)
+{
+	size_t id = get_global_id(0);
+
+	if (is_visible[id])
+		indices[visible_rank[id]] = get_particle(order, is_ordered, id);
+	if (id == n_particles - 1)
+		draw_command[0] = visible_rank[id] + is_visible[id];
+}
@@ -0,0 +1,271 @@
+/*
+	Uniform grid for the interacting modes, appended to kernel.cl.
+	Cells are cell_size wide, one interaction radius, and hashed into n_buckets buckets (a power of two),
+	so the grid is unbounded. Every step:
+		count_cells			bucket of every particle, and its rank within the bucket
+		(prefix sum)		bucket counts to bucket starts, see scan.cl
+		scatter_particles	copies of position and velocity in bucket order, neighbours are contiguous
+		compute_density		SPH only, density of every sorted particle
+		interact			forces from the 27 surrounding cells, then integration
+	Neighbour search is O(n) per step as long as cells hold a bounded number of particles.
+*/
+# define	HASH_X					73856093
+# define	HASH_Y					19349663
+# define	HASH_Z					83492791
+
+# define	FLOOR_DEPTH				1.0f			// below the generator, collision and SPH particles bounce off it
+
+static int4 get_cell(float4 position, float cell_size)
+{
+	return (int4)(convert_int3_sat_rtn(position.xyz / cell_size), 0);
+}
+
+static uint hash_cell(int4 cell, uint n_buckets)
+{
+	return (((uint)cell.x * HASH_X) ^ ((uint)cell.y * HASH_Y) ^ ((uint)cell.z * HASH_Z)) & (n_buckets - 1);
+}
+
+/*
+	SPH smoothing kernel (1 - q^2)^3, with q = distance / cell_size
+*/
+static float get_sph_weight(float distance_squared, float cell_size_squared)
+{
+	float x = 1.0f - distance_squared / cell_size_squared;
+
+	return x * x * x;
+}
+
+# define	SPH_REST_DENSITY		4.0f
+# define	SPH_STIFFNESS			0.5f
+
+static float get_sph_pressure(float density)
+{
+	return SPH_STIFFNESS * max(density - SPH_REST_DENSITY, 0.0f);
+}
+
+__kernel void count_cells(
+	PARTICLE_BUFFERS,
+	float cell_size,
+	uint n_buckets,
+	__global uint* particle_bucket,
+	__global uint* particle_rank,
+	__global uint* bucket_counts)
+{
+	size_t id = get_global_id(0);
+	uint bucket = hash_cell(get_cell(LOAD_POSITION(id), cell_size), n_buckets);
+
+	particle_bucket[id] = bucket;
+	particle_rank[id] = atomic_inc(&bucket_counts[bucket]);
+}
+
+__kernel void scatter_particles(
+	PARTICLE_BUFFERS,
+	__global const uint* particle_bucket,
+	__global const uint* particle_rank,
+	__global const uint* bucket_starts,
+	__global float4* sorted_position,
+	__global float4* sorted_velocity)
+{
+	size_t id = get_global_id(0);
+	uint slot = bucket_starts[particle_bucket[id]] + particle_rank[id];
+
+	sorted_position[slot] = LOAD_POSITION(id);
+	sorted_velocity[slot] = LOAD_VELOCITY(id);
+}
+
+/*
+	Visit every sorted particle within cell_size of p, other than the one in slot self.
+	Buckets shared with other cells are filtered out by cell, so each neighbour is seen once.
+*/
+# define	FOR_EACH_NEIGHBOUR(p, self, j, offset, distance_squared)										\
+	int4 cell_ = get_cell((p), cell_size);																\
+	for (int dz_ = -1; dz_ <= 1; dz_++)																	\
+	for (int dy_ = -1; dy_ <= 1; dy_++)																	\
+	for (int dx_ = -1; dx_ <= 1; dx_++)																	\
+	{																									\
+		int4 neighbour_cell_ = cell_ + (int4)(dx_, dy_, dz_, 0);										\
+		uint bucket_ = hash_cell(neighbour_cell_, n_buckets);											\
+		uint start_ = bucket_starts[bucket_];															\
+		uint end_ = start_ + bucket_counts[bucket_];													\
+																										\
+		for (uint j = start_; j < end_; j++)															\
+		{																								\
+			float4 offset = (p) - sorted_position[j];													\
+			float distance_squared;																		\
+																										\
+			offset.w = 0.0f;																			\
+			distance_squared = dot(offset, offset);														\
+			if (j == (self) || distance_squared >= cell_size * cell_size ||								\
+				any(get_cell(sorted_position[j], cell_size) != neighbour_cell_))						\
+				continue;
+# define	END_FOR_EACH_NEIGHBOUR																		\
+		}																								\
+	}
+
+__kernel void compute_density(
+	float cell_size,
+	uint n_buckets,
+	__global const uint* bucket_starts,
+	__global const uint* bucket_counts,
+	__global const float4* sorted_position,
+	__global float* sorted_density)
+{
+	size_t slot = get_global_id(0);
+	float4 p = sorted_position[slot];
+	float density = 1.0f;
+
+	FOR_EACH_NEIGHBOUR(p, slot, j, offset, distance_squared)
+		density += get_sph_weight(distance_squared, cell_size * cell_size);
+	END_FOR_EACH_NEIGHBOUR
+
+	sorted_density[slot] = density;
+}
+
+/*
+	One substep of an interacting mode, like update() but with forces from the neighbours
+*/
+__kernel void interact(
+	PARTICLE_BUFFERS,
+	PREVIOUS_BUFFER,
+	uint frame,
+	uint random_seed,
+	float dt,
+	uint substep,
+	float4 generator_position,
+	int spawn_in_cube,
+	int is_decaying,
+	int is_gravity_on,
+	int particle_mode_id,
+	int color_profile_id,
+	float cell_size,
+	uint n_buckets,
+	__global const uint* particle_bucket,
+	__global const uint* particle_rank,
+	__global const uint* bucket_starts,
+	__global const uint* bucket_counts,
+	__global const float4* sorted_position,
+	__global const float4* sorted_velocity,
+	__global const float* sorted_density)
+{
+	size_t id = get_global_id(0);
+	uint self = bucket_starts[particle_bucket[id]] + particle_rank[id];
+	float time_scale = dt * REFERENCE_RATE;
+	float life = LOAD_LIFETIME(id);
+	float4 p = sorted_position[self];
+	float4 v = sorted_velocity[self];
+
+	STORE_PREVIOUS(id, p);
+	if (IS_DECAYING)
+		life -= 0.01f * time_scale;
+
+	if (life <= 0.0f)
+	{
+		rng_t rng = rng_init(id, frame, substep, random_seed);
+		float4 c;
+
+		init_particle(&p, &c, &v, &rng, generator_position, (bool)SPAWN_IN_CUBE, PARTICLE_MODE_ID, COLOR_PROFILE_ID);
+		STORE_LIFETIME(id, 1.0f);
+		STORE_POSITION(id, p);
+		STORE_COLOR(id, c);
+		STORE_VELOCITY(id, v);
+		STORE_PREVIOUS(id, p);
+		return;
+	}
+
+	float4 force = (float4)(0.0f);
+	float4 viscosity = (float4)(0.0f);
+	float4 separation = (float4)(0.0f);
+	float4 velocity_sum = (float4)(0.0f);
+	float4 position_sum = (float4)(0.0f);
+	float n_neighbours = 0.0f;
+	float pressure = PARTICLE_MODE_ID == PARTICLE_SPH_FLUID ? get_sph_pressure(sorted_density[self]) : 0.0f;
+
+	FOR_EACH_NEIGHBOUR(p, self, j, offset, distance_squared)
+		float distance = sqrt(distance_squared);
+		float q = distance / cell_size;
+		float4 direction = distance > 0.0f ? offset / distance : (float4)(0.0f);
+
+		switch (PARTICLE_MODE_ID)
+		{
+			case PARTICLE_SOFT_COLLISION:
+			{
+				force += direction * (1.0f - q);
+				break;
+			}
+			case PARTICLE_SPH_FLUID:
+			{
+				float density = sorted_density[j];
+
+				force += direction * ((pressure + get_sph_pressure(density)) / (2.0f * density) * (1.0f - q) * (1.0f - q));
+				viscosity += (sorted_velocity[j] - v) * ((1.0f - q) / density);
+				break;
+			}
+			case PARTICLE_FLOCKING:
+			{
+				if (q < 0.5f)
+					separation += direction * (0.5f - q);
+				velocity_sum += sorted_velocity[j];
+				position_sum += sorted_position[j];
+				n_neighbours += 1.0f;
+				break;
+			}
+		}
+	END_FOR_EACH_NEIGHBOUR
+
+	switch (PARTICLE_MODE_ID)
+	{
+		case PARTICLE_SOFT_COLLISION:
+		{
+			v += force * (0.002f * time_scale);
+			break;
+		}
+		case PARTICLE_SPH_FLUID:
+		{
+			v += (force * 0.002f + viscosity * 0.02f) * time_scale;
+			break;
+		}
+		case PARTICLE_FLOCKING:
+		{
+			v += separation * (0.01f * time_scale);
+			if (n_neighbours > 0.0f)
+			{
+				v += (velocity_sum / n_neighbours - v) * (0.05f * time_scale);
+				v += (position_sum / n_neighbours - p) * (0.002f * time_scale);
+			}
+			break;
+		}
+	}
+	v.w = 0.0f;
+
+	// Gravity pulls down, otherwise the generator pulls everything in
+	if (IS_GRAVITY_ON)
+		v.y -= (PARTICLE_MODE_ID == PARTICLE_FLOCKING ? 0.0005f : 0.001f) * time_scale;
+	else
+		v += get_direction(p, generator_position) * (0.0002f * time_scale);
+
+	float speed = length(v.xyz);
+	if (PARTICLE_MODE_ID == PARTICLE_FLOCKING)
+	{
+		// Boids keep flying, within a speed range
+		if (speed > 0.0f)
+			v *= clamp(speed, 0.002f, 0.01f) / speed;
+	}
+	else
+	{
+		v *= max(1.0f - 0.01f * time_scale, 0.0f);
+		if (speed > 0.05f)
+			v *= 0.05f / speed;
+	}
+
+	p += v * time_scale;
+	if (PARTICLE_MODE_ID != PARTICLE_FLOCKING && p.y < generator_position.y - FLOOR_DEPTH)
+	{
+		p.y = generator_position.y - FLOOR_DEPTH;
+		v.y = -0.5f * v.y;
+	}
+
+	if (IS_DECAYING)
+		STORE_LIFETIME(id, life);
+	STORE_POSITION(id, p);
+	STORE_VELOCITY(id, v);
+}
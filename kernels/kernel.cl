@@ -1,28 +1,86 @@
 /*
-	Return a random unsigned long
+	Counter-based random numbers (Philox4x32-10), kept entirely in registers.
+	The stream of a particle is keyed by the global random seed, and addressed by
+	(particle id, frame, block, substep), so no per-particle state has to live in global memory.
 */
-static ulong rand_ulong(__global ulong* seed)
+# define	PHILOX_M0				0xD2511F53
+# define	PHILOX_M1				0xCD9E8D57
+# define	PHILOX_W0				0x9E3779B9
+# define	PHILOX_W1				0xBB67AE85
+# define	PHILOX_KEY_HI			0x5851F42D
+
+typedef struct
+{
+	uint4	counter;
+	uint2	key;
+	uint4	output;			// unused numbers of the last block, consumed from .x
+	uint	n_available;
+}	rng_t;
+
+static uint4 philox_round(uint4 counter, uint2 key)
+{
+	ulong product0 = (ulong)PHILOX_M0 * counter.x;
+	ulong product1 = (ulong)PHILOX_M1 * counter.z;
+
+	return (uint4)(
+		(uint)(product1 >> 32) ^ counter.y ^ key.x, (uint)product1,
+		(uint)(product0 >> 32) ^ counter.w ^ key.y, (uint)product0);
+}
+
+static uint4 philox4x32_10(uint4 counter, uint2 key)
+{
+	#pragma unroll
+	for (int i = 0; i < 10; i++)
+	{
+		counter = philox_round(counter, key);
+		key += (uint2)(PHILOX_W0, PHILOX_W1);
+	}
+	return counter;
+}
+
+static rng_t rng_init(uint id, uint frame, uint substep, uint random_seed)
+{
+	rng_t rng;
+
+	rng.counter = (uint4)(id, frame, 0, substep);
+	rng.key = (uint2)(random_seed, PHILOX_KEY_HI);
+	rng.n_available = 0;
+	return rng;
+}
+
+/*
+	Return a random unsigned int
+*/
+static uint rand_uint(rng_t* rng)
 {
-	ulong value = *seed * 1103515245 + 12345;
+	uint value;
 
-	*seed = value;
+	if (rng->n_available == 0)
+	{
+		rng->output = philox4x32_10(rng->counter, rng->key);
+		rng->counter.z++;
+		rng->n_available = 4;
+	}
+	value = rng->output.x;
+	rng->output = rng->output.yzwx;
+	rng->n_available--;
 	return value;
 }
 
 /*
 	Return a random float in range [0, 1]
 */
-static float rand_float(__global ulong* seed)
+static float rand_float(rng_t* rng)
 {
-	return (float)rand_ulong(seed) / ULONG_MAX;
+	return (float)rand_uint(rng) / UINT_MAX;
 }
 
 /*
 	Return a random float in range [a, b]
 */
-static float rand_float_in_range(global ulong* seed, float a, float b)
+static float rand_float_in_range(rng_t* rng, float a, float b)
 {
-	float	x = rand_float(seed);
+	float	x = rand_float(rng);
 
 	return (b - a) * x + a;
 }
@@ -31,37 +89,43 @@ static float rand_float_in_range(global ulong* seed, float a, float b)
 	Get random position in a cube of length 1 at origin
 */
 static float4 get_position_in_cube(
-	__global ulong* seed)
+	rng_t* rng)
 {
 	float4 position;
 
-	position.x = rand_float_in_range(seed, -0.5f, 0.5f);
-	position.y = rand_float_in_range(seed, -0.5f, 0.5f);
-	position.z = rand_float_in_range(seed, -0.5f, 0.5f);
+	position.x = rand_float_in_range(rng, -0.5f, 0.5f);
+	position.y = rand_float_in_range(rng, -0.5f, 0.5f);
+	position.z = rand_float_in_range(rng, -0.5f, 0.5f);
+	position.w = 0.0f;
 	return position;
 }
 
 /*
-	Get random position in a sphere of radius 0.5 at origin
+	Get random position in a sphere of radius 0.5 at origin.
+	Uniform in radius, denser at the center, or with fill_volume uniform through the volume
 */
 static float4 get_position_in_sphere(
-	__global ulong* seed)
+	rng_t* rng,
+	bool fill_volume)
 {
-	float4 position = get_position_in_cube(seed);
-	float radius = rand_float_in_range(seed, 0.0f, 0.5f);
+	float4 position = get_position_in_cube(rng);
+	float radius = rand_float_in_range(rng, 0.0f, 0.5f);
 
+	if (fill_volume)
+		radius = 0.5f * cbrt(2.0f * radius);
 	return (float4)(normalize(position.xyz), 0.0f) * radius;
 }
 
 static float4 get_position(
-	__global ulong* seed,
+	rng_t* rng,
 	float4 generator_position,
-	bool spawn_in_cube)
+	bool spawn_in_cube,
+	bool fill_volume)
 {
 	if (spawn_in_cube)
-		return generator_position + get_position_in_cube(seed);
+		return generator_position + get_position_in_cube(rng);
 	else
-		return generator_position + get_position_in_sphere(seed);
+		return generator_position + get_position_in_sphere(rng, fill_volume);
 }
 
 static float4 get_direction(float4 source, float4 destination)
@@ -82,7 +146,7 @@ static float4 get_direction(float4 source, float4 destination)
 # define	COLOR_RAINBOW_DASH		4
 
 static float4 get_color(
-	__global ulong* seed,
+	rng_t* rng,
 	int color_profile_id)
 {
 	const float4 RW_TABLE[] =
@@ -117,18 +181,19 @@ static float4 get_color(
 			color = (float4)(0.0f, 1.0f, 0.0f, 0.0f);				// Green
 			break;
 		case COLOR_RED_AND_WHITE:
-			color = RW_TABLE[rand_ulong(seed) % 2];
+			color = RW_TABLE[rand_uint(rng) % 2];
 			break;
 		case COLOR_CMY:
-			color = CMY_TABLE[rand_ulong(seed) % 3];
+			color = CMY_TABLE[rand_uint(rng) % 3];
 			break;
 		case COLOR_RAINBOW_DASH:
-			color = RAINBOW_TABLE[rand_ulong(seed) % 7];
+			color = RAINBOW_TABLE[rand_uint(rng) % 7];
 			break;
 		default:
-			color.x = rand_float(seed);
-			color.y = rand_float(seed);
-			color.z = rand_float(seed);
+			color.x = rand_float(rng);
+			color.y = rand_float(rng);
+			color.z = rand_float(rng);
+			color.w = 0.0f;
 			break;
 	}
 	return color;
@@ -143,56 +208,117 @@ static float4 get_color(
 # define	PARTICLE_RADIAL_EXPLOSION		3
 # define	PARTICLE_CHAOS_NOVA				4
 # define	PARTICLE_VORTEX_ATTRACTOR		5
+# define	PARTICLE_SOFT_COLLISION			6
+# define	PARTICLE_SPH_FLUID				7
+# define	PARTICLE_FLOCKING				8
+# define	PARTICLE_NBODY					9
+# define	PARTICLE_FIRST_CUSTOM			10		// modes registered in custom_modes.py, stepped by update
+
+# define	NBODY_INITIAL_SPEED		0.02f			// orbital speed N-body particles spawn with, around the y axis
+
+/*
+	Interacting modes see their neighbours through the uniform grid in grid.cl,
+	and are stepped by its interact kernel instead of update
+*/
+static bool mode_interacts(int particle_mode_id)
+{
+	return particle_mode_id >= PARTICLE_SOFT_COLLISION && particle_mode_id <= PARTICLE_FLOCKING;
+}
+
+static bool mode_uses_velocity(int particle_mode_id)
+{
+	return particle_mode_id == PARTICLE_GRAVITY_FOUNTAIN || particle_mode_id == PARTICLE_VORTEX_ATTRACTOR ||
+		mode_interacts(particle_mode_id) || particle_mode_id >= PARTICLE_NBODY;
+}
+
+/*
+	Emitter table, like EMITTER_DTYPE in emitters.py. Every particle belongs to one emitter,
+	update, init and change_color read its spawn position, mode, color profile and lifetime from the table.
+	Emitters own contiguous particle ranges from first, and respawn n_emit particles per dispatch when emitting.
+*/
+typedef struct
+{
+	float4	position;
+	int		particle_mode_id;
+	int		color_profile_id;
+	int		spawn_in_cube;
+	float	decay;					// lifetime lost per second
+	float	rate;					// particles per second
+	uint	first;
+	uint	n_emit;
+	uint	padding;
+}	emitter_t;
+
+/*
+	All the motion constants were tuned per frame at REFERENCE_RATE Hz,
+	time_scale is the length of a simulation step in those frames
+*/
+# define	REFERENCE_RATE			60.0f
+
+/*
+	Custom modes, their custom_update_<id>() and custom_init_<id>() functions
+	and the switch cases calling them, generated by custom_modes.py
+*/
+/* CUSTOM MODES */
+# ifndef CUSTOM_UPDATE_CASES
+#  define	CUSTOM_UPDATE_CASES
+#  define	CUSTOM_INIT_CASES
+# endif
 
 static void update_particle(
 	int particle_mode_id,
-	__global float4* position,
-	__global float4* velocity,
-	__global ulong* seed,
+	float4* position,
+	float4* velocity,
+	rng_t* rng,
 	float4 generator_position,
-	bool is_gravity_on)
+	bool is_gravity_on,
+	float time_scale)
 {
 	switch (particle_mode_id)
 	{
 		case PARTICLE_FALLING_DOWN:
 		{
-			position->y += is_gravity_on ? 0.02f : -0.02f;
+			position->y += (is_gravity_on ? 0.02f : -0.02f) * time_scale;
 			break;
 		}
 		case PARTICLE_GRAVITY_FOUNTAIN:
 		{
-			velocity->y += is_gravity_on ? 0.001f : -0.001f;
-			*position += *velocity;
+			velocity->y += (is_gravity_on ? 0.001f : -0.001f) * time_scale;
+			*position += *velocity * time_scale;
 			break;
 		}
 		case PARTICLE_RADIAL_EXPLOSION:
 		{
 			float4 direction = get_direction(generator_position, *position) * 0.01f;
 			
-			*position += direction;
+			*position += direction * time_scale;
 			if (is_gravity_on)
-				position->y += -0.02f;
+				position->y += -0.02f * time_scale;
 			break;
 		}
 		case PARTICLE_CHAOS_NOVA:
 		{
-			position->x += rand_float_in_range(seed, -0.1f, 0.1f);
-			position->y += rand_float_in_range(seed, -0.1f, 0.1f);
-			position->z += rand_float_in_range(seed, -0.1f, 0.1f);
+			// Random walk, so the jitter grows with the square root of time
+			float jitter = sqrt(time_scale);
+
+			position->x += rand_float_in_range(rng, -0.1f, 0.1f) * jitter;
+			position->y += rand_float_in_range(rng, -0.1f, 0.1f) * jitter;
+			position->z += rand_float_in_range(rng, -0.1f, 0.1f) * jitter;
 			if (is_gravity_on)
-				position->y += -0.02f;
+				position->y += -0.02f * time_scale;
 			break;
 		}
 		case PARTICLE_VORTEX_ATTRACTOR:
 		{
 			float4 direction = get_direction(*position, generator_position) * 0.001f;
 
-			*velocity += direction;
-			*position += *velocity;
+			*velocity += direction * time_scale;
+			*position += *velocity * time_scale;
 			if (is_gravity_on)
-				position->y += -0.02f;
+				position->y += -0.02f * time_scale;
 			break;
 		}
+		CUSTOM_UPDATE_CASES
 		default:
 		{
 			break;
@@ -201,17 +327,18 @@ static void update_particle(
 }
 
 static void init_particle(
-	__global float4* position,
-	__global float4* color,
-	__global float4* velocity,
-	__global ulong* seed,
+	float4* position,
+	float4* color,
+	float4* velocity,
+	rng_t* rng,
 	float4 generator_position,
 	bool spawn_in_cube,
 	int particle_mode_id,
 	int color_profile_id)
 {
-	*position = get_position(seed, generator_position, spawn_in_cube);
-	*color = get_color(seed, color_profile_id);
+	// Interacting modes fill the sphere evenly, the dense center would put hundreds of particles in a cell
+	*position = get_position(rng, generator_position, spawn_in_cube, mode_interacts(particle_mode_id));
+	*color = get_color(rng, color_profile_id);
 	*velocity = (float4)(0.0, 0.0, 0.0, 0.0);
 
 	switch (particle_mode_id)
@@ -224,6 +351,21 @@ static void init_particle(
 			*velocity = direction;
 			break;
 		}
+		case PARTICLE_FLOCKING:
+		{
+			*velocity = get_direction(generator_position, *position) * 0.005f;
+			break;
+		}
+		case PARTICLE_NBODY:
+		{
+			// Orbit the y axis through the generator
+			float4 tangent = cross((float4)(0.0f, 1.0f, 0.0f, 0.0f), *position - generator_position);
+			float tangent_length = length(tangent);
+
+			*velocity = tangent_length > 0.0f ? tangent * (NBODY_INITIAL_SPEED / tangent_length) : (float4)(0.0f);
+			break;
+		}
+		CUSTOM_INIT_CASES
 		default:
 		{
 			break;
@@ -231,61 +373,257 @@ static void init_particle(
 	}
 }
 
+/*
+	Particle buffer layout
+	Default: float4 position, float4 color, float lifetime and float4 velocity buffers (52 bytes).
+	COMPACT_LAYOUT: one interleaved vertex of 5 floats { position.xyz, lifetime, RGBA8 color }
+	and a half4 velocity buffer (28 bytes).
+*/
+# define	VERTEX_FLOATS			5
+
+static uint pack_color(float4 color)
+{
+	return as_uint(convert_uchar4_sat_rte(color * 255.0f));
+}
+
+# ifdef COMPACT_LAYOUT
+#  define	PARTICLE_BUFFERS		__global float* vertex, __global half* velocity
+#  define	COLOR_BUFFER			__global float* vertex
+#  define	LOAD_POSITION(id)		((float4)(vload3(0, &vertex[(id) * VERTEX_FLOATS]), 1.0f))
+#  define	STORE_POSITION(id, p)	vstore3((p).xyz, 0, &vertex[(id) * VERTEX_FLOATS])
+#  define	LOAD_LIFETIME(id)		(vertex[(id) * VERTEX_FLOATS + 3])
+#  define	STORE_LIFETIME(id, l)	(vertex[(id) * VERTEX_FLOATS + 3] = (l))
+#  define	STORE_COLOR(id, c)		(vertex[(id) * VERTEX_FLOATS + 4] = as_float(pack_color(c)))
+#  define	LOAD_VELOCITY(id)		vload_half4((id), velocity)
+#  define	STORE_VELOCITY(id, v)	vstore_half4((v), (id), velocity)
+# else
+#  define	PARTICLE_BUFFERS		__global float4* position, __global float4* color, __global float* lifetime, __global float4* velocity
+#  define	COLOR_BUFFER			__global float4* color
+#  define	LOAD_POSITION(id)		(position[(id)])
+#  define	STORE_POSITION(id, p)	(position[(id)] = (p))
+#  define	LOAD_LIFETIME(id)		(lifetime[(id)])
+#  define	STORE_LIFETIME(id, l)	(lifetime[(id)] = (l))
+#  define	STORE_COLOR(id, c)		(color[(id)] = (c))
+#  define	LOAD_VELOCITY(id)		(velocity[(id)])
+#  define	STORE_VELOCITY(id, v)	(velocity[(id)] = (v))
+# endif
+
+/*
+	INTERPOLATE: update also writes the position before its last substep, as packed float3,
+	so the renderer can blend between the last two simulation steps
+*/
+# ifdef INTERPOLATE
+#  define	PREVIOUS_BUFFER			__global float* previous_position
+#  define	STORE_PREVIOUS(id, p)	vstore3((p).xyz, (id), previous_position)
+# else
+#  define	PREVIOUS_BUFFER			__global float* unused_previous_position
+#  define	STORE_PREVIOUS(id, p)
+# endif
+
+/*
+	EMISSION: particles that die stay dead, update only respawns the dead ones ranked by pool.cl
+	below their emitter's n_emit, and init starts every particle dead. Otherwise every particle respawns when it dies.
+*/
+# ifdef EMISSION
+#  define	EMISSION_BUFFER			__global const uint* dead_rank
+#  define	IS_EMITTED(id, life)	((life) <= 0.0f && dead_rank[(id)] - dead_rank[emitter.first] < emitter.n_emit)
+#  define	RESPAWNS_AGAIN			false
+#  define	INITIAL_LIFETIME(l)		((void)(l), 0.0f)	// l still draws, like the NumPy backend
+# else
+#  define	EMISSION_BUFFER			__global const uint* unused_dead_rank
+#  define	IS_EMITTED(id, life)	true
+#  define	RESPAWNS_AGAIN			true
+#  define	INITIAL_LIFETIME(l)		(l)
+# endif
+
+/*
+	FORCE_FIELD: live particles also drift along a precomputed velocity field (force_field.py), a float4 volume
+	sampled with hardware trilinear filtering. The field repeats every 1 / force_field_params.y world units,
+	force_field_params.x is the displacement per REFERENCE_RATE frame at unit field magnitude.
+*/
+# ifdef FORCE_FIELD
+#  define	FORCE_FIELD_ARGS		__read_only image3d_t force_field, float4 force_field_params
+#  define	ADVECT(p, time_scale)	advect(force_field, force_field_params, (p), (time_scale))
+#  define	IS_ADVECTED				true
+
+__constant sampler_t force_field_sampler = CLK_NORMALIZED_COORDS_TRUE | CLK_ADDRESS_REPEAT | CLK_FILTER_LINEAR;
+
+static void advect(__read_only image3d_t field, float4 params, float4* position, float time_scale)
+{
+	float4 force = read_imagef(field, force_field_sampler, (float4)(position->xyz * params.y, 0.0f));
+
+	position->xyz += params.x * force.xyz * time_scale;
+}
+# else
+#  define	FORCE_FIELD_ARGS		__global const float* unused_force_field, float4 force_field_params
+#  define	ADVECT(p, time_scale)
+#  define	IS_ADVECTED				false
+# endif
+
+/*
+	TRAILS: update also writes every particle's position, and lifetime as w, into one slot of a ring of
+	past positions, at trail_offset = slot * n_particles. Slot-major, so the writes of a dispatch are contiguous.
+*/
+# ifdef TRAILS
+#  define	TRAIL_BUFFER			__global float4* trail
+#  define	STORE_TRAIL(id, p, l)	(trail[trail_offset + (id)] = (float4)((p).xyz, (l)))
+# else
+#  define	TRAIL_BUFFER			__global float4* unused_trail
+#  define	STORE_TRAIL(id, p, l)
+# endif
+
+/*
+	Specialized variants are built with -D FIXED_<NAME>=<value>, which replaces the
+	matching kernel argument with a constant so the compiler removes the dead branches
+*/
+# ifdef FIXED_PARTICLE_MODE
+#  define	PARTICLE_MODE_ID		FIXED_PARTICLE_MODE
+# else
+#  define	PARTICLE_MODE_ID		particle_mode_id
+# endif
+
+# ifdef FIXED_COLOR_PROFILE
+#  define	COLOR_PROFILE_ID		FIXED_COLOR_PROFILE
+# else
+#  define	COLOR_PROFILE_ID		color_profile_id
+# endif
+
+# ifdef FIXED_SPAWN_IN_CUBE
+#  define	SPAWN_IN_CUBE			FIXED_SPAWN_IN_CUBE
+# else
+#  define	SPAWN_IN_CUBE			spawn_in_cube
+# endif
+
+# ifdef FIXED_IS_DECAYING
+#  define	IS_DECAYING				FIXED_IS_DECAYING
+# else
+#  define	IS_DECAYING				is_decaying
+# endif
+
+# ifdef FIXED_IS_GRAVITY_ON
+#  define	IS_GRAVITY_ON			FIXED_IS_GRAVITY_ON
+# else
+#  define	IS_GRAVITY_ON			is_gravity_on
+# endif
+
+/*
+	Advance n_substeps simulation steps of dt seconds each, in a single dispatch
+*/
 __kernel void update(
-	__global float4* position,
-	__global float4* color,
-	__global float* lifetime,
-	__global float4* velocity,
-	__global ulong* seed,
-	float4 generator_position,
-	int spawn_in_cube,
+	PARTICLE_BUFFERS,
+	PREVIOUS_BUFFER,
+	EMISSION_BUFFER,
+	__global const uchar* emitter_index,
+	__global const emitter_t* emitters,
+	uint frame,
+	uint random_seed,
+	float dt,
+	int n_substeps,
 	int is_decaying,
 	int is_gravity_on,
-	int particle_mode_id,
-	int color_profile_id)
+	FORCE_FIELD_ARGS,
+	TRAIL_BUFFER,
+	uint trail_offset)
 {
+	// Partitioned dispatches run over a sub-buffer from a global offset,
+	// particles draw random numbers by global id and are stored at their index in the sub-buffer
 	size_t id = get_global_id(0);
+	size_t index = id - get_global_offset(0);
+	emitter_t emitter = emitters[emitter_index[index]];
+	int particle_mode_id = emitter.particle_mode_id;
+	int color_profile_id = emitter.color_profile_id;
+	int spawn_in_cube = emitter.spawn_in_cube;
+	bool uses_velocity = mode_uses_velocity(PARTICLE_MODE_ID);
+	bool is_respawned = false;
+	float life = LOAD_LIFETIME(index);
+	float4 p = LOAD_POSITION(index);
+	float4 v = uses_velocity ? LOAD_VELOCITY(index) : (float4)(0.0f);
+	float4 previous = p;
+	float4 c;
+	float time_scale = dt * REFERENCE_RATE;
+	bool can_respawn = IS_EMITTED(index, life);
 
-	if (is_decaying)
-		lifetime[id] -= 0.01f;
-
-	if (lifetime[id] > 0.0f)
-	{
-		update_particle(particle_mode_id, &position[id], &velocity[id], &seed[id], generator_position, (bool)is_gravity_on);
-	}
-	else
+	for (int substep = 0; substep < n_substeps; substep++)
 	{
-		lifetime[id] = 1.0f;
-		init_particle(&position[id], &color[id], &velocity[id], &seed[id], generator_position, (bool)spawn_in_cube, particle_mode_id, color_profile_id);
+		rng_t rng = rng_init(id, frame, substep, random_seed);
+
+		previous = p;
+		if (IS_DECAYING)
+			life -= emitter.decay * dt;
+
+		if (life > 0.0f)
+		{
+			update_particle(PARTICLE_MODE_ID, &p, &v, &rng, emitter.position, (bool)IS_GRAVITY_ON, time_scale);
+			ADVECT(&p, time_scale);
+		}
+		else if (can_respawn)
+		{
+			life = 1.0f;
+			init_particle(&p, &c, &v, &rng, emitter.position, (bool)SPAWN_IN_CUBE, PARTICLE_MODE_ID, COLOR_PROFILE_ID);
+			previous = p;
+			is_respawned = true;
+			can_respawn = RESPAWNS_AGAIN;
+		}
 	}
+
+	// Only touch the fields that actually changed
+	if (IS_DECAYING || is_respawned)
+		STORE_LIFETIME(index, life);
+	if (PARTICLE_MODE_ID != PARTICLE_STATIONARY || IS_ADVECTED || is_respawned)
+		STORE_POSITION(index, p);
+	if (uses_velocity || is_respawned)
+		STORE_VELOCITY(index, v);
+	if (is_respawned)
+		STORE_COLOR(index, c);
+	STORE_PREVIOUS(index, previous);
+	STORE_TRAIL(index, p, life);
 }
 
 __kernel void init(
-	__global float4* position,
-	__global float4* color,
-	__global float* lifetime,
-	__global float4* velocity,
-	__global ulong* seed,
-	float4 generator_position,
-	int spawn_in_cube,
-	int particle_mode_id,
-	int color_profile_id)
+	PARTICLE_BUFFERS,
+	__global const uchar* emitter_index,
+	__global const emitter_t* emitters,
+	uint frame,
+	uint random_seed)
 {
 	size_t id = get_global_id(0);
+	size_t index = id - get_global_offset(0);
+	emitter_t emitter = emitters[emitter_index[index]];
+	int particle_mode_id = emitter.particle_mode_id;
+	int color_profile_id = emitter.color_profile_id;
+	int spawn_in_cube = emitter.spawn_in_cube;
+	rng_t rng = rng_init(id, frame, 0, random_seed);
+	float4 p, c, v;
+
+	STORE_LIFETIME(index, INITIAL_LIFETIME(rand_float(&rng)));
+	init_particle(&p, &c, &v, &rng, emitter.position, (bool)SPAWN_IN_CUBE, PARTICLE_MODE_ID, COLOR_PROFILE_ID);
+	STORE_POSITION(index, p);
+	STORE_COLOR(index, c);
+	STORE_VELOCITY(index, v);
+}
 
-	seed[id] = (ulong) id;
-	seed[id] = rand_ulong(&seed[id]);
+// The trail slot of modes stepped by other kernels than update
+__kernel void record_trail(
+	PARTICLE_BUFFERS,
+	TRAIL_BUFFER,
+	uint trail_offset)
+{
+	size_t index = get_global_id(0);
 
-	lifetime[id] = rand_float(&seed[id]);
-	init_particle(&position[id], &color[id], &velocity[id], &seed[id], generator_position, (bool)spawn_in_cube, particle_mode_id, color_profile_id);
+	STORE_TRAIL(index, LOAD_POSITION(index), LOAD_LIFETIME(index));
 }
 
 __kernel void change_color(
-	__global float4* color,
-	__global ulong* seed,
-	int color_profile_id)
+	COLOR_BUFFER,
+	__global const uchar* emitter_index,
+	__global const emitter_t* emitters,
+	uint frame,
+	uint random_seed)
 {
 	size_t id = get_global_id(0);
+	size_t index = id - get_global_offset(0);
+	int color_profile_id = emitters[emitter_index[index]].color_profile_id;
+	rng_t rng = rng_init(id, frame, 0, random_seed);
 
-	color[id] = get_color(&seed[id], color_profile_id);
+	STORE_COLOR(index, get_color(&rng, COLOR_PROFILE_ID));
 }
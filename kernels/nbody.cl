@@ -0,0 +1,284 @@
+/*
+	N-body gravity, appended to kernel.cl after grid.cl.
+	The first n_bodies particles are heavy bodies of equal mass, every particle is attracted by all of them.
+	Every substep:
+		gather_bodies			snapshot of body positions, mass in .w
+		nbody_tiled				direct sum, bodies staged through __local memory one work-group-sized tile at a time
+	or, with Barnes-Hut:
+		bin_bodies				octree leaf of every body, and its rank within the leaf
+		(prefix sum)			leaf counts to leaf starts, see scan.cl
+		scatter_bodies			bodies in leaf order
+		sum_leaves				mass and mass-weighted position of every leaf
+		sum_children			the same for every level above, one dispatch per level
+		nbody_barnes_hut		far nodes as a single body, near leaves body by body
+	then
+		integrate_nbody			velocity and position from the accelerations
+*/
+# define	NBODY_GM				0.0002f			// total mass of the bodies times G, per 1/60 s frame squared
+# define	NBODY_SOFTENING_SQUARED	0.0025f			// keeps close encounters finite
+
+/*
+	Fixed-depth octree over a cube of 2 * NBODY_EXTENT around the generator, nodes of a level in Morton order,
+	so the children of node k are nodes 8k to 8k + 7 of the next level. Bodies outside the cube go to its border leaves.
+*/
+# define	NBODY_TREE_DEPTH		5
+# define	NBODY_EXTENT			2.0f
+# define	NBODY_THETA				0.5f			// a node of width s at distance d is opened when s > theta * d
+# define	NBODY_STACK_SIZE		(7 * NBODY_TREE_DEPTH + 1)
+
+static float4 get_body_acceleration(float4 p, float4 body)
+{
+	float4 offset = body - p;
+	float inverse_distance;
+
+	offset.w = 0.0f;
+	inverse_distance = rsqrt(dot(offset, offset) + NBODY_SOFTENING_SQUARED);
+	return offset * (body.w * inverse_distance * inverse_distance * inverse_distance);
+}
+
+__kernel void gather_bodies(
+	PARTICLE_BUFFERS,
+	float body_mass,
+	__global float4* bodies)
+{
+	size_t id = get_global_id(0);
+	float4 p = LOAD_POSITION(id);
+
+	p.w = body_mass;
+	bodies[id] = p;
+}
+
+/*
+	Direct sum over all bodies. The global size is a multiple of the local size,
+	work-items past n_particles only help load tiles.
+*/
+__kernel void nbody_tiled(
+	PARTICLE_BUFFERS,
+	uint n_particles,
+	uint n_bodies,
+	__global const float4* bodies,
+	__global float4* accelerations,
+	__local float4* tile)
+{
+	size_t id = get_global_id(0);
+	uint lid = get_local_id(0);
+	uint tile_size = get_local_size(0);
+	float4 p = id < n_particles ? LOAD_POSITION(id) : (float4)(0.0f);
+	float4 acceleration = (float4)(0.0f);
+
+	for (uint base = 0; base < n_bodies; base += tile_size)
+	{
+		// Padding bodies have no mass
+		tile[lid] = base + lid < n_bodies ? bodies[base + lid] : (float4)(0.0f);
+		barrier(CLK_LOCAL_MEM_FENCE);
+
+		for (uint k = 0; k < tile_size; k++)
+			acceleration += get_body_acceleration(p, tile[k]);
+		barrier(CLK_LOCAL_MEM_FENCE);
+	}
+
+	if (id < n_particles)
+		accelerations[id] = acceleration * NBODY_GM;
+}
+
+static uint get_level_offset(uint level)
+{
+	return ((1u << (3 * level)) - 1) / 7;
+}
+
+static uint spread_bits(uint x)
+{
+	x = (x | (x << 16)) & 0x030000FF;
+	x = (x | (x << 8)) & 0x0300F00F;
+	x = (x | (x << 4)) & 0x030C30C3;
+	x = (x | (x << 2)) & 0x09249249;
+	return x;
+}
+
+static uint get_leaf(float4 p, float4 generator_position)
+{
+	float n_cells = (float)(1 << NBODY_TREE_DEPTH);
+	float4 cell = (p - generator_position + NBODY_EXTENT) * (n_cells / (2.0f * NBODY_EXTENT));
+	int4 clamped = clamp(convert_int4_rtn(cell), 0, (1 << NBODY_TREE_DEPTH) - 1);
+
+	return spread_bits(clamped.x) | (spread_bits(clamped.y) << 1) | (spread_bits(clamped.z) << 2);
+}
+
+__kernel void bin_bodies(
+	PARTICLE_BUFFERS,
+	float4 generator_position,
+	__global uint* body_leaf,
+	__global uint* body_rank,
+	__global uint* leaf_counts)
+{
+	size_t id = get_global_id(0);
+	uint leaf = get_leaf(LOAD_POSITION(id), generator_position);
+
+	body_leaf[id] = leaf;
+	body_rank[id] = atomic_inc(&leaf_counts[leaf]);
+}
+
+__kernel void scatter_bodies(
+	PARTICLE_BUFFERS,
+	float body_mass,
+	__global const uint* body_leaf,
+	__global const uint* body_rank,
+	__global const uint* leaf_starts,
+	__global float4* sorted_bodies)
+{
+	size_t id = get_global_id(0);
+	float4 p = LOAD_POSITION(id);
+
+	p.w = body_mass;
+	sorted_bodies[leaf_starts[body_leaf[id]] + body_rank[id]] = p;
+}
+
+/*
+	Nodes hold (mass-weighted position sum, mass), empty nodes are all zero
+*/
+__kernel void sum_leaves(
+	__global const uint* leaf_starts,
+	__global const uint* leaf_counts,
+	__global const float4* sorted_bodies,
+	__global float4* nodes)
+{
+	size_t leaf = get_global_id(0);
+	uint start = leaf_starts[leaf];
+	float4 sum = (float4)(0.0f);
+
+	for (uint j = start; j < start + leaf_counts[leaf]; j++)
+	{
+		float4 body = sorted_bodies[j];
+
+		sum += (float4)(body.xyz * body.w, body.w);
+	}
+	nodes[get_level_offset(NBODY_TREE_DEPTH) + leaf] = sum;
+}
+
+__kernel void sum_children(
+	uint level,
+	__global float4* nodes)
+{
+	size_t k = get_global_id(0);
+	__global const float4* children = &nodes[get_level_offset(level + 1) + 8 * k];
+	float4 sum = (float4)(0.0f);
+
+	for (int c = 0; c < 8; c++)
+		sum += children[c];
+	nodes[get_level_offset(level) + k] = sum;
+}
+
+__kernel void nbody_barnes_hut(
+	PARTICLE_BUFFERS,
+	__global const uint* leaf_starts,
+	__global const uint* leaf_counts,
+	__global const float4* sorted_bodies,
+	__global const float4* nodes,
+	__global float4* accelerations)
+{
+	size_t id = get_global_id(0);
+	float4 p = LOAD_POSITION(id);
+	float4 acceleration = (float4)(0.0f);
+	uint stack_level[NBODY_STACK_SIZE];
+	uint stack_node[NBODY_STACK_SIZE];
+	int n_stacked = 1;
+
+	stack_level[0] = 0;
+	stack_node[0] = 0;
+	while (n_stacked > 0)
+	{
+		n_stacked--;
+		uint level = stack_level[n_stacked];
+		uint k = stack_node[n_stacked];
+		float4 node = nodes[get_level_offset(level) + k];
+
+		if (node.w == 0.0f)
+			continue;
+
+		float4 center = (float4)(node.xyz / node.w, node.w);
+		float4 offset = center - p;
+		float width = 2.0f * NBODY_EXTENT / (float)(1 << level);
+
+		offset.w = 0.0f;
+		if (width * width < NBODY_THETA * NBODY_THETA * dot(offset, offset))
+		{
+			acceleration += get_body_acceleration(p, center);
+		}
+		else if (level == NBODY_TREE_DEPTH)
+		{
+			uint start = leaf_starts[k];
+
+			for (uint j = start; j < start + leaf_counts[k]; j++)
+				acceleration += get_body_acceleration(p, sorted_bodies[j]);
+		}
+		else
+		{
+			for (uint c = 0; c < 8; c++)
+			{
+				stack_level[n_stacked] = level + 1;
+				stack_node[n_stacked] = 8 * k + c;
+				n_stacked++;
+			}
+		}
+	}
+
+	accelerations[id] = acceleration * NBODY_GM;
+}
+
+/*
+	One substep of N-body motion from the accelerations of this substep
+*/
+__kernel void integrate_nbody(
+	PARTICLE_BUFFERS,
+	PREVIOUS_BUFFER,
+	uint frame,
+	uint random_seed,
+	float dt,
+	uint substep,
+	float4 generator_position,
+	int spawn_in_cube,
+	int is_decaying,
+	int is_gravity_on,
+	int particle_mode_id,
+	int color_profile_id,
+	__global const float4* accelerations)
+{
+	size_t id = get_global_id(0);
+	float time_scale = dt * REFERENCE_RATE;
+	float life = LOAD_LIFETIME(id);
+	float4 p = LOAD_POSITION(id);
+	float4 v = LOAD_VELOCITY(id);
+
+	STORE_PREVIOUS(id, p);
+	if (IS_DECAYING)
+		life -= 0.01f * time_scale;
+
+	if (life <= 0.0f)
+	{
+		rng_t rng = rng_init(id, frame, substep, random_seed);
+		float4 c;
+
+		init_particle(&p, &c, &v, &rng, generator_position, (bool)SPAWN_IN_CUBE, PARTICLE_MODE_ID, COLOR_PROFILE_ID);
+		STORE_LIFETIME(id, 1.0f);
+		STORE_POSITION(id, p);
+		STORE_COLOR(id, c);
+		STORE_VELOCITY(id, v);
+		STORE_PREVIOUS(id, p);
+		return;
+	}
+
+	v += accelerations[id] * time_scale;
+	if (IS_GRAVITY_ON)
+		v.y -= 0.001f * time_scale;
+	v.w = 0.0f;
+
+	float speed = length(v.xyz);
+	if (speed > 0.05f)
+		v *= 0.05f / speed;
+	p += v * time_scale;
+
+	if (IS_DECAYING)
+		STORE_LIFETIME(id, life);
+	STORE_POSITION(id, p);
+	STORE_VELOCITY(id, v);
+}
@@ -0,0 +1,30 @@
+/*
+	Particle pool with an emission rate, appended to kernel.cl.
+	Dead particles (lifetime <= 0) are ranked by an exclusive prefix sum of flag_dead, update respawns
+	those ranked below n_emit, and compact_live packs the indices of the live ones into the element buffer
+	of an indirect draw, whose count it writes to the first uint of draw_command.
+*/
+__kernel void flag_dead(
+	PARTICLE_BUFFERS,
+	__global uint* is_dead)
+{
+	size_t id = get_global_id(0);
+
+	is_dead[id] = LOAD_LIFETIME(id) <= 0.0f;
+}
+
+__kernel void compact_live(
+	uint n_particles,
+	__global const uint* is_dead,
+	__global const uint* dead_rank,
+	__global uint* live_indices,
+	__global uint* draw_command)
+{
+	size_t id = get_global_id(0);
+	uint n_dead_before = dead_rank[id];
+
+	if (!is_dead[id])
+		live_indices[id - n_dead_before] = id;
+	if (id == n_particles - 1)
+		draw_command[0] = n_particles - n_dead_before - is_dead[id];
+}
@@ -0,0 +1,69 @@
+/*
+	Exclusive prefix sum of uints (Blelloch), used to turn grid bucket counts into bucket starts.
+	Each work-group scans a block of 2 * local size elements in local memory and writes the block total,
+	the block totals are scanned the same way, then added back to every element of their block.
+*/
+__kernel void scan_blocks(
+	__global const uint* input,
+	__global uint* output,
+	__global uint* block_sums,
+	uint n,
+	__local uint* scratch)
+{
+	uint lid = get_local_id(0);
+	uint block_size = get_local_size(0) * 2;
+	uint base = get_group_id(0) * block_size;
+	uint offset = 1;
+
+	scratch[2 * lid] = base + 2 * lid < n ? input[base + 2 * lid] : 0;
+	scratch[2 * lid + 1] = base + 2 * lid + 1 < n ? input[base + 2 * lid + 1] : 0;
+
+	// Up-sweep, partial sums in place
+	for (uint d = block_size >> 1; d > 0; d >>= 1)
+	{
+		barrier(CLK_LOCAL_MEM_FENCE);
+		if (lid < d)
+			scratch[offset * (2 * lid + 2) - 1] += scratch[offset * (2 * lid + 1) - 1];
+		offset <<= 1;
+	}
+
+	if (lid == 0)
+	{
+		block_sums[get_group_id(0)] = scratch[block_size - 1];
+		scratch[block_size - 1] = 0;
+	}
+
+	// Down-sweep
+	for (uint d = 1; d < block_size; d <<= 1)
+	{
+		offset >>= 1;
+		barrier(CLK_LOCAL_MEM_FENCE);
+		if (lid < d)
+		{
+			uint a = offset * (2 * lid + 1) - 1;
+			uint b = offset * (2 * lid + 2) - 1;
+			uint t = scratch[a];
+
+			scratch[a] = scratch[b];
+			scratch[b] += t;
+		}
+	}
+	barrier(CLK_LOCAL_MEM_FENCE);
+
+	if (base + 2 * lid < n)
+		output[base + 2 * lid] = scratch[2 * lid];
+	if (base + 2 * lid + 1 < n)
+		output[base + 2 * lid + 1] = scratch[2 * lid + 1];
+}
+
+__kernel void add_block_sums(
+	__global uint* output,
+	__global const uint* block_offsets,
+	uint n,
+	uint block_size)
+{
+	size_t id = get_global_id(0);
+
+	if (id < n)
+		output[id] += block_offsets[id / block_size];
+}
@@ -0,0 +1,186 @@
+/*
+	Back-to-front order of the particles for alpha blending, a bitonic sort of (depth key, index) pairs.
+	Keys are view-space z as order-preserving uints, so the farthest particles sort first. Dead particles
+	sort after every live one, and the padding up to a power of two after those.
+	Each work-group sorts or merges a block of 2 * local size pairs in local memory, merge steps wider
+	than a block go through global memory. Between full sorts, odd_even_pass swaps neighbours that fell
+	out of order, which is enough when the order only drifts a little from frame to frame.
+*/
+#define DEAD_KEY		0xFFFFFFFEu
+#define PADDING_KEY		0xFFFFFFFFu
+
+// View-space z, flipped into a uint that sorts like the float
+inline uint depth_key(
+	__global const float* positions,
+	__global const float* lifetimes,
+	uint stride,
+	uint lifetime_offset,
+	uint lifetime_stride,
+	float4 view_z,
+	uint index)
+{
+	if (lifetimes[index * lifetime_stride + lifetime_offset] <= 0.0f)
+		return DEAD_KEY;
+
+	__global const float* position = positions + index * stride;
+	float z = view_z.x * position[0] + view_z.y * position[1] + view_z.z * position[2] + view_z.w;
+	uint bits = as_uint(z);
+
+	return bits ^ ((bits >> 31) ? 0xFFFFFFFFu : 0x80000000u);
+}
+
+inline void compare_swap(__local uint* keys, __local uint* order, uint a, uint b, int ascending)
+{
+	if ((keys[a] > keys[b]) == ascending)
+	{
+		uint key = keys[a];
+		uint index = order[a];
+
+		keys[a] = keys[b];
+		order[a] = order[b];
+		keys[b] = key;
+		order[b] = index;
+	}
+}
+
+// Keys of every particle in index order, over the padded count
+__kernel void depth_keys(
+	__global const float* positions,
+	__global const float* lifetimes,
+	uint stride,
+	uint lifetime_offset,
+	uint lifetime_stride,
+	uint n_particles,
+	float4 view_z,
+	__global uint* keys,
+	__global uint* order)
+{
+	uint id = get_global_id(0);
+
+	keys[id] = id < n_particles ? depth_key(positions, lifetimes, stride, lifetime_offset, lifetime_stride, view_z, id) : PADDING_KEY;
+	order[id] = id;
+}
+
+// Keys of the particles in the last sorted order, for odd_even_pass
+__kernel void depth_keys_ordered(
+	__global const float* positions,
+	__global const float* lifetimes,
+	uint stride,
+	uint lifetime_offset,
+	uint lifetime_stride,
+	float4 view_z,
+	__global const uint* order,
+	__global uint* keys)
+{
+	uint id = get_global_id(0);
+
+	keys[id] = depth_key(positions, lifetimes, stride, lifetime_offset, lifetime_stride, view_z, order[id]);
+}
+
+// Sorts every block, ascending and descending in turn, so pairs of blocks form bitonic sequences
+__kernel void bitonic_sort_local(
+	__global uint* keys,
+	__global uint* order,
+	__local uint* local_keys,
+	__local uint* local_order)
+{
+	uint lid = get_local_id(0);
+	uint block_size = get_local_size(0) * 2;
+	uint base = get_group_id(0) * block_size;
+
+	local_keys[lid] = keys[base + lid];
+	local_order[lid] = order[base + lid];
+	local_keys[lid + block_size / 2] = keys[base + lid + block_size / 2];
+	local_order[lid + block_size / 2] = order[base + lid + block_size / 2];
+
+	for (uint k = 2; k <= block_size; k <<= 1)
+	{
+		for (uint j = k >> 1; j > 0; j >>= 1)
+		{
+			barrier(CLK_LOCAL_MEM_FENCE);
+			uint a = ((lid & ~(j - 1)) << 1) | (lid & (j - 1));
+			compare_swap(local_keys, local_order, a, a | j, ((base + a) & k) == 0);
+		}
+	}
+
+	barrier(CLK_LOCAL_MEM_FENCE);
+	keys[base + lid] = local_keys[lid];
+	order[base + lid] = local_order[lid];
+	keys[base + lid + block_size / 2] = local_keys[lid + block_size / 2];
+	order[base + lid + block_size / 2] = local_order[lid + block_size / 2];
+}
+
+// One merge step of stage k, with pairs j apart across blocks
+__kernel void bitonic_merge_global(
+	__global uint* keys,
+	__global uint* order,
+	uint k,
+	uint j)
+{
+	uint id = get_global_id(0);
+	uint a = ((id & ~(j - 1)) << 1) | (id & (j - 1));
+	uint b = a | j;
+
+	if ((keys[a] > keys[b]) == ((a & k) == 0))
+	{
+		uint key = keys[a];
+		uint index = order[a];
+
+		keys[a] = keys[b];
+		order[a] = order[b];
+		keys[b] = key;
+		order[b] = index;
+	}
+}
+
+// The merge steps of stage k that stay within a block
+__kernel void bitonic_merge_local(
+	__global uint* keys,
+	__global uint* order,
+	uint k,
+	__local uint* local_keys,
+	__local uint* local_order)
+{
+	uint lid = get_local_id(0);
+	uint block_size = get_local_size(0) * 2;
+	uint base = get_group_id(0) * block_size;
+
+	local_keys[lid] = keys[base + lid];
+	local_order[lid] = order[base + lid];
+	local_keys[lid + block_size / 2] = keys[base + lid + block_size / 2];
+	local_order[lid + block_size / 2] = order[base + lid + block_size / 2];
+
+	for (uint j = block_size >> 1; j > 0; j >>= 1)
+	{
+		barrier(CLK_LOCAL_MEM_FENCE);
+		uint a = ((lid & ~(j - 1)) << 1) | (lid & (j - 1));
+		compare_swap(local_keys, local_order, a, a | j, ((base + a) & k) == 0);
+	}
+
+	barrier(CLK_LOCAL_MEM_FENCE);
+	keys[base + lid] = local_keys[lid];
+	order[base + lid] = local_order[lid];
+	keys[base + lid + block_size / 2] = local_keys[lid + block_size / 2];
+	order[base + lid + block_size / 2] = local_order[lid + block_size / 2];
+}
+
+// Neighbours (2 id + parity, 2 id + parity + 1) swapped into ascending order
+__kernel void odd_even_pass(
+	__global uint* keys,
+	__global uint* order,
+	uint n,
+	uint parity)
+{
+	uint a = 2 * get_global_id(0) + parity;
+
+	if (a + 1 >= n || keys[a] <= keys[a + 1])
+		return;
+
+	uint key = keys[a];
+	uint index = order[a];
+
+	keys[a] = keys[a + 1];
+	order[a] = order[a + 1];
+	keys[a + 1] = key;
+	order[a + 1] = index;
+}
@@ -1,12 +1,50 @@
+import os
 import sys
+import time
 
-from particle_system import ParticleSystem
 from exceptions import ParticleSystemException
 from colorama import Fore, Back, Style
 
 def terminate_with_usage():
 	print(Style.BRIGHT + 'usage: ' + Style.RESET_ALL + 'python3 ' + Fore.BLUE + 'main.py ' + Fore.RESET +
-		'n_particles \t\t (n_particles > 0)')
+		'n_particles \t\t (n_particles > 0) [options]')
+	print(Style.BRIGHT + '\n[OPTIONS]' + Style.RESET_ALL)
+	print(Fore.BLUE + '--headless n_steps' + Fore.RESET + '\t\t Simulate n_steps without a window, then report throughput')
+	print(Fore.BLUE + '--backend opencl|numpy' + Fore.RESET + '\t\t Select simulation backend (numpy if no OpenCL platform)')
+	print(Fore.BLUE + '--seed n' + Fore.RESET + '\t\t\t Random seed, the same seed reproduces the same run')
+	print(Fore.BLUE + '--pipelined' + Fore.RESET + '\t\t\t Compute the next frame while the current one draws')
+	print(Fore.BLUE + '--compact' + Fore.RESET + '\t\t\t Pack particles into 28 bytes (RGBA8 color, half velocity)')
+	print(Fore.BLUE + '--sim-hz n' + Fore.RESET + '\t\t\t Simulation steps per second, independent of frame rate (default 60)')
+	print(Fore.BLUE + '--interpolate' + Fore.RESET + '\t\t\t Render between the last two simulation steps')
+	print(Fore.BLUE + '--partition n' + Fore.RESET + '\t\t\t Split particles across n devices, or n CPU sub-devices')
+	print(Fore.BLUE + '--bodies n' + Fore.RESET + '\t\t\t N-Body mode: the first n particles attract, 0 for all (default 1024)')
+	print(Fore.BLUE + '--barnes-hut' + Fore.RESET + '\t\t\t N-Body mode: approximate far bodies with an octree')
+	print(Fore.BLUE + '--emission-rate n' + Fore.RESET + '\t\t Respawn n particles per second, the pool grows to fit them')
+	print(Fore.BLUE + '--emitters file' + Fore.RESET + '\t\t\t Add the emitters listed in a JSON file to the generator')
+	print(Fore.BLUE + '--modes file' + Fore.RESET + '\t\t\t Add the OpenCL C particle modes listed in a JSON file (after N-Body on TAB)')
+	print(Fore.BLUE + '--depth-sort k' + Fore.RESET + '\t\t\t Draw particles back to front, fully sorted every k frames')
+	print(Fore.BLUE + '--additive' + Fore.RESET + '\t\t\t Blend additively, in any order')
+	print(Fore.BLUE + '--cull' + Fore.RESET + '\t\t\t\t Only draw the particles on screen')
+	print(Fore.BLUE + '--lod n' + Fore.RESET + '\t\t\t\t Cull, and thin every 8x8 pixel tile to about n particles')
+	print(Fore.BLUE + '--trails k' + Fore.RESET + '\t\t\t Draw every particle\'s last k positions as a fading trail (k >= 2)')
+	print(Fore.BLUE + '--force-field kind' + Fore.RESET + '\t\t Drift along a curl, wind or vortex field, or one from a .npy file')
+	print(Fore.BLUE + '--force-strength f' + Fore.RESET + '\t\t With --force-field, displacement per 1/60 s at full field strength (default 0.01)')
+	print(Fore.BLUE + '--profile file' + Fore.RESET + '\t\t\t Time each frame phase, write CSV (or .json) on F12 and at exit')
+	print(Fore.BLUE + '--record dir' + Fore.RESET + '\t\t\t Stream particle state of every step to a recording in dir')
+	print(Fore.BLUE + '--record-velocity' + Fore.RESET + '\t\t With --record, record velocity too')
+	print(Fore.BLUE + '--quantize' + Fore.RESET + '\t\t\t With --record, store 16-bit positions, RGBA8 colors and half floats')
+	print(Fore.BLUE + '--compress' + Fore.RESET + '\t\t\t With --record, zlib-compress every chunk of frames')
+	print(Fore.BLUE + '--replay dir' + Fore.RESET + '\t\t\t Play a recording instead of simulating (n_particles comes from it)')
+	print(Fore.BLUE + '--capture dir' + Fore.RESET + '\t\t\t Write rendered frames to dir as PNGs')
+	print(Fore.BLUE + '--capture-every k' + Fore.RESET + '\t\t With --capture, write every k-th frame (default 1)')
+	print(Fore.BLUE + '--capture-format png|gif' + Fore.RESET + '\t With --capture, write PNG frames or one GIF')
+	print(Fore.BLUE + '--offscreen n_frames' + Fore.RESET + '\t\t Render n_frames without a window (EGL, or OSMesa)')
+	print(Fore.BLUE + '--verify' + Fore.RESET + '\t\t\t With --headless, report drift of OpenCL against numpy')
+	print(Fore.BLUE + '--mode n' + Fore.RESET + '\t\t\t With --headless, particle mode n, in TAB order (default 0)')
+	print(Fore.BLUE + '--color n' + Fore.RESET + '\t\t\t With --headless, color profile n, in C order (default 0)')
+	print(Fore.BLUE + '--gravity' + Fore.RESET + '\t\t\t With --headless, turn gravity on, like G')
+	print(Fore.BLUE + '--no-decay' + Fore.RESET + '\t\t\t With --headless, turn lifetime decay off, like L')
+	print(Fore.BLUE + '--spawn-cube' + Fore.RESET + '\t\t\t With --headless, spawn particles in a cube, like Z')
 	print(Style.BRIGHT + '\n[CONTROLS]' + Style.RESET_ALL)
 	print(Fore.BLUE + 'W A S D Q E' + Fore.RESET + '\t\t\t Move camera')
 	print(Fore.BLUE + 'LEFT SHIFT + MOUSE MOVE' + Fore.RESET + '\t\t Rotate camera')
@@ -22,6 +60,13 @@ def terminate_with_usage():
 	print(Fore.BLUE + 'X' + Fore.RESET + '\t\t\t\t Toggle particle shrinking on/off')
 	print(Fore.BLUE + 'TAB' + Fore.RESET + '\t\t\t\t Select next particle mode')
 	print(Fore.BLUE + 'C' + Fore.RESET + '\t\t\t\t Select next color profile')
+	print(Fore.BLUE + 'F12' + Fore.RESET + '\t\t\t\t Write frame profile (with --profile)')
+	print(Fore.BLUE + 'SPACE' + Fore.RESET + '\t\t\t\t Pause/resume replay (with --replay)')
+	print(Fore.BLUE + '=/-' + Fore.RESET + '\t\t\t\t Double/halve emission rate (with --emission-rate)')
+	print(Fore.BLUE + 'B' + Fore.RESET + '\t\t\t\t Toggle additive/alpha blending')
+	print(Fore.BLUE + 'F' + Fore.RESET + '\t\t\t\t Select next force field')
+	print(Fore.BLUE + 'N/BACKSPACE' + Fore.RESET + '\t\t\t Add an emitter at the generator/remove the last one')
+	print(Fore.BLUE + 'COMMA/PERIOD' + Fore.RESET + '\t\t\t Step replay one frame back/forward (with --replay)')
 	print()
 	print(Fore.BLUE + 'ESC' + Fore.RESET + '\t\t\t\t Terminate')
 	print()
@@ -33,6 +78,143 @@ def parse_number(expr):
 	except ValueError:
 		terminate_with_usage()
 
+def parse_float(expr):
+	try:
+		return float(expr)
+	except ValueError:
+		terminate_with_usage()
+
+# Options that take a value, and flags that don't
+OPTIONS_WITH_VALUE = ( '--headless', '--backend', '--seed', '--sim-hz', '--profile', '--partition', '--bodies', '--record', '--replay',
+	'--capture', '--capture-every', '--capture-format', '--offscreen', '--emission-rate',
+	'--emitters', '--depth-sort', '--lod', '--force-field', '--force-strength', '--trails', '--modes', '--mode', '--color' )
+FLAGS = ( '--verify', '--pipelined', '--compact', '--interpolate', '--barnes-hut', '--record-velocity', '--quantize',
+	'--compress', '--additive', '--cull', '--gravity', '--no-decay', '--spawn-cube' )
+
+def parse_options(args):
+	options = {}
+	i = 0
+	while i < len(args):
+		if args[i] in OPTIONS_WITH_VALUE and i + 1 < len(args):
+			options[args[i]] = args[i + 1]
+			i += 2
+		elif args[i] in FLAGS:
+			options[args[i]] = True
+			i += 1
+		else:
+			terminate_with_usage()
+	return options
+
+def select_backend(options):
+	backend = options.get('--backend', 'opencl')
+	if backend not in ('opencl', 'numpy'):
+		terminate_with_usage()
+
+	if backend == 'opencl':
+		from simulation_core import has_opencl_platform
+
+		if not has_opencl_platform():
+			print(Style.BRIGHT + Fore.YELLOW + 'No OpenCL platform found, using numpy backend' + Style.RESET_ALL + Fore.RESET)
+			backend = 'numpy'
+	return backend
+
+def create_simulation(n_particles, backend, compact=False, n_partitions=0):
+	if backend == 'numpy':
+		from numpy_backend import NumpySimulation
+		return NumpySimulation(n_particles)
+	elif n_partitions:
+		from simulation_core import SimulationCore
+		from device_partition import create_partitioned_context
+		return SimulationCore(n_particles, create_partitioned_context(n_partitions), compact=compact, partition=True)
+	else:
+		from simulation_core import SimulationCore
+		return SimulationCore(n_particles, compact=compact)
+
+# Simulation attributes of a headless run, what the keys toggle in the renderer. Parsed after --modes is loaded.
+def parse_settings(options, n_bodies):
+	settings = {
+		'particle_mode_id': parse_number(options.get('--mode', '0')),
+		'color_profile_id': parse_number(options.get('--color', '0')),
+		'is_gravity_on': '--gravity' in options,
+		'is_decaying': '--no-decay' not in options,
+		'spawn_in_cube': '--spawn-cube' in options,
+		'n_bodies': n_bodies,
+		'barnes_hut': '--barnes-hut' in options,
+		}
+	if '--mode' in options or '--color' in options:
+		from simulation_core import PARTICLE_MODES, COLOR_PROFILES
+		from custom_modes import custom_modes
+
+		mode, color = settings['particle_mode_id'], settings['color_profile_id']
+		if not (0 <= mode < len(PARTICLE_MODES) or custom_modes.is_custom(mode)) or not 0 <= color < len(COLOR_PROFILES):
+			terminate_with_usage()
+	return settings
+
+def apply_settings(core, settings):
+	for name, value in settings.items():
+		setattr(core, name, value)
+
+def create_recorder(options, n_particles, backend):
+	if '--record' not in options:
+		return None
+	if backend != 'opencl':
+		raise ParticleSystemException('Recording reads back OpenCL buffers, it needs the OpenCL backend')
+
+	from recorder import Recorder
+	return Recorder(options['--record'], n_particles, with_velocity='--record-velocity' in options,
+		quantize='--quantize' in options, compress='--compress' in options)
+
+def run_headless(n_particles, n_steps, backend, verify, random_seed, compact, simulation_rate, n_partitions, recorder=None,
+		emission_rate=None, emitters_filename=None, force_field=None, force_strength=None, trail_length=0, settings=None):
+	core = create_simulation(n_particles, backend, compact, n_partitions)
+	apply_settings(core, settings or {})
+	core.random_seed = random_seed
+	core.time_step = 1.0 / simulation_rate
+	core.emission_rate = emission_rate
+	core.force_field = force_field
+	if force_strength is not None:
+		core.force_strength = force_strength
+	if backend == 'opencl':
+		# Only written, headless, to measure what trails cost
+		core.trail_length = trail_length
+	if emitters_filename is not None:
+		core.emitters.load(emitters_filename)
+	core.init()
+	if recorder is None:
+		elapsed = core.run(n_steps)
+	else:
+		# Offline rendering: every step is read back and written while the next one computes
+		start = time.perf_counter()
+		recorder.capture(core, 0.0)
+		for step in range(1, n_steps + 1):
+			core.update()
+			recorder.capture(core, step * core.time_step)
+		recorder.close()
+		elapsed = time.perf_counter() - start
+	print(Style.BRIGHT + 'BACKEND: \t' + Style.RESET_ALL, backend)
+	print(Style.BRIGHT + 'STEPS: \t' + Style.RESET_ALL, n_steps)
+	print(Style.BRIGHT + 'ELAPSED: \t' + Style.RESET_ALL, '%.3f s' % elapsed)
+	print(Style.BRIGHT + 'THROUGHPUT: \t' + Style.RESET_ALL, '%.3e particles/s' % (n_particles * n_steps / elapsed))
+
+	if verify and backend == 'opencl':
+		import numpy as np
+
+		reference = create_simulation(n_particles, 'numpy')
+		apply_settings(reference, settings or {})
+		reference.random_seed = random_seed
+		reference.time_step = core.time_step
+		reference.emission_rate = emission_rate
+		reference.force_field = force_field
+		if force_strength is not None:
+			reference.force_strength = force_strength
+		if emitters_filename is not None:
+			reference.emitters.load(emitters_filename)
+		reference.init()
+		reference.run(n_steps)
+		for name, actual, expected in zip(('position', 'color', 'lifetime'), core.read_state(), reference.read_state()):
+			drift = np.max(np.abs(actual - expected)) if n_particles else 0.0
+			print(Style.BRIGHT + 'DRIFT: \t' + Style.RESET_ALL, '%-10s %.3e' % (name, drift))
+
 def main():
 	if len(sys.argv) < 2:
 		terminate_with_usage()
@@ -40,10 +222,76 @@ def main():
 	n_particles = parse_number(sys.argv[1])
 	if n_particles <= 0:
 		terminate_with_usage()
+	options = parse_options(sys.argv[2:])
+	random_seed = parse_number(options.get('--seed', '0'))
+	simulation_rate = parse_number(options.get('--sim-hz', '60'))
+	n_partitions = parse_number(options.get('--partition', '0'))
+	n_bodies = parse_number(options.get('--bodies', '1024'))
+	emission_rate = parse_number(options['--emission-rate']) if '--emission-rate' in options else None
+	if simulation_rate <= 0 or n_partitions < 0 or n_bodies < 0 or (emission_rate is not None and emission_rate < 0):
+		terminate_with_usage()
+
+	capture_every = parse_number(options.get('--capture-every', '1'))
+	offscreen_frames = parse_number(options.get('--offscreen', '0'))
+	depth_sort_every = parse_number(options.get('--depth-sort', '0'))
+	lod_budget = parse_number(options.get('--lod', '0'))
+	trail_length = parse_number(options.get('--trails', '0'))
+	if capture_every <= 0 or offscreen_frames < 0 or depth_sort_every < 0 or lod_budget < 0 or trail_length == 1 or trail_length < 0:
+		terminate_with_usage()
+	if options.get('--capture-format', 'png') not in ('png', 'gif'):
+		terminate_with_usage()
+
+	# A built-in field, or a .npy file
+	force_field = options.get('--force-field')
+	force_strength = parse_float(options['--force-strength']) if '--force-strength' in options else None
+	if force_field is not None and force_field not in ('curl', 'wind', 'vortex') and not force_field.endswith('.npy'):
+		terminate_with_usage()
+
+	if '--replay' in options and ('--record' in options or '--headless' in options or '--emitters' in options):
+		terminate_with_usage()
+	if '--headless' in options and ('--offscreen' in options or '--capture' in options):
+		terminate_with_usage()
 
 	try:
-		particle_system = ParticleSystem(n_particles)
-		particle_system.loop()
+		# Before any simulation, their emitters and kernels need the custom modes
+		if '--modes' in options:
+			from custom_modes import custom_modes
+
+			custom_modes.load(options['--modes'])
+		if '--headless' in options:
+			n_steps = parse_number(options['--headless'])
+			if n_steps <= 0:
+				terminate_with_usage()
+			backend = select_backend(options)
+			run_headless(n_particles, n_steps, backend, '--verify' in options, random_seed,
+				'--compact' in options, simulation_rate, n_partitions, create_recorder(options, n_particles, backend),
+				emission_rate, options.get('--emitters'), force_field, force_strength, trail_length,
+				parse_settings(options, n_bodies))
+		else:
+			# PyOpenGL picks its platform on first import, a windowless context needs EGL (or OSMesa)
+			if offscreen_frames:
+				os.environ.setdefault('PYOPENGL_PLATFORM', 'egl')
+			from particle_system import ParticleSystem
+
+			if '--replay' in options:
+				from recorder import Replay
+
+				replay = Replay(options['--replay'])
+				n_particles = replay.n_particles
+				backend = 'replay'
+			else:
+				replay = None
+				backend = select_backend(options)
+
+			particle_system = ParticleSystem(n_particles, backend, '--pipelined' in options,
+				'--compact' in options, simulation_rate, '--interpolate' in options, options.get('--profile'), n_partitions,
+				create_recorder(options, n_particles, backend), replay, options.get('--capture'), capture_every,
+				options.get('--capture-format', 'png'), offscreen_frames, emission_rate, depth_sort_every, '--additive' in options,
+				'--cull' in options, lod_budget, force_field, force_strength, trail_length, options.get('--emitters'))
+			particle_system.core.random_seed = random_seed
+			particle_system.core.n_bodies = n_bodies
+			particle_system.core.barnes_hut = '--barnes-hut' in options
+			particle_system.loop()
 	except IOError as e:
 		print(Style.BRIGHT + Fore.RED + 'I/O Error: ' + Style.RESET_ALL + Fore.RESET + str(e))
 	except ParticleSystemException as e:
@@ -0,0 +1,548 @@
+import numpy as np
+import time
+
+from exceptions import ParticleSystemException
+from emitters import EmitterTable
+from custom_modes import FIRST_CUSTOM_MODE
+
+# Same Philox4x32-10 as rand_uint() in kernels/kernel.cl
+PHILOX_M0 = np.uint64(0xD2511F53)
+PHILOX_M1 = np.uint64(0xCD9E8D57)
+PHILOX_W0 = 0x9E3779B9
+PHILOX_W1 = 0xBB67AE85
+PHILOX_KEY_HI = 0x5851F42D
+UINT_MASK = np.uint64(0xFFFFFFFF)
+UINT_MAX = np.float32(2.0 ** 32)
+
+REFERENCE_RATE = np.float32(60.0)		# like kernel.cl, constants are per 1/60 s frame
+
+# color_profile_id
+COLOR_CONFETTI = 0
+COLOR_MONOCHROME = 1
+COLOR_RED_AND_WHITE = 2
+COLOR_CMY = 3
+COLOR_RAINBOW_DASH = 4
+
+# particle_mode_id
+PARTICLE_STATIONARY = 0
+PARTICLE_FALLING_DOWN = 1
+PARTICLE_GRAVITY_FOUNTAIN = 2
+PARTICLE_RADIAL_EXPLOSION = 3
+PARTICLE_CHAOS_NOVA = 4
+PARTICLE_VORTEX_ATTRACTOR = 5
+PARTICLE_SOFT_COLLISION = 6
+PARTICLE_SPH_FLUID = 7
+PARTICLE_FLOCKING = 8
+PARTICLE_NBODY = 9
+
+INTERACTING_MODES = ( PARTICLE_SOFT_COLLISION, PARTICLE_SPH_FLUID, PARTICLE_FLOCKING )
+
+# Like kernels/grid.cl
+INTERACTION_RADIUS = np.float32(0.04)
+FLOOR_DEPTH = np.float32(1.0)
+SPH_REST_DENSITY = np.float32(4.0)
+SPH_STIFFNESS = np.float32(0.5)
+
+# Like kernels/nbody.cl
+NBODY_GM = np.float32(0.0002)
+NBODY_SOFTENING_SQUARED = np.float32(0.0025)
+NBODY_INITIAL_SPEED = np.float32(0.02)
+NBODY_CHUNK = 1 << 22				# particle-body pairs per vectorized pass
+
+GREEN = np.array([0.0, 1.0, 0.0, 0.0], dtype=np.float32)
+
+RW_TABLE = np.array([
+	[1.0, 0.0, 0.0, 0.0],							# Red
+	[1.0, 1.0, 1.0, 0.0],							# White
+	], dtype=np.float32)
+
+CMY_TABLE = np.array([
+	[0.0, 1.0, 1.0, 0.0],							# Cyan
+	[1.0, 0.0, 1.0, 0.0],							# Magenta
+	[1.0, 1.0, 0.0, 0.0],							# Yellow
+	], dtype=np.float32)
+
+RAINBOW_TABLE = np.array([
+	[1.0, 0.0, 0.0, 0.0],							# Red
+	[1.0, 165.0 / 255.0, 0.0, 0.0],					# Orange
+	[1.0, 1.0, 0.0, 0.0],							# Yellow
+	[0.0, 1.0, 0.0, 0.0],							# Green
+	[0.0, 0.0, 1.0, 0.0],							# Blue
+	[75.0 / 255.0, 0.0, 130.0 / 255.0, 0.0],		# Indigo
+	[128.0 / 255.0, 0.0, 128.0 / 255.0, 0.0],		# Purple
+	], dtype=np.float32)
+
+COLOR_TABLES = {
+	COLOR_RED_AND_WHITE: RW_TABLE,
+	COLOR_CMY: CMY_TABLE,
+	COLOR_RAINBOW_DASH: RAINBOW_TABLE,
+	}
+
+
+# uint32 counters are carried in uint64 arrays, so the 32x32 products don't overflow
+def philox4x32_10(counter, key):
+	c0, c1, c2, c3 = counter
+	k0, k1 = key
+	for _ in range(10):
+		product0 = PHILOX_M0 * c0
+		product1 = PHILOX_M1 * c2
+		c0, c1, c2, c3 = ((product1 >> np.uint64(32)) ^ c1 ^ np.uint64(k0), product1 & UINT_MASK,
+			(product0 >> np.uint64(32)) ^ c3 ^ np.uint64(k1), product0 & UINT_MASK)
+		k0 = (k0 + PHILOX_W0) & 0xFFFFFFFF
+		k1 = (k1 + PHILOX_W1) & 0xFFFFFFFF
+	return [ c0, c1, c2, c3 ]
+
+
+# Random streams of a group of particles, which all draw the same amount of numbers
+class RandomStream:
+
+	def __init__(self, ids, frame, random_seed, substep=0):
+		self.ids = np.asarray(ids, dtype=np.uint64)
+		self.frame = np.uint64(frame)
+		self.substep = np.uint64(substep)
+		self.key = (random_seed & 0xFFFFFFFF, PHILOX_KEY_HI)
+		self.block = 0
+		self.output = []
+
+	def rand_uint(self):
+		if not self.output:
+			zeros = np.zeros_like(self.ids)
+			counter = (self.ids, zeros + self.frame, zeros + np.uint64(self.block), zeros + self.substep)
+			self.output = philox4x32_10(counter, self.key)
+			self.block += 1
+		return self.output.pop(0)
+
+	def rand_float(self):
+		return self.rand_uint().astype(np.float32) / UINT_MAX
+
+	def rand_float_in_range(self, a, b):
+		x = self.rand_float()
+		return np.float32(b - a) * x + np.float32(a)
+
+	# The same streams, continued for the particles in mask
+	def select(self, mask):
+		stream = RandomStream(self.ids[mask], self.frame, self.key[0], self.substep)
+		stream.block = self.block
+		stream.output = [ output[mask] for output in self.output ]
+		return stream
+
+
+# Like OpenCL normalize(), a zero vector stays zero
+def normalize_rows(vectors):
+	length = np.sqrt(np.sum(vectors * vectors, axis=1, keepdims=True))
+	return np.divide(vectors, length, out=np.zeros_like(vectors), where=length > 0.0)
+
+def get_direction(source, destination):
+	direction = destination - source
+	direction[:, 3] = 0.0
+	return normalize_rows(direction)
+
+def get_sph_pressure(density):
+	return SPH_STIFFNESS * np.maximum(density - SPH_REST_DENSITY, np.float32(0.0))
+
+# Every (i, j), i != j, with position j within cell_size of position i, found through the 27 surrounding cells
+def get_neighbour_pairs(position, cell_size):
+	cells = np.floor(position[:, :3] / cell_size).astype(np.int64)
+	keys = (cells[:, 0] << 42) + (cells[:, 1] << 21) + cells[:, 2]
+	order = np.argsort(keys, kind='stable')
+	sorted_keys = keys[order]
+
+	pairs_i = []
+	pairs_j = []
+	for dz in (-1, 0, 1):
+		for dy in (-1, 0, 1):
+			for dx in (-1, 0, 1):
+				neighbour_keys = keys + ((dx << 42) + (dy << 21) + dz)
+				first = np.searchsorted(sorted_keys, neighbour_keys, side='left')
+				counts = np.searchsorted(sorted_keys, neighbour_keys, side='right') - first
+				total = int(np.sum(counts))
+				i = np.repeat(np.arange(len(position)), counts)
+				within = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+				pairs_i.append(i)
+				pairs_j.append(order[np.repeat(first, counts) + within])
+
+	i = np.concatenate(pairs_i)
+	j = np.concatenate(pairs_j)
+	offset = position[i] - position[j]
+	offset[:, 3] = 0.0
+	distance_squared = np.sum(offset * offset, axis=1)
+	keep = (i != j) & (distance_squared < cell_size * cell_size)
+	return i[keep], j[keep], offset[keep], distance_squared[keep]
+
+# Per-row sums of pair values into n rows
+def sum_pairs(i, values, n):
+	if values.ndim == 1:
+		return np.bincount(i, weights=values, minlength=n).astype(np.float32)
+	return np.stack([ sum_pairs(i, values[:, k], n) for k in range(values.shape[1]) ], axis=1)
+
+
+# Structure-of-arrays particle state, every kernel step is one vectorized pass
+class NumpySimulation:
+
+	def __init__(self, n_particles, random_seed=0):
+		self.n_particles = n_particles
+
+		# Every step draws from its own frame of the counter-based random stream, like SimulationCore
+		self.random_seed = random_seed
+		self.frame = 0
+
+		# Simulated seconds per substep
+		self.time_step = 1.0 / 60
+
+		self.generator_position = np.array( [0.0, 0.0, 0.0, 1.0], dtype=np.float32)
+
+		self.spawn_in_cube = False
+		self.is_decaying = True
+		self.is_gravity_on = False
+		self.particle_mode_id = 0
+		self.color_profile_id = 0
+
+		# N-body always sums directly, Barnes-Hut is OpenCL only
+		self.n_bodies = 1024
+
+		# Like SimulationCore, dead particles wait for emission when there is a rate
+		self.emission_rate = None
+		self.n_emit = 0
+
+		# Like SimulationCore, emitter 0 is the generator
+		self.emitters = EmitterTable()
+		self.emitter_index = np.zeros(n_particles, dtype=np.uint8)
+		self.emitter_assignment_key = None
+
+		# Like SimulationCore, sampled on the host with the same trilinear filtering.
+		# force_field.py is only imported once a field is set.
+		self.force_field = None
+		self.force_strength = None				# None for force_field.DEFAULT_STRENGTH
+		self.force_fields = None
+
+		self.position = np.zeros((n_particles, 4), dtype=np.float32)
+		self.color = np.zeros((n_particles, 4), dtype=np.float32)
+		self.lifetime = np.zeros(n_particles, dtype=np.float32)
+		self.velocity = np.zeros((n_particles, 4), dtype=np.float32)
+
+	def init(self):
+		ids = np.arange(self.n_particles)
+		emitters = self.__prepare_emitters()
+		rng = self.__next_frame(ids)
+
+		self.lifetime[:] = rng.rand_float()
+		if self.emission_rate is not None:
+			self.lifetime[:] = 0.0
+		for index, emitter in enumerate(emitters):
+			mine = self.emitter_index == index
+			self.__init_particles(ids[mine], rng.select(mine), emitter)
+
+	# Like the kernel, all substeps of one update share a frame and draw from their own substep stream
+	def update(self, n_substeps=1):
+		ids = np.arange(self.n_particles)
+		time_scale = np.float32(self.time_step) * REFERENCE_RATE
+		self.frame = (self.frame + 1) & 0xFFFFFFFF
+
+		# Interacting and N-body modes step every particle with the generator
+		self.n_emit = 0
+		if self.particle_mode_id in INTERACTING_MODES or self.particle_mode_id == PARTICLE_NBODY:
+			generator = self.__prepare_emitters()[0]
+			for substep in range(n_substeps):
+				if self.particle_mode_id == PARTICLE_NBODY:
+					self.__step_nbody(ids, substep, time_scale, generator)
+				else:
+					self.__interact(ids, substep, time_scale, generator)
+			return
+
+		# Emitting, the dead particles ranked below their emitter's n_emit respawn once, the others stay dead
+		emitters = self.__prepare_emitters(n_substeps)
+		particle_emitters = emitters[self.emitter_index]
+		can_respawn = np.ones(self.n_particles, dtype=bool)
+		if self.emission_rate is not None:
+			is_dead = self.lifetime <= 0.0
+			dead_rank = np.cumsum(is_dead) - is_dead
+			can_respawn = is_dead & (dead_rank - dead_rank[particle_emitters['first']] < particle_emitters['n_emit'])
+		decay = particle_emitters['decay'] * np.float32(self.time_step)
+
+		for substep in range(n_substeps):
+			if self.is_decaying:
+				self.lifetime -= decay
+
+			alive = self.lifetime > 0.0
+			dead = ~alive & can_respawn
+
+			for index, emitter in enumerate(emitters):
+				mine = self.emitter_index == index
+				updated = ids[alive & mine]
+				respawned = ids[dead & mine]
+				self.__update_particles(updated, RandomStream(updated, self.frame, self.random_seed, substep), time_scale, emitter)
+				if len(respawned):
+					self.__init_particles(respawned, RandomStream(respawned, self.frame, self.random_seed, substep), emitter)
+			self.lifetime[dead] = 1.0
+			if self.emission_rate is not None:
+				can_respawn[dead] = False
+
+	# Keeps the particles both counts have, the others start dead
+	def resize(self, n_particles):
+		n_kept = min(n_particles, self.n_particles)
+		for name in ( 'position', 'color', 'lifetime', 'velocity' ):
+			old = getattr(self, name)
+			new = np.zeros((n_particles, *old.shape[1:]), dtype=np.float32)
+			new[:n_kept] = old[:n_kept]
+			setattr(self, name, new)
+		self.n_particles = n_particles
+		self.emitter_index = np.zeros(n_particles, dtype=np.uint8)
+		self.emitter_assignment_key = None
+
+	def get_live_count(self):
+		if self.emission_rate is None:
+			return self.n_particles
+		return int(np.count_nonzero(self.lifetime > 0.0))
+
+	def change_color(self):
+		ids = np.arange(self.n_particles)
+		emitters = self.__prepare_emitters()
+		rng = self.__next_frame(ids)
+		for index, emitter in enumerate(emitters):
+			mine = self.emitter_index == index
+			self.color[mine] = self.__get_color(rng.select(mine), emitter)
+
+	# Run n_steps of update() and return elapsed wall time in seconds
+	def run(self, n_steps):
+		start = time.perf_counter()
+		for _ in range(n_steps):
+			self.update()
+		return time.perf_counter() - start
+
+	def finish(self):
+		pass
+
+	def get_n_bodies(self):
+		if self.n_bodies <= 0:
+			return self.n_particles
+		return min(self.n_bodies, self.n_particles)
+
+	# Host-side steps enqueue nothing, the frame profiler times them on the host
+	def pop_events(self):
+		return []
+
+	def read_state(self):
+		return self.position, self.color, self.lifetime
+
+	# Like SimulationCore, the emitter table of a dispatch over n_substeps
+	def __prepare_emitters(self, n_substeps=0):
+		self.emitters.sync_generator(self)
+		if self.emission_rate is not None:
+			self.n_emit = self.emitters.next_emission(self.time_step * n_substeps)
+
+		assignment_key = self.emitters.get_assignment_key(self.n_particles)
+		if assignment_key != self.emitter_assignment_key:
+			self.emitter_index = self.emitters.assign(self.n_particles)
+			self.emitter_assignment_key = assignment_key
+		return self.emitters.get_table()
+
+	def __next_frame(self, ids):
+		self.frame = (self.frame + 1) & 0xFFFFFFFF
+		return RandomStream(ids, self.frame, self.random_seed)
+
+	def __get_position_in_cube(self, rng):
+		position = np.zeros((len(rng.ids), 4), dtype=np.float32)
+		for axis in range(3):
+			position[:, axis] = rng.rand_float_in_range(-0.5, 0.5)
+		return position
+
+	def __get_position_in_sphere(self, rng, fill_volume):
+		position = self.__get_position_in_cube(rng)
+		radius = rng.rand_float_in_range(0.0, 0.5)
+		if fill_volume:
+			radius = np.float32(0.5) * np.cbrt(np.float32(2.0) * radius)
+		return normalize_rows(position) * radius[:, np.newaxis]
+
+	def __get_position(self, rng, emitter):
+		if emitter['spawn_in_cube']:
+			return emitter['position'] + self.__get_position_in_cube(rng)
+		else:
+			return emitter['position'] + self.__get_position_in_sphere(rng, emitter['particle_mode_id'] in INTERACTING_MODES)
+
+	def __get_color(self, rng, emitter):
+		color_profile_id = emitter['color_profile_id']
+		if color_profile_id == COLOR_MONOCHROME:
+			return np.broadcast_to(GREEN, (len(rng.ids), 4))
+		elif color_profile_id in COLOR_TABLES:
+			table = COLOR_TABLES[color_profile_id]
+			return table[rng.rand_uint() % np.uint64(len(table))]
+		else:
+			color = np.zeros((len(rng.ids), 4), dtype=np.float32)
+			for channel in range(3):
+				color[:, channel] = rng.rand_float()
+			return color
+
+	def __init_particles(self, ids, rng, emitter):
+		mode = emitter['particle_mode_id']
+		if mode >= FIRST_CUSTOM_MODE:
+			raise ParticleSystemException('Custom particle modes are OpenCL C, they need the OpenCL backend')
+		generator_position = emitter['position']
+		self.position[ids] = self.__get_position(rng, emitter)
+		self.color[ids] = self.__get_color(rng, emitter)
+		self.velocity[ids] = 0.0
+
+		if mode == PARTICLE_GRAVITY_FOUNTAIN:
+			direction = get_direction(generator_position[np.newaxis, :], self.position[ids]) * np.float32(0.05)
+			direction[:, 1] = np.abs(direction[:, 1])
+			self.velocity[ids] = direction
+		elif mode == PARTICLE_FLOCKING:
+			self.velocity[ids] = get_direction(generator_position[np.newaxis, :], self.position[ids]) * np.float32(0.005)
+		elif mode == PARTICLE_NBODY:
+			offset = self.position[ids] - generator_position
+			tangent = np.zeros_like(offset)
+			tangent[:, :3] = np.cross(np.array([0.0, 1.0, 0.0], dtype=np.float32), offset[:, :3])
+			self.velocity[ids] = normalize_rows(tangent) * NBODY_INITIAL_SPEED
+
+	def __update_particles(self, ids, rng, time_scale, emitter):
+		mode = emitter['particle_mode_id']
+		generator_position = emitter['position']
+		position = self.position[ids]
+
+		if mode == PARTICLE_FALLING_DOWN:
+			position[:, 1] += (np.float32(0.02) if self.is_gravity_on else np.float32(-0.02)) * time_scale
+		elif mode == PARTICLE_GRAVITY_FOUNTAIN:
+			velocity = self.velocity[ids]
+			velocity[:, 1] += (np.float32(0.001) if self.is_gravity_on else np.float32(-0.001)) * time_scale
+			position += velocity * time_scale
+			self.velocity[ids] = velocity
+		elif mode == PARTICLE_RADIAL_EXPLOSION:
+			position += get_direction(generator_position[np.newaxis, :], position) * np.float32(0.01) * time_scale
+		elif mode == PARTICLE_CHAOS_NOVA:
+			jitter = np.sqrt(time_scale)
+			for axis in range(3):
+				position[:, axis] += rng.rand_float_in_range(-0.1, 0.1) * jitter
+		elif mode == PARTICLE_VORTEX_ATTRACTOR:
+			velocity = self.velocity[ids] + get_direction(position, generator_position[np.newaxis, :]) * np.float32(0.001) * time_scale
+			position += velocity * time_scale
+			self.velocity[ids] = velocity
+		elif mode >= FIRST_CUSTOM_MODE:
+			raise ParticleSystemException('Custom particle modes are OpenCL C, they need the OpenCL backend')
+		elif self.force_field is None:
+			return
+
+		if self.is_gravity_on and mode in (PARTICLE_RADIAL_EXPLOSION, PARTICLE_CHAOS_NOVA, PARTICLE_VORTEX_ATTRACTOR):
+			position[:, 1] += np.float32(-0.02) * time_scale
+		if self.force_field is not None:
+			self.__advect(position, time_scale)
+		self.position[ids] = position
+
+	# Like ADVECT() in kernels/kernel.cl
+	def __advect(self, position, time_scale):
+		from force_field import ForceFieldCache, FIELD_EXTENT, DEFAULT_STRENGTH, sample_field
+
+		if self.force_fields is None:
+			self.force_fields = ForceFieldCache()
+		strength = DEFAULT_STRENGTH if self.force_strength is None else self.force_strength
+		force = sample_field(self.force_fields.get_data(self.force_field), position[:, :3] * np.float32(1.0 / FIELD_EXTENT))
+		position[:, :3] += np.float32(strength) * force[:, :3] * time_scale
+
+	# One substep of the interact kernel: every particle sees the state of the others from before the substep.
+	# Sums run in a different order than on the device, so results agree up to rounding.
+	def __interact(self, ids, substep, time_scale, generator):
+		mode = self.particle_mode_id
+		h = INTERACTION_RADIUS
+		position = self.position.copy()
+		velocity = self.velocity.copy()
+
+		if self.is_decaying:
+			self.lifetime -= np.float32(0.01) * time_scale
+		alive = self.lifetime > 0.0
+		dead = ~alive
+
+		i, j, offset, distance_squared = get_neighbour_pairs(position, h)
+		distance = np.sqrt(distance_squared)
+		q = distance / h
+		direction = np.divide(offset, distance[:, np.newaxis], out=np.zeros_like(offset), where=distance[:, np.newaxis] > 0.0)
+		n = self.n_particles
+		v = velocity
+
+		if mode == PARTICLE_SOFT_COLLISION:
+			force = sum_pairs(i, direction * (1.0 - q)[:, np.newaxis], n)
+			v = v + force * (np.float32(0.002) * time_scale)
+		elif mode == PARTICLE_SPH_FLUID:
+			density = np.float32(1.0) + sum_pairs(i, (1.0 - distance_squared / (h * h)) ** 3, n)
+			pressure = get_sph_pressure(density)
+			weight = (pressure[i] + pressure[j]) / (2.0 * density[j]) * (1.0 - q) * (1.0 - q)
+			force = sum_pairs(i, direction * weight[:, np.newaxis], n)
+			viscosity = sum_pairs(i, (velocity[j] - velocity[i]) * ((1.0 - q) / density[j])[:, np.newaxis], n)
+			v = v + (force * np.float32(0.002) + viscosity * np.float32(0.02)) * time_scale
+		else:
+			close = q < 0.5
+			separation = sum_pairs(i[close], direction[close] * (0.5 - q[close])[:, np.newaxis], n)
+			n_neighbours = np.bincount(i, minlength=n).astype(np.float32)[:, np.newaxis]
+			velocity_sum = sum_pairs(i, velocity[j], n)
+			position_sum = sum_pairs(i, position[j], n)
+			v = v + separation * (np.float32(0.01) * time_scale)
+			flocked = n_neighbours[:, 0] > 0.0
+			mean_velocity = velocity_sum[flocked] / n_neighbours[flocked]
+			mean_position = position_sum[flocked] / n_neighbours[flocked]
+			v[flocked] += (mean_velocity - v[flocked]) * (np.float32(0.05) * time_scale)
+			v[flocked] += (mean_position - position[flocked]) * (np.float32(0.002) * time_scale)
+		v = v.astype(np.float32)
+		v[:, 3] = 0.0
+
+		# Gravity pulls down, otherwise the generator pulls everything in
+		if self.is_gravity_on:
+			v[:, 1] -= (np.float32(0.0005) if mode == PARTICLE_FLOCKING else np.float32(0.001)) * time_scale
+		else:
+			v += get_direction(position, self.generator_position[np.newaxis, :]) * (np.float32(0.0002) * time_scale)
+
+		speed = np.sqrt(np.sum(v[:, :3] * v[:, :3], axis=1))
+		moving = speed > 0.0
+		if mode == PARTICLE_FLOCKING:
+			v[moving] *= (np.clip(speed[moving], 0.002, 0.01) / speed[moving])[:, np.newaxis]
+		else:
+			v *= max(np.float32(1.0) - np.float32(0.01) * time_scale, np.float32(0.0))
+			fast = speed > 0.05
+			v[fast] *= (np.float32(0.05) / speed[fast])[:, np.newaxis]
+
+		p = position + v * time_scale
+		if mode != PARTICLE_FLOCKING:
+			floor = self.generator_position[1] - FLOOR_DEPTH
+			below = p[:, 1] < floor
+			p[below, 1] = floor
+			v[below, 1] *= np.float32(-0.5)
+
+		self.position[alive] = p[alive]
+		self.velocity[alive] = v[alive]
+		if np.any(dead):
+			self.lifetime[dead] = 1.0
+			self.__init_particles(ids[dead], RandomStream(ids[dead], self.frame, self.random_seed, substep), generator)
+
+	# Direct sum over the bodies, in chunks of particles so the pairwise arrays stay small
+	def __get_nbody_accelerations(self):
+		n_bodies = self.get_n_bodies()
+		bodies = self.position[:n_bodies, :3]
+		body_mass = np.float32(1.0 / n_bodies)
+		accelerations = np.zeros((self.n_particles, 4), dtype=np.float32)
+		chunk = max(1, NBODY_CHUNK // n_bodies)
+
+		for start in range(0, self.n_particles, chunk):
+			offset = bodies[np.newaxis, :, :] - self.position[start:start + chunk, np.newaxis, :3]
+			inverse_distance = np.float32(1.0) / np.sqrt(np.sum(offset * offset, axis=2) + NBODY_SOFTENING_SQUARED)
+			weight = body_mass * inverse_distance * inverse_distance * inverse_distance
+			accelerations[start:start + chunk, :3] = np.sum(offset * weight[:, :, np.newaxis], axis=1) * NBODY_GM
+		return accelerations
+
+	def __step_nbody(self, ids, substep, time_scale, generator):
+		accelerations = self.__get_nbody_accelerations()
+
+		if self.is_decaying:
+			self.lifetime -= np.float32(0.01) * time_scale
+		alive = self.lifetime > 0.0
+		dead = ~alive
+
+		v = self.velocity + accelerations * time_scale
+		if self.is_gravity_on:
+			v[:, 1] -= np.float32(0.001) * time_scale
+		v[:, 3] = 0.0
+
+		speed = np.sqrt(np.sum(v[:, :3] * v[:, :3], axis=1))
+		fast = speed > 0.05
+		v[fast] *= (np.float32(0.05) / speed[fast])[:, np.newaxis]
+
+		self.position[alive] += v[alive] * time_scale
+		self.velocity[alive] = v[alive]
+		if np.any(dead):
+			self.lifetime[dead] = 1.0
+			self.__init_particles(ids[dead], RandomStream(ids[dead], self.frame, self.random_seed, substep), generator)
@@ -1,7 +1,6 @@
 import glfw
 from OpenGL.GL import *
 from OpenGL.raw.GL import _types
-from PIL import Image
 
 import pyopencl as cl
 from pyopencl.tools import get_gl_sharing_context_properties
@@ -14,7 +13,12 @@ from colorama import Fore, Back, Style
 from shader import Shader
 from camera import Camera
 from exceptions import ParticleSystemException
-from file_to_string import file_to_string
+from simulation_core import SimulationCore, COLOR_PROFILES, PARTICLE_MODES, VERTEX_FLOATS
+from frame_profiler import FrameProfiler
+from startup import StartupTimer
+from texture_cache import TextureCache
+from emitters import MAX_EMITTERS, is_emitter_mode
+from custom_modes import custom_modes
 
 SCREEN_WIDTH = 800
 SCREEN_HEIGHT = 800
@@ -28,26 +32,31 @@ TEXTURE_FILENAME = 'textures/doge.png'
 
 VERTEX_SHADER_FILENAME = 'shaders/vertex_shader.glsl'
 FRAGMENT_SHADER_FILENAME = 'shaders/fragment_shader.glsl'
+TRAIL_VERTEX_SHADER_FILENAME = 'shaders/trail_vertex_shader.glsl'
+TRAIL_FRAGMENT_SHADER_FILENAME = 'shaders/trail_fragment_shader.glsl'
 
-KERNEL_FILENAME = 'kernels/kernel.cl'
+N_BUFFER_SETS = 2			# pipelined mode draws one VBO set while OpenCL fills the other
 
-COLOR_PROFILES = (
-	'Confetti',
-	'Monochrome',
-	'Red and White',
-	'Cyan Magenta Yellow',
-	'Rainbow Dash',
-	)
+SYNC_TIMEOUT_NS = 1000000
 
-PARTICLE_MODES = (
-	'Stationary',
-	'Falling Down',
-	'Gravity Fountain',
-	'Radial Explosion',
-	'Chaos Nova',
-	'Vortex Attractor',
-	)
+DEFAULT_SIMULATION_RATE = 60		# fixed simulation steps per second, independent of the frame rate
+MAX_SUBSTEPS = 8					# per frame, the simulation falls behind rather than stall rendering
+MAX_FRAME_TIME = 0.25				# longer frames (window dragged, breakpoint) are clamped
 
+TITLE_INTERVAL = 0.5				# seconds between FPS updates in the window title
+
+HOST_BACKENDS = ( 'numpy', 'replay' )	# state lives on the host and is uploaded into the VBOs
+
+MAX_POOL_CAPACITY = 1 << 24			# the pool doubles whenever emission runs out of dead particles, up to this
+EMISSION_RATE_FACTOR = 2.0			# per key press
+
+OFFSCREEN_FRAME_RATE = 60			# offscreen frames are spaced evenly in time, however fast they render
+
+ODD_EVEN_PASSES = 4					# per frame between full depth sorts
+
+TRAIL_SAMPLE_FLOATS = 4				# position.xyz and lifetime per particle per trail slot
+TRAIL_TEXTURE_UNIT = 1				# buffer textures the trail shader reads, the doge texture is on unit 0
+TRAIL_COLOR_TEXTURE_UNIT = 2
 
 # check for key press events
 def key_callback(window, key, scancode, action, mods):
@@ -72,6 +81,29 @@ def key_callback(window, key, scancode, action, mods):
 			ps.toggle_particle_mode()
 		elif key == glfw.KEY_C:
 			ps.toggle_color_profile()
+		elif key == glfw.KEY_F12:
+			ps.dump_profile()
+		elif key == glfw.KEY_SPACE:
+			ps.toggle_replay_pause()
+		elif key == glfw.KEY_EQUAL:
+			ps.scale_emission_rate(EMISSION_RATE_FACTOR)
+		elif key == glfw.KEY_MINUS:
+			ps.scale_emission_rate(1.0 / EMISSION_RATE_FACTOR)
+		elif key == glfw.KEY_N:
+			ps.add_emitter()
+		elif key == glfw.KEY_BACKSPACE:
+			ps.remove_emitter()
+		elif key == glfw.KEY_B:
+			ps.toggle_blending()
+		elif key == glfw.KEY_F:
+			ps.toggle_force_field()
+
+	# Held keys scrub through a replay
+	if action in (glfw.PRESS, glfw.REPEAT):
+		if key == glfw.KEY_COMMA:
+			ps.step_replay(-1)
+		elif key == glfw.KEY_PERIOD:
+			ps.step_replay(1)
 
 def set_generator_position(ps, mouse_ndc_x, mouse_ndc_y):
 	mouse_camera_space = np.array([mouse_ndc_x / (2), mouse_ndc_y / (2), -1.0])
@@ -80,12 +112,12 @@ def set_generator_position(ps, mouse_ndc_x, mouse_ndc_y):
 	RAY_DIRECTION = mouse_camera_space[:3]
 	RAY_DIRECTION = RAY_DIRECTION / np.linalg.norm(RAY_DIRECTION)
 
-	DISTANCE_CAMERA_GENERATOR = np.linalg.norm(ps.generator_position[:3] - ps.camera.position)
+	DISTANCE_CAMERA_GENERATOR = np.linalg.norm(ps.core.generator_position[:3] - ps.camera.position)
 
 	new_position = ps.camera.position + DISTANCE_CAMERA_GENERATOR * RAY_DIRECTION
-	ps.generator_position[0] = new_position[0]
-	ps.generator_position[1] = new_position[1]
-	ps.generator_position[2] = new_position[2]
+	ps.core.generator_position[0] = new_position[0]
+	ps.core.generator_position[1] = new_position[1]
+	ps.core.generator_position[2] = new_position[2]
 
 def mouse_callback(window, pos_x, pos_y):
 	ps = glfw.get_window_user_pointer(window)
@@ -141,33 +173,128 @@ def get_perspective_projection(fov_degrees, aspect_ratio, near=0.1, far=100.0):
 
 class ParticleSystem:
 
-	def __init__(self, n_particles):
-		self.n_particles = n_particles
+	def __init__(self, n_particles, backend='opencl', is_pipelined=False, is_compact=False,
+			simulation_rate=DEFAULT_SIMULATION_RATE, is_interpolated=False, profile_filename=None, n_partitions=0,
+			recorder=None, replay=None, capture_directory=None, capture_every=1, capture_format='png', offscreen_frames=0,
+			emission_rate=None, depth_sort_every=0, is_additive=False, is_culled=False, lod_budget=0,
+			force_field=None, force_strength=None, trail_length=0, emitters_filename=None):
+		# Phases up to the first frame are timed, the texture is decoded and the kernels are built on workers meanwhile
+		self.startup = StartupTimer()
+		texture_levels = self.startup.submit('texture decode', TextureCache().load, path.join(path.dirname(__file__), TEXTURE_FILENAME))
 
-		self.generator_position = np.array( [0.0, 0.0, 0.0, 1.0], dtype=np.float32)
+		self.n_particles = n_particles
+		self.backend = backend
+
+		# Offscreen, a windowless context renders offscreen_frames frames into a framebuffer object.
+		# OpenCL can't share its buffers, so the state is uploaded like a host backend's.
+		self.is_offscreen = offscreen_frames > 0
+		self.offscreen_frames = offscreen_frames
+		self.is_host_upload = backend in HOST_BACKENDS or self.is_offscreen
+
+		# Emitting, particles that die wait for the emission rate, and only the live ones are drawn, indirectly.
+		# The pool is reallocated as it grows, which a single VBO set on a single device keeps simple.
+		self.is_emitting = emission_rate is not None and backend != 'replay'
+		self.n_live = 0
+
+		# Depth sorted, particles are drawn farthest first through an element buffer, fully sorted every
+		# depth_sort_every frames and refined by odd-even passes in between. Additive blending needs no order.
+		self.is_depth_sorted = depth_sort_every > 0
+		self.depth_sort_every = depth_sort_every
+		self.is_additive = is_additive
+		self.n_sorted_frames = 0
+		self.host_state = None
+
+		# Culled, only the particles on screen are drawn, and with a LOD budget only about that many per screen tile
+		self.is_culled = is_culled or lod_budget > 0
+		self.lod_budget = lod_budget
+
+		# With trails, the last trail_length positions of every particle are kept in a ring, on the device, and drawn
+		# as fading lines. OpenCL writes the ring in place, host backends upload one slot per step.
+		self.trail_length = trail_length
+		self.trail_head = 0
+		self.trail_textures = None
+
+		self.is_pipelined = is_pipelined and not self.is_host_upload and not self.is_emitting and not self.is_depth_sorted \
+			and not self.is_culled and not self.trail_length
+		if is_pipelined and not self.is_pipelined:
+			reasons = [ reason for reason, is_on in ( ('the ' + backend + ' backend', backend in HOST_BACKENDS),
+				('offscreen rendering', self.is_offscreen), ('emission', self.is_emitting), ('depth sorting', self.is_depth_sorted),
+				('culling', self.is_culled), ('trails', self.trail_length) ) if is_on ]
+			print(Style.BRIGHT + Fore.YELLOW + 'WARNING: ' + Style.RESET_ALL + Fore.RESET +
+				'--pipelined has no effect with ' + ', '.join(reasons))
+		self.is_compact = is_compact and not self.is_host_upload
+		self.is_interpolated = is_interpolated and not self.is_host_upload
+		self.n_partitions = n_partitions if not self.is_host_upload and not self.is_emitting and not self.trail_length else 0
 
 		self.is_perspective = True
-		self.spawn_in_cube = False
-		self.is_decaying = True
-		self.is_gravity_on = False
 		self.is_texture = False
 		self.is_shrinking = False
-		self.particle_mode_id = 0
-		self.color_profile_id = 0
 		self.point_size = 1
 
 		self.delta_time = 0.0
 		self.last_frame = 0.0
+		self.last_title_update = 0.0
+		self.n_title_frames = 0
+		self.n_rendered_frames = 0
+
+		# Phase timings of every frame, written to profile_filename on F12 and at exit
+		self.profile_filename = profile_filename
+		self.profiler = FrameProfiler(enabled=profile_filename is not None)
+
+		# Simulated time not consumed by fixed steps yet, and simulated so far
+		self.time_accumulator = 0.0
+		self.simulation_time = 0.0
+
+		# Every simulation step is streamed to the recorder, if any
+		self.recorder = recorder
 
 		self.last_mouse_pos_x = None	# will be initialized in mouse_callback
 		self.last_mouse_pos_y = None
 
-		self.__init_window()
-		self.__init_texture()
-		self.__init_gl_objects()
-		self.__init_cl_stuff()
-
-		self.shader = Shader(VERTEX_SHADER_FILENAME, FRAGMENT_SHADER_FILENAME)
+		with self.startup.phase('window'):
+			self.__init_window()
+		with self.startup.phase('gl objects'):
+			self.__init_gl_objects()
+
+		# Every k-th rendered frame is read back and encoded to capture_directory, if any
+		self.capture = None
+		if capture_directory is not None:
+			from capture import FrameCapture
+
+			with self.startup.phase('capture'):
+				self.capture = FrameCapture(capture_directory, SCREEN_WIDTH, SCREEN_HEIGHT, capture_every, capture_format)
+
+		with self.startup.phase('simulation'):
+			if self.backend == 'numpy':
+				from numpy_backend import NumpySimulation
+
+				self.core = NumpySimulation(self.n_particles)
+			elif self.backend == 'replay':
+				# Recorded frames go straight into the VBOs, nothing is simulated
+				self.core = replay
+			else:
+				self.__init_cl_stuff()
+			self.core.time_step = 1.0 / simulation_rate
+			if self.is_emitting:
+				self.core.emission_rate = float(emission_rate)
+
+			# Built on the first F, see toggle_force_field()
+			self.force_field_cycle = None
+			if self.backend != 'replay':
+				self.core.force_field = force_field
+				if force_strength is not None:
+					self.core.force_strength = force_strength
+				if emitters_filename is not None:
+					self.core.emitters.load(emitters_filename)
+
+			# Set up like the first frame will run, so the variant built meanwhile is the one init() uses
+			if self.backend == 'opencl':
+				self.core.prebuild_kernels(self.startup)
+
+		self.__init_texture(self.startup.wait('texture', texture_levels))
+		with self.startup.phase('shaders'):
+			self.shader = Shader(VERTEX_SHADER_FILENAME, FRAGMENT_SHADER_FILENAME)
+			self.trail_shader = self.__init_trail_shader() if self.trail_length else None
 		self.camera = Camera()
 
 		self.PERSPECTIVE_PROJECTION = get_perspective_projection(FOV_DEGREES, ASPECT_RATIO)
@@ -179,70 +306,345 @@ class ParticleSystem:
 
 		# glEnable(GL_DEPTH_TEST)		# THIS REALLY SLOWS DOWN FRAME RATE
 		glEnable(GL_BLEND)
-		glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
+		self.__set_blend_function()
 		glEnable(GL_VERTEX_PROGRAM_POINT_SIZE)
 		self.shader.set_float('point_size', float(self.point_size))
 		self.shader.set_bool('is_shrinking', self.is_shrinking)
+		self.shader.set_float('interpolation_alpha', 1.0)
 		glClearColor(0.0, 0.0, 0.0, 0.0)
 
 	def loop(self):
-		# Run __kernel init() once
-		cl.enqueue_acquire_gl_objects(self.queue, self.gl_buffers)
-		self.kernel.init(self.queue, (self.n_particles,), None,
-			*self.gl_buffers,
-			self.velocity_buffer,
-			self.seed_buffer,
-			self.generator_position,
-			np.int32(self.spawn_in_cube),
-			np.int32(self.particle_mode_id),
-			np.int32(self.color_profile_id))
-		cl.enqueue_release_gl_objects(self.queue, self.gl_buffers)
-		self.queue.finish()
+		# Run __kernel init() once, after the kernels built at startup
+		with self.startup.phase('kernels'):
+			self.core.init()
+			if self.is_interpolated:
+				# Zero substeps only fill in the previous positions
+				self.core.update(0)
+		self.__record_state(0)
+		if self.is_pipelined:
+			self.__loop_pipelined()
+			return
+		self.core.finish()
+		self.__publish_state()
+		self.__record_trail()
 		glFlush()
+		self.n_live = self.core.get_live_count()
+
+		while not self.__should_close():
+			self.profiler.begin_frame()
+			with self.profiler.phase('input'):
+				self.__update_frame_counter()
+				self.__process_key_input()
+				self.shader.set_matrix('view', self.camera.get_view_matrix())
+
+			# Run __kernel update() whenever fixed steps are due
+			with self.profiler.phase('compute'):
+				n_substeps = self.__advance_simulation_time()
+				if n_substeps:
+					self.core.update(n_substeps)
+					self.__record_state(n_substeps)
+					self.core.finish()
+					self.__publish_state()
+					self.__record_trail()
+					glFlush()
+					self.__grow_pool()
+			with self.profiler.phase('sort'):
+				self.__sort_by_depth()
+			with self.profiler.phase('cull'):
+				self.__cull()
+			self.profiler.add_events(self.core.pop_events())
 
-		while not glfw.window_should_close(self.window):
-			self.__update_frame_counter()
-			self.__process_key_input()
-			self.shader.set_matrix('view', self.camera.get_view_matrix())
-
-			# Run __kernel update() on each frame
-			cl.enqueue_acquire_gl_objects(self.queue, self.gl_buffers)
-			self.kernel.update(self.queue, (self.n_particles,), None,
-				*self.gl_buffers,
-				self.velocity_buffer,
-				self.seed_buffer,
-				self.generator_position,
-				np.int32(self.spawn_in_cube),
-				np.int32(self.is_decaying),
-				np.int32(self.is_gravity_on),
-				np.int32(self.particle_mode_id),
-				np.int32(self.color_profile_id))
-			cl.enqueue_release_gl_objects(self.queue, self.gl_buffers)
-			self.queue.finish()
-			glFlush()
+			# Render
+			self.__render()
+			self.__report_startup()
+			self.profiler.end_frame()
+
+		self.__finish()
+
+	# Frame N draws from one VBO set while OpenCL computes frame N+1 into the other.
+	# Only GL fences and CL events synchronize the two, no queue.finish() or glFlush() per frame.
+	# Frames without a due simulation step redraw the current set.
+	def __loop_pipelined(self):
+		fences = [ None ] * N_BUFFER_SETS
+		current = 0
+		publish_event = self.core.publish(current)
+
+		while not self.__should_close():
+			self.profiler.begin_frame()
+			with self.profiler.phase('input'):
+				self.__update_frame_counter()
+				self.__process_key_input()
+				self.shader.set_matrix('view', self.camera.get_view_matrix())
+
+			with self.profiler.phase('compute'):
+				# OpenGL must be done drawing a VBO set before OpenCL overwrites it
+				following = (current + 1) % N_BUFFER_SETS
+				n_substeps = self.__advance_simulation_time()
+				if n_substeps:
+					if not self.core.has_gl_event:
+						self.__wait_fence(fences[following])
+					self.core.update(n_substeps)
+					self.__record_state(n_substeps)
+					following_publish_event = self.core.publish(following)
+
+				# And OpenCL must be done publishing a VBO set before OpenGL draws it
+				if not self.core.has_gl_event:
+					publish_event.wait()
+			self.profiler.add_events(self.core.pop_events())
 
 			# Render
+			glBindVertexArray(self.vaos[current])
+			self.__render()
+			self.__report_startup()
+			if fences[current] is not None:
+				glDeleteSync(fences[current])
+			fences[current] = glFenceSync(GL_SYNC_GPU_COMMANDS_COMPLETE, 0)
+			self.profiler.end_frame()
+
+			if n_substeps:
+				current = following
+				publish_event = following_publish_event
+
+		self.core.finish()
+		self.__finish()
+
+	def __render(self):
+		with self.profiler.phase('clear'):
 			glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+
+		self.shader.upload_uniforms()
+		self.profiler.begin_gl_query('draw')
+		if self.trail_length:
+			self.__draw_trails()
+		if self.draw_buffers is not None:
+			glDrawElementsIndirect(GL_POINTS, GL_UNSIGNED_INT, ctypes.c_void_p(0))
+		else:
 			glDrawArrays(GL_POINTS, 0, self.n_particles)
+		self.profiler.end_gl_query()
+		self.n_rendered_frames += 1
+
+		# Before the swap, the back buffer still holds this frame
+		if self.capture is not None:
+			with self.profiler.phase('capture'):
+				self.capture.capture()
+		if self.is_offscreen:
+			return
+
+		with self.profiler.phase('swap'):
 			glfw.swap_buffers(self.window)
+		with self.profiler.phase('input'):
 			glfw.poll_events()
 
+	def __report_startup(self):
+		if self.startup is None:
+			return
+		self.startup.report()
+		self.startup = None
+
+	# trail_length - 1 line segments per particle, their vertices fetched by the trail shader from gl_VertexID
+	def __draw_trails(self):
+		self.trail_shader.use()
+		self.trail_shader.set_int('trail_head', self.trail_head if self.is_host_upload else self.core.trail_head)
+		self.trail_shader.set_int('n_particles', self.n_particles)
+		glBindVertexArray(self.trail_vao)
+		glDrawArrays(GL_LINES, 0, 2 * (self.trail_length - 1) * self.n_particles)
+		glBindVertexArray(self.vao)
+		self.shader.use()
+
+	# Host backends write the step just published into the next trail slot, OpenCL writes its own in update
+	def __record_trail(self):
+		if not self.trail_length or not self.is_host_upload:
+			return
+		position, lifetime = self.host_state[0], self.host_state[2]
+		sample = np.ascontiguousarray(np.c_[position[:, :3], lifetime], dtype=np.float32)
+		self.trail_head = (self.trail_head + 1) % self.trail_length
+		glBindBuffer(GL_ARRAY_BUFFER, self.trail_buffer)
+		glBufferSubData(GL_ARRAY_BUFFER, self.trail_head * sample.nbytes, sample.nbytes, sample)
+
+	def __should_close(self):
+		if self.is_offscreen:
+			return self.n_rendered_frames >= self.offscreen_frames
+		return glfw.window_should_close(self.window)
+
+	def dump_profile(self):
+		if self.profiler.enabled:
+			self.profiler.dump(self.profile_filename)
+
+	def __finish(self):
+		if self.profiler.enabled:
+			self.profiler.report()
+			self.profiler.dump(self.profile_filename)
+		if self.recorder is not None:
+			self.recorder.close()
+		if self.capture is not None:
+			self.capture.close()
+
+	# Readback of the state after the steps just enqueued, it overlaps with the next frame
+	def __record_state(self, n_substeps):
+		self.simulation_time += n_substeps * self.core.time_step
+		if self.recorder is not None:
+			self.recorder.capture(self.core, self.simulation_time)
+
+	def toggle_replay_pause(self):
+		if self.backend != 'replay':
+			return
+		self.core.toggle_pause()
+		print(Style.BRIGHT + 'Replay: 	' + Style.RESET_ALL, ('Paused' if self.core.is_paused else 'Playing'))
+
+	def step_replay(self, offset):
+		if self.backend != 'replay':
+			return
+		if not self.core.is_paused:
+			self.core.toggle_pause()
+		self.core.seek(self.core.frame_index + offset)
+		self.__publish_state()
+		glFlush()
+		print(Style.BRIGHT + 'Replay frame: 	' + Style.RESET_ALL, '%d / %d' % (self.core.frame_index + 1, self.core.n_frames))
+
+	# Emission that found fewer dead particles than were due doubles the pool.
+	# Not while recording, a recording keeps one particle count.
+	def __grow_pool(self):
+		if not self.is_emitting:
+			return
+		n_dead = self.n_particles - self.n_live
+		self.n_live = self.core.get_live_count()
+		if self.core.n_emit > n_dead and self.n_particles < MAX_POOL_CAPACITY and self.recorder is None:
+			self.resize_pool(min(self.n_particles * 2, MAX_POOL_CAPACITY))
+
+	# Reallocate the VBOs and the simulation for n_particles, keeping the particles both counts have
+	def resize_pool(self, n_particles):
+		self.core.finish()
+		glFinish()
+		old_vaos, old_vbo_sets, old_draw_buffers = self.vaos, self.vbo_sets, self.draw_buffers
+		old_trail_buffers = () if self.trail_buffer is None else (self.trail_buffer,)
+
+		self.n_particles = n_particles
+		self.__init_gl_objects()
+		if self.is_host_upload:
+			self.core.resize(n_particles)
+			self.__publish_state()
+		else:
+			self.core.resize(n_particles, self.vbo_sets, self.draw_buffers, self.trail_buffer)
+		self.n_live = self.core.get_live_count()
+
+		glDeleteVertexArrays(len(old_vaos), old_vaos)
+		old_buffers = [ int(buffer) for vbos in old_vbo_sets for buffer in vbos ] + [ int(buffer) for buffer in old_draw_buffers or () ] + \
+			[ int(buffer) for buffer in old_trail_buffers ]
+		glDeleteBuffers(len(old_buffers), old_buffers)
+		print(Style.BRIGHT + 'Pool: \t\t' + Style.RESET_ALL, '%d particles' % n_particles)
+
+	def scale_emission_rate(self, factor):
+		if not self.is_emitting:
+			return
+		self.core.emission_rate *= factor
+		print(Style.BRIGHT + 'Emission: \t' + Style.RESET_ALL, '%.0f particles/s' % self.core.emission_rate)
+
+	# A new emitter where the generator is, with its current particle mode, color profile and spawn shape
+	def add_emitter(self):
+		if self.backend == 'replay':
+			return
+		if not is_emitter_mode(self.core.particle_mode_id):
+			print(Style.BRIGHT + 'Emitters: \t' + Style.RESET_ALL, 'Not in ' + self.__get_mode_names()[self.core.particle_mode_id] + ' mode')
+			return
+		emitters = self.core.emitters
+		if len(emitters) == MAX_EMITTERS:
+			return
+		emitters.add(self.core.generator_position, self.core.particle_mode_id, self.core.color_profile_id, self.core.spawn_in_cube)
+		print(Style.BRIGHT + 'Emitters: \t' + Style.RESET_ALL, len(emitters))
+
+	def remove_emitter(self):
+		if self.backend == 'replay' or len(self.core.emitters) == 1:
+			return
+		self.core.emitters.remove(len(self.core.emitters) - 1)
+		print(Style.BRIGHT + 'Emitters: \t' + Style.RESET_ALL, len(self.core.emitters))
+
+	# Back to front for the current view, the camera moves even when the simulation doesn't
+	def __sort_by_depth(self):
+		if not self.__is_sorting() or self.is_host_upload:
+			return
+
+		# Emission changes which particles are live every step, so every frame is a full sort
+		is_full = self.n_sorted_frames % self.depth_sort_every == 0 or self.is_emitting
+		self.core.sort_by_depth(self.camera.get_view_matrix()[2].astype(np.float32), is_full, ODD_EVEN_PASSES, self.is_culled)
+		self.core.finish()
+		self.n_sorted_frames += 1
+
+	# Only what is on screen goes into the indirect draw, in sorted order when sorting
+	def __cull(self):
+		if self.is_host_upload:
+			if self.is_culled or self.__is_sorting():
+				self.__upload_draw_indices()
+			return
+		if not self.is_culled:
+			return
+
+		view_projection = self.__get_projection_matrix() @ self.camera.get_view_matrix()
+		self.core.cull(view_projection, (SCREEN_WIDTH, SCREEN_HEIGHT), self.point_size, self.lod_budget, self.__is_sorting())
+		self.core.finish()
+
+	def __is_sorting(self):
+		return self.is_depth_sorted and not self.is_additive
+
+	# Fixed timestep accumulator, returns how many simulation steps are due this frame
+	def __advance_simulation_time(self):
+		time_step = self.core.time_step
+		self.time_accumulator += min(self.delta_time, MAX_FRAME_TIME)
+
+		n_substeps = min(int(self.time_accumulator / time_step), MAX_SUBSTEPS)
+		self.time_accumulator -= n_substeps * time_step
+		if n_substeps == MAX_SUBSTEPS:
+			# Too far behind, drop the backlog instead of spiraling
+			self.time_accumulator = min(self.time_accumulator, time_step)
+
+		# Render between the last two steps, by the fraction of a step left over
+		if self.is_interpolated:
+			self.shader.set_float('interpolation_alpha', self.time_accumulator / time_step)
+		return n_substeps
+
+	def __wait_fence(self, fence):
+		if fence is None:
+			return
+		while glClientWaitSync(fence, GL_SYNC_FLUSH_COMMANDS_BIT, SYNC_TIMEOUT_NS) == GL_TIMEOUT_EXPIRED:
+			pass
+
+	def toggle_blending(self):
+		self.is_additive = not self.is_additive
+		self.__set_blend_function()
+		print(Style.BRIGHT + 'Blending: \t' + Style.RESET_ALL, ('Additive' if self.is_additive else
+			'Alpha, depth sorted' if self.is_depth_sorted else 'Alpha'))
+
+	def __set_blend_function(self):
+		glBlendFunc(GL_SRC_ALPHA, GL_ONE if self.is_additive else GL_ONE_MINUS_SRC_ALPHA)
+
+	def toggle_force_field(self):
+		if self.backend == 'replay':
+			return
+		if self.force_field_cycle is None:
+			from force_field import FIELD_KINDS
+
+			# No field, the built-in ones and the one given at startup, if it was loaded from a file
+			given = self.core.force_field
+			self.force_field_cycle = (None,) + FIELD_KINDS + (() if given in (None,) + FIELD_KINDS else (given,))
+		cycle = self.force_field_cycle
+		self.core.force_field = cycle[(cycle.index(self.core.force_field) + 1) % len(cycle)]
+		print(Style.BRIGHT + 'Force field: \t' + Style.RESET_ALL, (self.core.force_field or 'Off'))
+
 	def toggle_projection_mode(self):
 		self.is_perspective = not self.is_perspective
 		self.shader.set_matrix('projection', self.__get_projection_matrix())
 		print(Style.BRIGHT + 'Projection: \t' + Style.RESET_ALL, ('Perspective' if self.is_perspective else 'Orthographic'))
 
 	def toggle_spawn_location(self):
-		self.spawn_in_cube = not self.spawn_in_cube
-		print(Style.BRIGHT + 'Spawn in: \t' + Style.RESET_ALL, ('Cube' if self.spawn_in_cube else 'Sphere'))
+		self.core.spawn_in_cube = not self.core.spawn_in_cube
+		print(Style.BRIGHT + 'Spawn in: \t' + Style.RESET_ALL, ('Cube' if self.core.spawn_in_cube else 'Sphere'))
 
 	def toggle_lifetime(self):
-		self.is_decaying = not self.is_decaying
-		print(Style.BRIGHT + 'Life decay: \t' + Style.RESET_ALL, ('On' if self.is_decaying else 'Off'))
+		self.core.is_decaying = not self.core.is_decaying
+		print(Style.BRIGHT + 'Life decay: \t' + Style.RESET_ALL, ('On' if self.core.is_decaying else 'Off'))
 
 	def toggle_gravity(self):
-		self.is_gravity_on = not self.is_gravity_on
-		print(Style.BRIGHT + 'Gravity mod: \t' + Style.RESET_ALL, ('On' if self.is_gravity_on else 'Off'))
+		self.core.is_gravity_on = not self.core.is_gravity_on
+		print(Style.BRIGHT + 'Gravity mod: \t' + Style.RESET_ALL, ('On' if self.core.is_gravity_on else 'Off'))
 
 	def toggle_texture(self):
 		self.is_texture = not self.is_texture
@@ -254,24 +656,75 @@ class ParticleSystem:
 		self.shader.set_bool('is_shrinking', self.is_shrinking)
 		print(Style.BRIGHT + 'Shrinking: \t' + Style.RESET_ALL, ('On' if self.is_shrinking else 'Off'))
 		
+	# Custom modes are OpenCL C, only that backend cycles through them after the built-in ones
+	def __get_mode_names(self):
+		if self.backend == 'opencl':
+			return PARTICLE_MODES + custom_modes.get_names()
+		return PARTICLE_MODES
+
 	def toggle_particle_mode(self):
-		self.particle_mode_id = (self.particle_mode_id + 1) % len(PARTICLE_MODES)
-		print(Style.BRIGHT + Fore.BLUE + 'Particle Mode: \t' + Fore.RESET + Style.RESET_ALL, PARTICLE_MODES[self.particle_mode_id])
+		mode_names = self.__get_mode_names()
+		self.core.particle_mode_id = (self.core.particle_mode_id + 1) % len(mode_names)
+		print(Style.BRIGHT + Fore.BLUE + 'Particle Mode: \t' + Fore.RESET + Style.RESET_ALL, mode_names[self.core.particle_mode_id])
 
 	def toggle_color_profile(self):
-		self.color_profile_id = (self.color_profile_id + 1) % len(COLOR_PROFILES)
-		print(Style.BRIGHT + Fore.GREEN + 'Color Profile: \t' + Fore.RESET + Style.RESET_ALL, COLOR_PROFILES[self.color_profile_id])
+		self.core.color_profile_id = (self.core.color_profile_id + 1) % len(COLOR_PROFILES)
+		print(Style.BRIGHT + Fore.GREEN + 'Color Profile: \t' + Fore.RESET + Style.RESET_ALL, COLOR_PROFILES[self.core.color_profile_id])
 
 		# Run __kernel change_color()
-		cl.enqueue_acquire_gl_objects(self.queue, self.gl_buffers)
-		self.kernel.change_color(self.queue, (self.n_particles,), None,
-			self.color_buffer,
-			self.seed_buffer,
-			np.int32(self.color_profile_id))
-		cl.enqueue_release_gl_objects(self.queue, self.gl_buffers)
-		self.queue.finish()
+		self.core.change_color()
+		self.core.finish()
+		self.__publish_state()
 		glFlush()
 
+	# Backends that don't update the VBOs in place copy their state into them.
+	# Host-side and offscreen backends can't share buffers with OpenGL, partitioned ones keep state in plain buffers.
+	def __publish_state(self):
+		if self.is_host_upload:
+			state = self.core.read_state()
+			self.host_state = state
+			for vbo, data in zip(self.vbo_sets[0], state):
+				glBindBuffer(GL_ARRAY_BUFFER, vbo)
+				glBufferSubData(GL_ARRAY_BUFFER, 0, data.nbytes, data)
+			if self.is_emitting:
+				self.__upload_live_indices(state[2])
+		elif self.n_partitions and not self.is_pipelined:
+			self.core.publish(0)
+			self.core.finish()
+
+	# Host-side compaction, the indices of the particles with lifetime left and their count
+	def __upload_live_indices(self, lifetime):
+		live_indices = np.flatnonzero(lifetime > 0.0).astype(np.uint32)
+		glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, self.draw_buffers[0])
+		glBufferSubData(GL_ELEMENT_ARRAY_BUFFER, 0, live_indices.nbytes, live_indices)
+		glBindBuffer(GL_DRAW_INDIRECT_BUFFER, self.draw_buffers[1])
+		glBufferSubData(GL_DRAW_INDIRECT_BUFFER, 0, 4, np.array([ len(live_indices) ], dtype=np.uint32))
+
+	# Host-side culling and depth sort: the particles on screen (or live), farthest first when sorting,
+	# then the dead ones when every particle is drawn
+	def __upload_draw_indices(self):
+		position, lifetime = self.host_state[0], self.host_state[2]
+		view = self.camera.get_view_matrix()
+		if self.is_culled:
+			from frustum_cull import get_visible
+
+			is_drawn = get_visible(position, lifetime, self.__get_projection_matrix() @ view, (SCREEN_WIDTH, SCREEN_HEIGHT),
+				self.point_size, self.lod_budget)
+		else:
+			is_drawn = lifetime > 0.0
+
+		indices = np.flatnonzero(is_drawn)
+		if self.__is_sorting():
+			indices = indices[np.argsort(position[indices, :3] @ view[2, :3].astype(np.float32), kind='stable')]
+		if not self.is_emitting and not self.is_culled:
+			indices = np.concatenate((indices, np.flatnonzero(~is_drawn)))
+		indices = indices.astype(np.uint32)
+
+		glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, self.draw_buffers[0])
+		glBufferSubData(GL_ELEMENT_ARRAY_BUFFER, 0, indices.nbytes, indices)
+		glBindBuffer(GL_DRAW_INDIRECT_BUFFER, self.draw_buffers[1])
+		glBufferSubData(GL_DRAW_INDIRECT_BUFFER, 0, 4, np.array([ len(indices) ], dtype=np.uint32))
+
 	def __adjust_point_size(self, offset):
 		self.point_size += offset
 		if self.point_size < 1:
@@ -282,15 +735,27 @@ class ParticleSystem:
 		return self.PERSPECTIVE_PROJECTION if self.is_perspective else self.ORTHOGRAPHIC_PROJECTION
 
 	def __update_frame_counter(self):
+		if self.is_offscreen:
+			self.delta_time = 1.0 / OFFSCREEN_FRAME_RATE
+			return
+
 		current_frame = glfw.get_time()
 		self.delta_time = current_frame - self.last_frame
 		self.last_frame = current_frame
 
-		fps = 1.0 / self.delta_time
-		glfw.set_window_title(self.window, 'Particle System (FPS: %.0f)' % fps)
+		# Setting the title costs host time too, only refresh it a few times per second
+		self.n_title_frames += 1
+		if current_frame - self.last_title_update >= TITLE_INTERVAL:
+			fps = self.n_title_frames / (current_frame - self.last_title_update)
+			glfw.set_window_title(self.window, 'Particle System (FPS: %.0f)' % fps)
+			self.last_title_update = current_frame
+			self.n_title_frames = 0
 		
 	# Check key states for held key inputs
 	def __process_key_input(self):
+		if self.is_offscreen:
+			return
+
 		CAMERA_SPEED = 2.5 * self.delta_time
 
 		# Move camera
@@ -315,19 +780,25 @@ class ParticleSystem:
 
 		# Move generator position
 		if glfw.get_key(self.window, glfw.KEY_LEFT) == glfw.PRESS:
-			self.generator_position -= np.array([*self.camera.local_right, 0.0]) * 0.02
+			self.core.generator_position -= np.array([*self.camera.local_right, 0.0]) * 0.02
 		if glfw.get_key(self.window, glfw.KEY_RIGHT) == glfw.PRESS:
-			self.generator_position += np.array([*self.camera.local_right, 0.0]) * 0.02
+			self.core.generator_position += np.array([*self.camera.local_right, 0.0]) * 0.02
 		if glfw.get_key(self.window, glfw.KEY_DOWN) == glfw.PRESS:
-			self.generator_position -= np.array([*self.camera.local_up, 0.0]) * 0.02
+			self.core.generator_position -= np.array([*self.camera.local_up, 0.0]) * 0.02
 		if glfw.get_key(self.window, glfw.KEY_UP) == glfw.PRESS:
-			self.generator_position += np.array([*self.camera.local_up, 0.0]) * 0.02
+			self.core.generator_position += np.array([*self.camera.local_up, 0.0]) * 0.02
 		if glfw.get_key(self.window, glfw.KEY_HOME) == glfw.PRESS:
-			self.generator_position -= np.array([*self.camera.local_front, 0.0]) * 0.02
+			self.core.generator_position -= np.array([*self.camera.local_front, 0.0]) * 0.02
 		if glfw.get_key(self.window, glfw.KEY_END) == glfw.PRESS:
-			self.generator_position += np.array([*self.camera.local_front, 0.0]) * 0.02
+			self.core.generator_position += np.array([*self.camera.local_front, 0.0]) * 0.02
 
 	def __init_window(self):
+		if self.is_offscreen:
+			from capture import OffscreenTarget
+
+			self.offscreen_target = OffscreenTarget(SCREEN_WIDTH, SCREEN_HEIGHT)
+			return
+
 		if not glfw.init():
 			raise ParticleSystemException('glfw.init() failed')
 
@@ -350,50 +821,153 @@ class ParticleSystem:
 		glfw.set_key_callback(self.window, key_callback)
 		glfw.set_cursor_pos_callback(self.window, mouse_callback)
 
-	def __init_texture(self):
-		base_path = path.dirname(__file__)
-		file_path = path.join(base_path, TEXTURE_FILENAME)
-		im = Image.open(file_path)
-		im_data = np.fromstring(im.tobytes(), np.uint8)
-
+	# Mipmap levels from the texture cache, uploaded as they are, small particles sample the smaller levels
+	def __init_texture(self, levels):
 		texture_loc = glGenTextures(1)
 		glBindTexture(GL_TEXTURE_2D, texture_loc)
 		glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_REPEAT)
 		glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_REPEAT)
-		glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
+		glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR_MIPMAP_LINEAR)
 		glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
-		glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA, im.size[0], im.size[1], 0, GL_RGBA, GL_UNSIGNED_BYTE, im_data);
+		glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAX_LEVEL, len(levels) - 1)
+		for level, pixels in enumerate(levels):
+			glTexImage2D(GL_TEXTURE_2D, level, GL_RGBA, pixels.shape[1], pixels.shape[0], 0, GL_RGBA, GL_UNSIGNED_BYTE, pixels)
 
 	def __init_gl_objects(self):
-		# One VAO to RULE THEM ALL
-		self.vao = glGenVertexArrays(1)
+		# One VAO to RULE THEM ALL, per VBO set
+		self.vaos = []
+		self.vbo_sets = []
+		for _ in range(N_BUFFER_SETS if self.is_pipelined else 1):
+			vao, vbos = self.__init_vbo_set()
+			self.vaos.append(vao)
+			self.vbo_sets.append(vbos)
+
+		self.vao = self.vaos[0]
 		glBindVertexArray(self.vao)
+		self.draw_buffers = self.__init_draw_buffers() if self.is_emitting or self.is_depth_sorted or self.is_culled else None
+		self.trail_buffer = self.__init_trail_buffer() if self.trail_length else None
+
+	# Element buffer of the live, visible or depth sorted particle indices, bound to the VAO, and the indirect command drawing them
+	def __init_draw_buffers(self):
+		index_buffer, command_buffer = glGenBuffers(2)
+		glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, index_buffer)
+		indices = None if self.is_emitting else np.arange(self.n_particles, dtype=np.uint32)
+		glBufferData(GL_ELEMENT_ARRAY_BUFFER, ctypes.sizeof(_types.GLuint) * self.n_particles, indices, GL_DYNAMIC_DRAW)
+
+		# count, instance count, first index, base vertex, base instance. Emitting or culling, OpenCL writes count.
+		command = np.array([ 0 if self.is_emitting else self.n_particles, 1, 0, 0, 0 ], dtype=np.uint32)
+		glBindBuffer(GL_DRAW_INDIRECT_BUFFER, command_buffer)
+		glBufferData(GL_DRAW_INDIRECT_BUFFER, command.nbytes, command, GL_DYNAMIC_DRAW)
+		return index_buffer, command_buffer
+
+	# The trail ring, zeroed so the slots not written yet draw nothing, read by the trail shader as a buffer texture
+	def __init_trail_buffer(self):
+		trail_buffer = glGenBuffers(1)
+		glBindBuffer(GL_ARRAY_BUFFER, trail_buffer)
+		glBufferData(GL_ARRAY_BUFFER, np.zeros(self.trail_length * self.n_particles * TRAIL_SAMPLE_FLOATS, dtype=np.float32),
+			GL_DYNAMIC_DRAW)
+		if self.trail_textures is None:
+			self.trail_textures = glGenTextures(2)
+			self.trail_vao = glGenVertexArrays(1)
+
+		# Colors come straight from the particle VBOs, the color VBO or the compact vertices
+		color_vbo, color_format = (self.vbo_sets[0][0], GL_R32F) if self.is_compact else (self.vbo_sets[0][1], GL_RGBA32F)
+		for unit, texture, buffer, texture_format in ((TRAIL_TEXTURE_UNIT, self.trail_textures[0], trail_buffer, GL_RGBA32F),
+				(TRAIL_COLOR_TEXTURE_UNIT, self.trail_textures[1], color_vbo, color_format)):
+			glActiveTexture(GL_TEXTURE0 + unit)
+			glBindTexture(GL_TEXTURE_BUFFER, texture)
+			glTexBuffer(GL_TEXTURE_BUFFER, texture_format, buffer)
+		glActiveTexture(GL_TEXTURE0)
+		return trail_buffer
+
+	# Shares the particle shader's Frame block, which stays the program in use
+	def __init_trail_shader(self):
+		trail_shader = Shader(TRAIL_VERTEX_SHADER_FILENAME, TRAIL_FRAGMENT_SHADER_FILENAME, frame_source=self.shader)
+		trail_shader.set_int('trail', TRAIL_TEXTURE_UNIT)
+		trail_shader.set_int('colors', TRAIL_COLOR_TEXTURE_UNIT)
+		trail_shader.set_int('trail_length', self.trail_length)
+		trail_shader.set_bool('is_compact', self.is_compact)
+		self.shader.use()
+		return trail_shader
+
+	def __init_vbo_set(self):
+		vao = glGenVertexArrays(1)
+		glBindVertexArray(vao)
+
+		if self.is_compact:
+			return vao, self.__init_compact_vbos() + self.__init_previous_position_vbos()
 
 		# Position VBO
-		self.position_vbo = glGenBuffers(1)
-		glBindBuffer(GL_ARRAY_BUFFER, self.position_vbo)
+		position_vbo = glGenBuffers(1)
+		glBindBuffer(GL_ARRAY_BUFFER, position_vbo)
 		glBufferData(GL_ARRAY_BUFFER, ctypes.sizeof(_types.GLfloat) * 4 * self.n_particles, None, GL_DYNAMIC_DRAW)
 		glVertexAttribPointer(0, 4, GL_FLOAT, GL_FALSE, 4 * ctypes.sizeof(_types.GLfloat), None)
 		glEnableVertexAttribArray(0)
 
 		# Color VBO
-		self.color_vbo = glGenBuffers(1)
-		glBindBuffer(GL_ARRAY_BUFFER, self.color_vbo)
+		color_vbo = glGenBuffers(1)
+		glBindBuffer(GL_ARRAY_BUFFER, color_vbo)
 		glBufferData(GL_ARRAY_BUFFER, ctypes.sizeof(_types.GLfloat) * 4 * self.n_particles, None, GL_DYNAMIC_DRAW)
 		glVertexAttribPointer(1, 4, GL_FLOAT, GL_FALSE, 4 * ctypes.sizeof(_types.GLfloat), None)
 		glEnableVertexAttribArray(1)
 
 		# Lifetime VBO
-		self.lifetime_vbo = glGenBuffers(1)
-		glBindBuffer(GL_ARRAY_BUFFER, self.lifetime_vbo)
+		lifetime_vbo = glGenBuffers(1)
+		glBindBuffer(GL_ARRAY_BUFFER, lifetime_vbo)
 		glBufferData(GL_ARRAY_BUFFER, ctypes.sizeof(_types.GLfloat) * 1 * self.n_particles, None, GL_DYNAMIC_DRAW)
 		glVertexAttribPointer(2, 1, GL_FLOAT, GL_FALSE, 1 * ctypes.sizeof(_types.GLfloat), None)
 		glEnableVertexAttribArray(2)
 
+		return vao, (position_vbo, color_vbo, lifetime_vbo) + self.__init_previous_position_vbos()
+
+	# Positions before the last substep as packed vec3, for interpolated rendering
+	def __init_previous_position_vbos(self):
+		if not self.is_interpolated:
+			return ()
+
+		previous_position_vbo = glGenBuffers(1)
+		glBindBuffer(GL_ARRAY_BUFFER, previous_position_vbo)
+		glBufferData(GL_ARRAY_BUFFER, ctypes.sizeof(_types.GLfloat) * 3 * self.n_particles, None, GL_DYNAMIC_DRAW)
+		glVertexAttribPointer(3, 3, GL_FLOAT, GL_FALSE, 3 * ctypes.sizeof(_types.GLfloat), None)
+		glEnableVertexAttribArray(3)
+
+		return (previous_position_vbo,)
+
+	# One interleaved VBO of { position.xyz, lifetime, RGBA8 color } vertices, 20 bytes each.
+	# Attribute 0 reads lifetime as position.w, which the vertex shader ignores.
+	def __init_compact_vbos(self):
+		FLOAT_SIZE = ctypes.sizeof(_types.GLfloat)
+		STRIDE = VERTEX_FLOATS * FLOAT_SIZE
+
+		vertex_vbo = glGenBuffers(1)
+		glBindBuffer(GL_ARRAY_BUFFER, vertex_vbo)
+		glBufferData(GL_ARRAY_BUFFER, STRIDE * self.n_particles, None, GL_DYNAMIC_DRAW)
+
+		glVertexAttribPointer(0, 4, GL_FLOAT, GL_FALSE, STRIDE, ctypes.c_void_p(0))
+		glEnableVertexAttribArray(0)
+		glVertexAttribPointer(1, 4, GL_UNSIGNED_BYTE, GL_TRUE, STRIDE, ctypes.c_void_p(4 * FLOAT_SIZE))
+		glEnableVertexAttribArray(1)
+		glVertexAttribPointer(2, 1, GL_FLOAT, GL_FALSE, STRIDE, ctypes.c_void_p(3 * FLOAT_SIZE))
+		glEnableVertexAttribArray(2)
+
+		return (vertex_vbo,)
+
 	def __init_cl_stuff(self):
+		if self.is_offscreen:
+			# Any OpenCL device, its state is read back every step
+			self.core = SimulationCore(self.n_particles, profiling=self.profiler.enabled, defer_build=True)
+			return
+
 		# Figure out platform and device
 		platform = cl.get_platforms()[0]
-		if sys.platform == "darwin":
+		if self.n_partitions:
+			# Several devices or sub-devices, each simulating its own range of particles
+			from device_partition import get_partition_devices
+
+			devices = get_partition_devices(self.n_partitions)
+			self.context = cl.Context(properties=[(cl.context_properties.PLATFORM, devices[0].platform)] +
+				get_gl_sharing_context_properties(), devices=devices)
+		elif sys.platform == "darwin":
 			self.context = cl.Context(properties=get_gl_sharing_context_properties(), devices=[])
 		else:
 			# Some OSs prefer clCreateContextFromType, some prefer clCreateContext. Try both.
@@ -403,26 +977,8 @@ class ParticleSystem:
 				self.context = cl.Context(properties=[(cl.context_properties.PLATFORM, platform)] + get_gl_sharing_context_properties(),
 					devices = [platform.get_devices()[0]])
 
-		print(Style.BRIGHT + 'DEVICE: \t' + Style.RESET_ALL, self.context.devices[0])
-		print(Style.BRIGHT + 'VERSION: \t' + Style.RESET_ALL, self.context.devices[0].get_info(cl.device_info.VERSION))
-
-		# Make OpenCL buffers, one for each OpenGL VBO
-		self.position_buffer = cl.GLBuffer(self.context, cl.mem_flags.READ_WRITE, int(self.position_vbo))
-		self.color_buffer = cl.GLBuffer(self.context, cl.mem_flags.READ_WRITE, int(self.color_vbo))
-		self.lifetime_buffer = cl.GLBuffer(self.context, cl.mem_flags.READ_WRITE, int(self.lifetime_vbo))
-		self.gl_buffers = ( self.position_buffer, self.color_buffer, self.lifetime_buffer )
-
-		# Make other OpenCL buffers
-		self.seed_buffer = cl.Buffer(self.context, cl.mem_flags.READ_WRITE, self.n_particles * 8)			# buffer of ulong
-		self.velocity_buffer = cl.Buffer(self.context, cl.mem_flags.READ_WRITE, self.n_particles * 4 * 4)	# buffer of float4
-
-		# Compile kernel program
-		try:
-			program_src = file_to_string(KERNEL_FILENAME)
-			self.kernel = cl.Program(self.context, program_src).build()
-		except cl.RuntimeError as e:
-			raise ParticleSystemException('Error compiling ' + KERNEL_FILENAME + '\n' + str(e))
-
-		# Will need a command queue to run kernel
-		self.queue = cl.CommandQueue(self.context)
-
+		# The simulation core wraps each OpenGL VBO as an OpenCL buffer
+		self.core = SimulationCore(self.n_particles, self.context, self.vbo_sets, profiling=self.profiler.enabled,
+			compact=self.is_compact, interpolate=self.is_interpolated, partition=bool(self.n_partitions),
+			gl_draw_buffers=self.draw_buffers, gl_trail_buffer=self.trail_buffer, defer_build=True)
+		self.core.trail_length = self.trail_length
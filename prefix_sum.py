@@ -0,0 +1,53 @@
+import pyopencl as cl
+import numpy as np
+
+from exceptions import ParticleSystemException
+from file_to_string import file_to_string
+
+SCAN_KERNEL_FILENAME = 'kernels/scan.cl'
+
+MAX_WORK_GROUP_SIZE = 256
+
+
+# Exclusive prefix sum of uint buffers on the device, with scratch buffers kept per size
+class PrefixSum:
+
+	def __init__(self, context, program_cache):
+		self.context = context
+		try:
+			program = program_cache.build(context, file_to_string(SCAN_KERNEL_FILENAME))
+		except cl.RuntimeError as e:
+			raise ParticleSystemException('Error compiling ' + SCAN_KERNEL_FILENAME + '\n' + str(e))
+
+		self.scan_blocks = cl.Kernel(program, 'scan_blocks')
+		self.add_block_sums = cl.Kernel(program, 'add_block_sums')
+
+		# Largest power of two the device and kernel allow
+		device = context.devices[0]
+		limit = min(MAX_WORK_GROUP_SIZE, device.max_work_group_size,
+			self.scan_blocks.get_work_group_info(cl.kernel_work_group_info.WORK_GROUP_SIZE, device))
+		self.work_group_size = 1 << (limit.bit_length() - 1)
+		self.block_size = 2 * self.work_group_size
+
+		self.__block_sums = {}
+
+	# output[i] = sum of input[:i], for the first n uints. Returns the last event.
+	def __call__(self, queue, input_buffer, output_buffer, n, wait_for=None):
+		n_blocks = (n + self.block_size - 1) // self.block_size
+		block_sums, block_offsets = self.__get_block_sums(n_blocks)
+
+		event = self.scan_blocks(queue, (n_blocks * self.work_group_size,), (self.work_group_size,),
+			input_buffer, output_buffer, block_sums, np.uint32(n), cl.LocalMemory(self.block_size * 4),
+			wait_for=wait_for)
+		if n_blocks == 1:
+			return event
+
+		self(queue, block_sums, block_offsets, n_blocks)
+		return self.add_block_sums(queue, (n,), None, output_buffer, block_offsets, np.uint32(n), np.uint32(self.block_size))
+
+	def __get_block_sums(self, n_blocks):
+		buffers = self.__block_sums.get(n_blocks)
+		if buffers is None:
+			buffers = tuple(cl.Buffer(self.context, cl.mem_flags.READ_WRITE, n_blocks * 4) for _ in range(2))
+			self.__block_sums[n_blocks] = buffers
+		return buffers
@@ -0,0 +1,111 @@
+import pyopencl as cl
+import hashlib
+import os
+import struct
+
+import disk_cache
+
+CACHE_DIRECTORY = disk_cache.get_cache_directory('programs')
+
+# Total size of the entries, beyond it the least recently used are evicted. About 0.4 MB per variant with pocl,
+# so several full benchmark sweeps fit. The environment variable overrides it, in megabytes.
+DEFAULT_CACHE_MEGABYTES = 256
+CACHE_SIZE_VARIABLE = 'PARTICLE_SYSTEM_CACHE_MB'
+
+# Entry file: magic, sha256 of the payload, then payload = device count + (length, binary) per device
+CACHE_MAGIC = b'PSCLBIN1'
+CACHE_SUFFIX = '.bin'
+
+
+def get_max_cache_bytes():
+	try:
+		return int(float(os.environ.get(CACHE_SIZE_VARIABLE, DEFAULT_CACHE_MEGABYTES)) * (1 << 20))
+	except ValueError:
+		return DEFAULT_CACHE_MEGABYTES << 20
+
+def get_cache_key(context, source, options):
+	digest = hashlib.sha256()
+	digest.update(source.encode())
+	for device in context.devices:
+		digest.update(b'\0' + device.name.encode())
+		digest.update(b'\0' + device.driver_version.encode())
+		digest.update(b'\0' + device.platform.version.encode())
+	for option in options:
+		digest.update(b'\0' + option.encode())
+	return digest.hexdigest()
+
+def pack_binaries(binaries):
+	payload = struct.pack('<I', len(binaries))
+	for binary in binaries:
+		payload += struct.pack('<Q', len(binary)) + bytes(binary)
+	return CACHE_MAGIC + hashlib.sha256(payload).digest() + payload
+
+# Returns None if the entry is truncated or its checksum doesn't match
+def unpack_binaries(data):
+	header_size = len(CACHE_MAGIC) + 32
+	if len(data) < header_size + 4 or not data.startswith(CACHE_MAGIC):
+		return None
+	payload = data[header_size:]
+	if hashlib.sha256(payload).digest() != data[len(CACHE_MAGIC):header_size]:
+		return None
+
+	(count,) = struct.unpack_from('<I', payload, 0)
+	offset = 4
+	binaries = []
+	for _ in range(count):
+		if offset + 8 > len(payload):
+			return None
+		(length,) = struct.unpack_from('<Q', payload, offset)
+		offset += 8
+		binaries.append(payload[offset:offset + length])
+		offset += length
+	return binaries if offset == len(payload) else None
+
+
+# Persistent cache of compiled program binaries, evicting the least recently used entries
+class ProgramCache:
+
+	def __init__(self, directory=CACHE_DIRECTORY, max_bytes=None):
+		self.directory = directory
+		self.max_bytes = max_bytes if max_bytes is not None else get_max_cache_bytes()
+
+	# Like cl.Program(context, source).build(options), but loads the binaries from disk when possible
+	def build(self, context, source, options=()):
+		options = list(options)
+		entry_path = os.path.join(self.directory, get_cache_key(context, source, options) + CACHE_SUFFIX)
+
+		program = self.__load(context, entry_path, options)
+		if program is not None:
+			return program
+
+		program = cl.Program(context, source).build(options=options)
+		self.__store(entry_path, program.binaries)
+		return program
+
+	def __load(self, context, entry_path, options):
+		try:
+			with open(entry_path, 'rb') as file:
+				binaries = unpack_binaries(file.read())
+		except OSError:
+			return None
+
+		if binaries is None or len(binaries) != len(context.devices):
+			disk_cache.remove(entry_path)
+			return None
+
+		try:
+			program = cl.Program(context, context.devices, binaries).build(options=options)
+		except cl.Error:
+			# Binary rejected by the driver, recompile from source
+			disk_cache.remove(entry_path)
+			return None
+
+		disk_cache.touch(entry_path)
+		return program
+
+	def __store(self, entry_path, binaries):
+		try:
+			disk_cache.write_atomically(entry_path, pack_binaries(binaries))
+			disk_cache.evict(self.directory, CACHE_SUFFIX, self.max_bytes)
+		except OSError:
+			pass
@@ -0,0 +1,289 @@
+import json
+import os
+import queue
+import threading
+import zlib
+import numpy as np
+from colorama import Style
+
+import pyopencl as cl
+
+from exceptions import ParticleSystemException
+
+RECORDING_VERSION = 1
+HEADER_FILENAME = 'header.json'
+CHUNK_FILENAME = 'chunk_%05d.dat'
+COMPRESSED_SUFFIX = '.zlib'
+
+DEFAULT_CHUNK_FRAMES = 64		# frames per chunk file
+N_STAGING_SLOTS = 3				# readbacks in flight, capture() waits when the writer falls this far behind
+COMPRESSION_LEVEL = 1			# zlib, fast enough to keep up with capture
+
+QUANTIZED_POSITION_MAX = 65535
+
+
+# One recorded frame: simulation time, then the particle fields.
+# Quantized frames keep positions as uint16 steps between per-frame bounds, colors as RGBA8 and the rest as half floats.
+def get_frame_dtype(n_particles, with_velocity, quantize):
+	fields = [ ('time', np.float64) ]
+	if quantize:
+		fields += [
+			('position_origin', np.float32, (3,)),
+			('position_step', np.float32, (3,)),
+			('position', np.uint16, (n_particles, 3)),
+			('color', np.uint8, (n_particles, 4)),
+			('lifetime', np.float16, (n_particles,)),
+			]
+	else:
+		fields += [
+			('position', np.float32, (n_particles, 4)),
+			('color', np.float32, (n_particles, 4)),
+			('lifetime', np.float32, (n_particles,)),
+			]
+	if with_velocity:
+		fields.append(('velocity', np.float16 if quantize else np.float32, (n_particles, 4)))
+	return np.dtype(fields)
+
+
+# Streams particle state to chunks of np.memmap frames in a directory.
+# Device copies land in pinned staging buffers without blocking, a writer thread quantizes, stores and compresses them.
+class Recorder:
+
+	def __init__(self, directory, n_particles, with_velocity=False, quantize=False, compress=False,
+			chunk_frames=DEFAULT_CHUNK_FRAMES):
+		self.directory = directory
+		self.n_particles = n_particles
+		self.with_velocity = with_velocity
+		self.quantize = quantize
+		self.compress = compress
+		self.chunk_frames = chunk_frames
+		self.frame_dtype = get_frame_dtype(n_particles, with_velocity, quantize)
+
+		try:
+			os.makedirs(directory, exist_ok=True)
+		except OSError as e:
+			raise ParticleSystemException('Cannot create recording directory ' + directory + '\n' + str(e))
+
+		self.times = []
+		self.__chunk = None
+
+		# Staging slots are allocated on the first capture, from the core's context
+		self.__staging = None
+		self.__free_slots = queue.Queue()
+		self.__pending = queue.Queue()
+		self.__error = None
+		self.__writer = threading.Thread(target=self.__write_frames, daemon=True)
+		self.__writer.start()
+
+	# Start reading back the core's current state, stamped with its simulation time
+	def capture(self, core, time):
+		if self.__error is not None:
+			raise ParticleSystemException('Recording to ' + self.directory + ' failed\n' + str(self.__error))
+		if self.__staging is None:
+			self.__init_staging(core)
+
+		slot = self.__free_slots.get()
+		host_buffers, host_velocity = self.__staging[slot]
+		events = core.enqueue_read_state(host_buffers, host_velocity)
+		self.__pending.put((core, slot, events, time))
+
+	# Wait for the writer, then write the last chunk and the header
+	def close(self):
+		self.__pending.put(None)
+		self.__writer.join()
+		if self.__chunk is not None:
+			self.__finish_chunk()
+		self.__staging = None
+		self.__write_header()
+		print(Style.BRIGHT + 'RECORDING: \t' + Style.RESET_ALL, '%d frames in %s' % (len(self.times), self.directory))
+
+	# Host arrays mapped from ALLOC_HOST_PTR buffers, which drivers back with page-locked memory
+	def __init_staging(self, core):
+		def make_pinned(size, dtype):
+			buffer = cl.Buffer(core.context, cl.mem_flags.READ_WRITE | cl.mem_flags.ALLOC_HOST_PTR, size)
+			host_buffer, _ = cl.enqueue_map_buffer(core.queue, buffer, cl.map_flags.READ | cl.map_flags.WRITE,
+				0, (size // np.dtype(dtype).itemsize,), dtype, is_blocking=True)
+			return host_buffer
+
+		self.__staging = []
+		for slot in range(N_STAGING_SLOTS):
+			host_buffers = [ make_pinned(size, np.float32) for size in core.get_state_buffer_sizes() ]
+			host_velocity = make_pinned(core.get_velocity_buffer_size(), np.uint8) if self.with_velocity else None
+			self.__staging.append((host_buffers, host_velocity))
+			self.__free_slots.put(slot)
+
+	def __write_frames(self):
+		while True:
+			item = self.__pending.get()
+			if item is None:
+				return
+
+			core, slot, events, time = item
+			try:
+				cl.wait_for_events(events)
+				if self.__error is None:
+					self.__write_frame(core, *self.__staging[slot], time)
+			except (OSError, cl.Error) as e:
+				self.__error = e
+			self.__free_slots.put(slot)
+
+	def __write_frame(self, core, host_buffers, host_velocity, time):
+		if self.__chunk is None:
+			path = os.path.join(self.directory, CHUNK_FILENAME % (len(self.times) // self.chunk_frames))
+			self.__chunk = np.memmap(path, dtype=self.frame_dtype, mode='w+', shape=(self.chunk_frames,))
+
+		frame = self.__chunk[len(self.times) % self.chunk_frames]
+		position, color, lifetime = core.unpack_state(host_buffers)
+		frame['time'] = time
+
+		if self.quantize:
+			origin = np.min(position[:, :3], axis=0)
+			step = np.maximum(np.max(position[:, :3], axis=0) - origin, np.float32(1e-6)) / QUANTIZED_POSITION_MAX
+			frame['position_origin'] = origin
+			frame['position_step'] = step
+			frame['position'] = np.rint((position[:, :3] - origin) / step)
+			frame['color'] = np.rint(np.clip(color, 0.0, 1.0) * 255.0)
+		else:
+			frame['position'] = position
+			frame['color'] = color
+		frame['lifetime'] = lifetime
+		if host_velocity is not None:
+			frame['velocity'] = core.unpack_velocity(host_velocity)
+
+		del frame
+		self.times.append(time)
+		if len(self.times) % self.chunk_frames == 0:
+			self.__finish_chunk()
+
+	# Flush the chunk, trimmed to the frames it holds, and compress it if asked
+	def __finish_chunk(self):
+		n_frames = (len(self.times) - 1) % self.chunk_frames + 1
+		path = self.__chunk.filename
+		self.__chunk.flush()
+		self.__chunk = None
+
+		with open(path, 'r+b') as file:
+			file.truncate(n_frames * self.frame_dtype.itemsize)
+		if self.compress:
+			with open(path, 'rb') as file:
+				data = zlib.compress(file.read(), COMPRESSION_LEVEL)
+			with open(path + COMPRESSED_SUFFIX, 'wb') as file:
+				file.write(data)
+			os.remove(path)
+
+		# Keep the header current, so a recording cut short still replays up to its last chunk
+		self.__write_header()
+
+	def __write_header(self):
+		n_frames = len(self.times) - (len(self.times) % self.chunk_frames if self.__chunk is not None else 0)
+		header = {
+			'version': RECORDING_VERSION,
+			'n_particles': self.n_particles,
+			'with_velocity': self.with_velocity,
+			'quantize': self.quantize,
+			'compress': self.compress,
+			'chunk_frames': self.chunk_frames,
+			'frame_dtype': np.lib.format.dtype_to_descr(self.frame_dtype),
+			'times': self.times[:n_frames],
+			}
+		with open(os.path.join(self.directory, HEADER_FILENAME), 'w') as file:
+			json.dump(header, file)
+
+
+# Plays a recording back in place of a simulation backend, the renderer uploads read_state() into its VBOs.
+# update() advances playback by simulated time, so a recording plays at the speed it was simulated.
+class Replay:
+
+	def __init__(self, directory):
+		try:
+			with open(os.path.join(directory, HEADER_FILENAME), 'r') as file:
+				header = json.load(file)
+		except (OSError, ValueError) as e:
+			raise ParticleSystemException('No recording in ' + directory + '\n' + str(e))
+		if header.get('version') != RECORDING_VERSION:
+			raise ParticleSystemException('Recording ' + directory + ' has version ' + str(header.get('version')) +
+				', expected ' + str(RECORDING_VERSION))
+		if not header['times']:
+			raise ParticleSystemException('Recording ' + directory + ' has no frames')
+
+		self.directory = directory
+		self.n_particles = header['n_particles']
+		self.quantize = header['quantize']
+		self.compress = header['compress']
+		self.chunk_frames = header['chunk_frames']
+		self.frame_dtype = np.lib.format.descr_to_dtype([ tuple(field) for field in header['frame_dtype'] ])
+		self.times = np.array(header['times'], dtype=np.float64)
+		self.n_frames = len(self.times)
+
+		self.frame_index = 0
+		self.playback_time = self.times[0]
+		self.is_paused = False
+		self.__chunk_index = None
+		self.__chunk = None
+
+		# Simulation attributes the renderer sets and reads, which a replay ignores
+		self.time_step = 1.0 / 60
+		self.random_seed = 0
+		self.generator_position = np.array( [0.0, 0.0, 0.0, 1.0], dtype=np.float32)
+		self.spawn_in_cube = False
+		self.is_decaying = True
+		self.is_gravity_on = False
+		self.particle_mode_id = 0
+		self.color_profile_id = 0
+
+	def init(self):
+		self.seek(0)
+
+	# Show the last frame recorded at or before the playback time, looping at the end
+	def update(self, n_substeps=1):
+		if self.is_paused:
+			return
+		self.playback_time += n_substeps * self.time_step
+		if self.playback_time > self.times[-1]:
+			self.playback_time = self.times[0]
+		self.frame_index = max(int(np.searchsorted(self.times, self.playback_time, side='right')) - 1, 0)
+
+	def seek(self, frame_index):
+		self.frame_index = min(max(frame_index, 0), self.n_frames - 1)
+		self.playback_time = self.times[self.frame_index]
+
+	def toggle_pause(self):
+		self.is_paused = not self.is_paused
+
+	def change_color(self):
+		pass
+
+	def finish(self):
+		pass
+
+	def pop_events(self):
+		return []
+
+	# Every recorded particle is drawn
+	def get_live_count(self):
+		return self.n_particles
+
+	# Position, color and lifetime of the current frame. Unquantized fields are views of the memory-mapped chunk.
+	def read_state(self):
+		frame = self.__get_frame(self.frame_index)
+		if not self.quantize:
+			return frame['position'], frame['color'], frame['lifetime']
+
+		position = np.ones((self.n_particles, 4), dtype=np.float32)
+		position[:, :3] = frame['position_origin'] + frame['position'] * frame['position_step']
+		return position, frame['color'].astype(np.float32) / 255.0, frame['lifetime'].astype(np.float32)
+
+	def __get_frame(self, frame_index):
+		chunk_index = frame_index // self.chunk_frames
+		if chunk_index != self.__chunk_index:
+			path = os.path.join(self.directory, CHUNK_FILENAME % chunk_index)
+			try:
+				if self.compress:
+					with open(path + COMPRESSED_SUFFIX, 'rb') as file:
+						self.__chunk = np.frombuffer(zlib.decompress(file.read()), dtype=self.frame_dtype)
+				else:
+					self.__chunk = np.memmap(path, dtype=self.frame_dtype, mode='r')
+			except (OSError, zlib.error) as e:
+				raise ParticleSystemException('Cannot read ' + path + '\n' + str(e))
+			self.__chunk_index = chunk_index
+		return self.__chunk[frame_index % self.chunk_frames]
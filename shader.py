@@ -1,11 +1,23 @@
 from OpenGL.GL import *
+import numpy as np
 
 from exceptions import ParticleSystemException
 from file_to_string import file_to_string
 
+UNIFORM_BLOCK_NAME = 'Frame'		# std140 block of the per-frame state, in both shaders
+UNIFORM_BLOCK_BINDING = 0
+
+# Host-side types of uniform block members, std140 bools are 4 bytes
+BLOCK_MEMBER_DTYPES = {
+	GL_FLOAT_MAT4: np.dtype((np.float32, (4, 4))),
+	GL_FLOAT: np.dtype(np.float32),
+	GL_BOOL: np.dtype(np.uint32),
+	}
+
 class Shader:
 
-	def __init__(self, vs_filename, fs_filename):
+	# With frame_source, the Frame block reads that shader's uniform buffer, and its members set here are set there
+	def __init__(self, vs_filename, fs_filename, frame_source=None):
 		# compile shaders
 		vertex_shader = self.__compile_shader(vs_filename, GL_VERTEX_SHADER)
 		fragment_shader = self.__compile_shader(fs_filename, GL_FRAGMENT_SHADER)
@@ -18,6 +30,18 @@ class Shader:
 		glDeleteShader(vertex_shader)
 		glDeleteShader(fragment_shader)
 
+		# Uniforms outside the block, and the block members, looked up once.
+		# set_*() only write block members into a host copy, upload_uniforms() sends it if it changed.
+		self.__locations = {}
+		self.__block_members = {}
+		self.__introspect_uniforms()
+		self.__bind_uniform_block()
+		self.__frame_source = frame_source
+		if frame_source is None:
+			self.__init_uniform_buffer()
+		else:
+			self.ubo = frame_source.ubo
+
 	def __compile_shader(self, shader_filename, shader_type):
 		shader_source = file_to_string(shader_filename)
 		shader = glCreateShader(shader_type)
@@ -43,14 +67,84 @@ class Shader:
 
 		return shader_program
 
+	# Active uniforms by name: block members at their std140 offset, the others at their location
+	def __introspect_uniforms(self):
+		for index in range(glGetProgramiv(self.__ID, GL_ACTIVE_UNIFORMS)):
+			name, _, uniform_type = glGetActiveUniform(self.__ID, index)
+			name = name.decode() if isinstance(name, bytes) else name
+			block_index, offset = ( self.__get_uniform_info(index, pname) for pname in (GL_UNIFORM_BLOCK_INDEX, GL_UNIFORM_OFFSET) )
+			if block_index == -1:
+				self.__locations[name] = glGetUniformLocation(self.__ID, name)
+			else:
+				self.__block_members[name] = (offset, BLOCK_MEMBER_DTYPES[uniform_type])
+
+	def __get_uniform_info(self, index, pname):
+		value = np.zeros(1, dtype=np.int32)
+		glGetActiveUniformsiv(self.__ID, 1, np.array([ index ], dtype=np.uint32), pname, value)
+		return int(value[0])
+
+	def __bind_uniform_block(self):
+		self.__block_index = glGetUniformBlockIndex(self.__ID, UNIFORM_BLOCK_NAME)
+		if self.__block_index == GL_INVALID_INDEX:
+			raise ParticleSystemException('ERROR: NO UNIFORM BLOCK ' + UNIFORM_BLOCK_NAME)
+		glUniformBlockBinding(self.__ID, self.__block_index, UNIFORM_BLOCK_BINDING)
+
+	def __init_uniform_buffer(self):
+		block_size = np.zeros(1, dtype=np.int32)
+		glGetActiveUniformBlockiv(self.__ID, self.__block_index, GL_UNIFORM_BLOCK_DATA_SIZE, block_size)
+		block_size = int(block_size[0])
+
+		self.__block_data = np.zeros(block_size, dtype=np.uint8)
+		self.__is_block_dirty = False
+		self.ubo = glGenBuffers(1)
+		glBindBuffer(GL_UNIFORM_BUFFER, self.ubo)
+		glBufferData(GL_UNIFORM_BUFFER, block_size, self.__block_data, GL_DYNAMIC_DRAW)
+		glBindBufferBase(GL_UNIFORM_BUFFER, UNIFORM_BLOCK_BINDING, self.ubo)
+
+	def use(self):
+		glUseProgram(self.__ID)
+
+	# Once per frame before drawing, a single upload of the block if any member changed since the last one
+	def upload_uniforms(self):
+		if self.__frame_source is not None:
+			self.__frame_source.upload_uniforms()
+			return
+		if not self.__is_block_dirty:
+			return
+		glBindBuffer(GL_UNIFORM_BUFFER, self.ubo)
+		glBufferSubData(GL_UNIFORM_BUFFER, 0, self.__block_data.nbytes, self.__block_data)
+		self.__is_block_dirty = False
+
+	# Block members are row-major, like the matrices passed in
+	def __set_block_member(self, name, value):
+		if self.__frame_source is not None:
+			self.__frame_source.__set_block_member(name, value)
+			return
+		offset, dtype = self.__block_members[name]
+		data = np.asarray(value, dtype=dtype.base).reshape(dtype.shape).tobytes()
+		member = self.__block_data[offset:offset + dtype.itemsize]
+		if member.tobytes() != data:
+			member[:] = np.frombuffer(data, dtype=np.uint8)
+			self.__is_block_dirty = True
+
 	def set_matrix(self, name, value):
-		loc = glGetUniformLocation(self.__ID, name)
-		glUniformMatrix4fv(loc, 1, GL_TRUE, value)	# Transpose=TRUE, important!
+		if name in self.__block_members:
+			self.__set_block_member(name, value)
+		else:
+			glUniformMatrix4fv(self.__locations[name], 1, GL_TRUE, value)	# Transpose=TRUE, important!
 
 	def set_float(self, name, value):
-		loc = glGetUniformLocation(self.__ID, name)
-		glUniform1f(loc, value)
+		if name in self.__block_members:
+			self.__set_block_member(name, value)
+		else:
+			glUniform1f(self.__locations[name], value)
 
 	def set_bool(self, name, value):
-		loc = glGetUniformLocation(self.__ID, name)
-		glUniform1i(loc, int(value))
+		if name in self.__block_members:
+			self.__set_block_member(name, int(value))
+		else:
+			glUniform1i(self.__locations[name], int(value))
+
+	# Uniforms outside the block only, like sampler units, on the program in use
+	def set_int(self, name, value):
+		glUniform1i(self.__locations[name], int(value))
@@ -7,7 +7,23 @@ in float				distance_from_mouse;
 out vec4				frag_color;
 
 uniform sampler2D		doge_texture;
-uniform bool			is_texture;
+
+// Same block as vertex_shader.glsl
+layout (std140, row_major) uniform Frame
+{
+	mat4				model;
+	mat4				view;
+	mat4				projection;
+
+	float				mouse_x;
+	float				mouse_y;
+
+	float				point_size;
+	bool				is_shrinking;
+
+	float				interpolation_alpha;
+	bool				is_texture;
+};
 
 void main()
 {
@@ -0,0 +1,70 @@
+#version 400 core
+
+out vec4							color;
+
+// Per-frame state, the particles' block, read from the same uniform buffer
+layout (std140, row_major) uniform Frame
+{
+	mat4							model;
+	mat4							view;
+	mat4							projection;
+
+	float							mouse_x;
+	float							mouse_y;
+
+	float							point_size;
+	bool							is_shrinking;
+
+	float							interpolation_alpha;
+	bool							is_texture;
+};
+
+uniform samplerBuffer				trail;				// vec4(position, lifetime), trail_length slots of n_particles
+uniform samplerBuffer				colors;				// vec4 colors, or the compact vertices as floats
+uniform int							trail_length;
+uniform int							trail_head;			// slot written last
+uniform int							n_particles;
+uniform bool						is_compact;
+
+const int							VERTEX_FLOATS = 5;
+
+vec4 get_sample(int particle, int age)
+{
+	int slot = (trail_head - age + trail_length) % trail_length;
+
+	return texelFetch(trail, slot * n_particles + particle);
+}
+
+vec3 get_color(int particle)
+{
+	if (is_compact)
+		return unpackUnorm4x8(floatBitsToUint(texelFetch(colors, particle * VERTEX_FLOATS + 4).r)).rgb;
+	return texelFetch(colors, particle).rgb;
+}
+
+// Drawn as GL_LINES without attributes, trail_length - 1 segments per particle, newest first.
+// Segment k joins the samples k and k + 1 steps old, this vertex is one of the two.
+void main()
+{
+	int segment_id = gl_VertexID / 2;
+	int n_segments = trail_length - 1;
+	int particle = segment_id / n_segments;
+	int age = segment_id % n_segments;
+	vec4 newer = get_sample(particle, age);
+	vec4 older = get_sample(particle, age + 1);
+	vec4 end = (gl_VertexID % 2 == 0) ? newer : older;
+
+	// Nothing across a death or a respawn, when the lifetime went up: both ends off screen
+	if (newer.w <= 0.0f || older.w <= 0.0f || newer.w > older.w)
+	{
+		gl_Position = vec4(2.0f, 2.0f, 2.0f, 1.0f);
+		color = vec4(0.0f);
+		return;
+	}
+
+	gl_Position = projection * view * model * vec4(end.xyz, 1.0f);
+
+	// Fades out with age, and with lifetime like the particles
+	float end_age = float(age + gl_VertexID % 2);
+	color = vec4(get_color(particle), 1.0f) * end.w * (1.0f - end_age / float(n_segments));
+}
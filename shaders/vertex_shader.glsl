@@ -3,25 +3,34 @@
 layout (location = 0) in vec4		position;
 layout (location = 1) in vec4		color_;
 layout (location = 2) in float		lifetime_;
+layout (location = 3) in vec3		previous_position;
 
 out vec4							color;
 out float							lifetime;
 out float							distance_from_mouse;
 
-uniform mat4						model;
-uniform mat4						view;
-uniform mat4						projection;
+// Per-frame state, uploaded at most once per frame. Same block as fragment_shader.glsl.
+layout (std140, row_major) uniform Frame
+{
+	mat4							model;
+	mat4							view;
+	mat4							projection;
+
+	float							mouse_x;
+	float							mouse_y;
 
-uniform float						mouse_x;
-uniform float						mouse_y;
+	float							point_size;
+	bool							is_shrinking;
 
-uniform float						point_size;
-uniform bool						is_shrinking;
+	float							interpolation_alpha;		// 1.0 unless rendering between simulation steps
+	bool							is_texture;
+};
 
 void main()
 {
 	// Calculate vertex position in clip space
-	gl_Position = projection * view * model * vec4(position.xyz, 1.0f);
+	vec3 interpolated_position = mix(previous_position, position.xyz, interpolation_alpha);
+	gl_Position = projection * view * model * vec4(interpolated_position, 1.0f);
 
 	// Calculate vertex position in NDC space, and compare it to mouse NDC position
 	vec2 ndc_position;
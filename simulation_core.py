@@ -0,0 +1,814 @@
+import pyopencl as cl
+import numpy as np
+import time
+import types
+from colorama import Style
+
+from exceptions import ParticleSystemException
+from file_to_string import file_to_string
+from program_cache import ProgramCache
+from kernel_variants import KernelVariants
+from prefix_sum import PrefixSum
+from emitters import EmitterTable, MAX_EMITTERS, EMITTER_DTYPE
+from custom_modes import custom_modes
+
+KERNEL_FILENAME = 'kernels/kernel.cl'
+GRID_KERNEL_FILENAME = 'kernels/grid.cl'
+NBODY_KERNEL_FILENAME = 'kernels/nbody.cl'
+POOL_KERNEL_FILENAME = 'kernels/pool.cl'
+PROGRAM_FILENAMES = ( KERNEL_FILENAME, GRID_KERNEL_FILENAME, NBODY_KERNEL_FILENAME, POOL_KERNEL_FILENAME )
+
+VERTEX_FLOATS = 5				# compact layout vertex: position.xyz, lifetime, RGBA8 color
+
+DEFAULT_TIME_STEP = 1.0 / 60	# the rate the kernel constants were tuned at, one step per frame
+
+COLOR_PROFILES = (
+	'Confetti',
+	'Monochrome',
+	'Red and White',
+	'Cyan Magenta Yellow',
+	'Rainbow Dash',
+	)
+
+PARTICLE_MODES = (
+	'Stationary',
+	'Falling Down',
+	'Gravity Fountain',
+	'Radial Explosion',
+	'Chaos Nova',
+	'Vortex Attractor',
+	'Soft Collision',
+	'SPH Fluid',
+	'Flocking',
+	'N-Body',
+	)
+
+# Modes where particles push each other around, stepped on the uniform grid of kernels/grid.cl
+INTERACTING_MODES = tuple(PARTICLE_MODES.index(name) for name in ('Soft Collision', 'SPH Fluid', 'Flocking'))
+SPH_MODE = PARTICLE_MODES.index('SPH Fluid')
+
+INTERACTION_RADIUS = 0.04		# also the grid cell size
+MIN_GRID_BUCKETS = 1024
+
+NBODY_MODE = PARTICLE_MODES.index('N-Body')
+DEFAULT_N_BODIES = 1024
+MAX_NBODY_WORK_GROUP_SIZE = 256
+NBODY_TREE_DEPTH = 5			# like kernels/nbody.cl
+
+TRAIL_SAMPLE_BYTES = 16			# float4 position.xyz and lifetime per particle per trail slot
+
+DRAW_COMMAND_UINTS = 5			# glDrawElementsIndirect command: count, instance count, first index, base vertex, base instance
+
+program_cache = ProgramCache()
+
+
+def has_opencl_platform():
+	try:
+		return any(platform.get_devices() for platform in cl.get_platforms())
+	except cl.Error:
+		return False
+
+# Context on any OpenCL device (honors PYOPENCL_CTX), no GL sharing required
+def create_headless_context():
+	try:
+		return cl.create_some_context(interactive=False)
+	except (cl.Error, IndexError) as e:
+		raise ParticleSystemException('No OpenCL device available\n' + str(e))
+
+
+# The commands of a step that runs several kernels, as one event: its profile spans from the start
+# of the first to the end of the last, so benchmarks time the whole step
+class EventSpan:
+
+	def __init__(self, first, last):
+		self.first = first
+		self.last = last
+
+	@property
+	def profile(self):
+		return types.SimpleNamespace(start=self.first.profile.start, end=self.last.profile.end)
+
+	def wait(self):
+		self.last.wait()
+
+
+class SimulationCore:
+
+	def __init__(self, n_particles, context=None, gl_vbo_sets=None, profiling=False, specialize=True, random_seed=0,
+			compact=False, interpolate=False, partition=False, gl_draw_buffers=None, gl_trail_buffer=None, defer_build=False):
+		self.n_particles = n_particles
+		self.specialize = specialize
+		self.compact = compact
+		self.interpolate = interpolate
+		self.profiling = profiling
+
+		# With profiling, (phase, cl.Event) of every command enqueued since the last pop_events()
+		self.events = []
+
+		# Simulated seconds per substep
+		self.time_step = DEFAULT_TIME_STEP
+
+		# Every dispatch draws from its own frame of the counter-based random stream
+		self.random_seed = random_seed
+		self.frame = 0
+
+		self.generator_position = np.array( [0.0, 0.0, 0.0, 1.0], dtype=np.float32)
+
+		self.spawn_in_cube = False
+		self.is_decaying = True
+		self.is_gravity_on = False
+		self.particle_mode_id = 0
+		self.color_profile_id = 0
+
+		# Particles respawned per second, or None for respawning every particle as soon as it dies.
+		# With a rate, dead particles wait for emission, and every step packs the live ones for an indirect draw.
+		self.emission_rate = None
+		self.n_emit = 0
+
+		# Emitter 0 is the generator above, more emitters are stepped by the same dispatches
+		self.emitters = EmitterTable()
+
+		# A force field kind or .npy filename that live particles drift along, or None.
+		# Fields are built and uploaded once, switching back to one reuses its image.
+		self.force_field = None
+		self.force_strength = None				# displacement per 1/60 s at full strength, None for force_field.DEFAULT_STRENGTH
+
+		# With a trail_length, every update also writes the particles into slot trail_head of a ring of their
+		# trail_length last positions, the renderer's trail buffer or a plain one
+		self.trail_length = 0
+		self.trail_head = 0
+
+		self.context = context if context is not None else create_headless_context()
+
+		print(Style.BRIGHT + 'DEVICE: \t' + Style.RESET_ALL, self.context.devices[0])
+		print(Style.BRIGHT + 'VERSION: \t' + Style.RESET_ALL, self.context.devices[0].get_info(cl.device_info.VERSION))
+
+		# Without cl_khr_gl_event, OpenCL and OpenGL must be synchronized explicitly around acquire/release
+		self.has_gl_event = 'cl_khr_gl_event' in self.context.devices[0].extensions
+
+		self.__init_buffers(gl_vbo_sets, partition, gl_draw_buffers, gl_trail_buffer)
+		self.__init_program(defer_build)
+
+		# Will need a command queue to run kernel, profiling lets kernel events report device timestamps
+		properties = cl.command_queue_properties.PROFILING_ENABLE if profiling else 0
+		self.queue = cl.CommandQueue(self.context, self.context.devices[0], properties=properties)
+
+		# With partition, every device of the context runs its own range of particles,
+		# and self.queue only acquires, gathers and publishes
+		self.partitions = None
+		if partition:
+			from device_partition import DevicePartitions
+
+			self.partitions = DevicePartitions(self.context, n_particles)
+
+		# Uniform grid and N-body buffers, allocated the first time their mode runs
+		self.prefix_sum = None
+		self.bucket_counts = None
+		self.accelerations = None
+		self.dead_rank = None
+		self.depth_sort = None
+		self.frustum_cull = None
+		self.force_fields = None
+
+		# N-body: the first n_bodies particles attract every particle, all of them when n_bodies <= 0.
+		# The tiled direct sum uses nbody_work_group_size bodies per tile, or the largest the device allows up to 256.
+		self.n_bodies = DEFAULT_N_BODIES
+		self.barnes_hut = False
+		self.nbody_work_group_size = None
+
+	def init(self):
+		self.__upload_emitters()
+		self.__acquire()
+		event = self.__enqueue('init', ( *self.particle_buffers, self.emitter_index ),
+			self.emitter_buffer,
+			*self.__next_frame())
+		self.__release()
+		self.__compact()
+		return event
+
+	# Advance n_substeps fixed time steps in a single dispatch
+	def update(self, n_substeps=1):
+		self.n_emit = 0				# interacting and N-body modes respawn every particle as it dies
+		self.__advance_trail()
+		if self.particle_mode_id in INTERACTING_MODES:
+			event = self.__record_trail(self.__update_interacting(n_substeps))
+		elif self.particle_mode_id == NBODY_MODE:
+			event = self.__record_trail(self.__update_nbody(n_substeps))
+		else:
+			event = self.__update_particles(n_substeps)
+		self.__compact()
+		return event
+
+	# Reallocate the particles for a new count, keeping those both counts have, the others start dead.
+	# A renderer passes VBOs of the new size, and may delete the old ones once this returns.
+	def resize(self, n_particles, gl_vbo_sets=None, gl_draw_buffers=None, gl_trail_buffer=None):
+		if self.partitions is not None:
+			raise ParticleSystemException('Partitioned simulations cannot be resized')
+		self.queue.finish()
+
+		n_kept = min(n_particles, self.n_particles)
+		old_n_particles = self.n_particles
+		old_buffers = ( *self.particle_buffers, self.previous_position_buffer )
+		old_gl_buffers = self.gl_buffers
+
+		self.n_particles = n_particles
+		self.__init_buffers(gl_vbo_sets, False, gl_draw_buffers, gl_trail_buffer)
+		new_buffers = ( *self.particle_buffers, self.previous_position_buffer )
+
+		# Grid, N-body and pool buffers are sized by particle count, they are reallocated on next use
+		self.bucket_counts = None
+		self.accelerations = None
+		self.dead_rank = None
+
+		if old_gl_buffers:
+			self.__record('acquire', cl.enqueue_acquire_gl_objects(self.queue, old_gl_buffers))
+		self.__acquire()
+		for old_buffer, new_buffer in zip(old_buffers, new_buffers):
+			if old_buffer is None:
+				continue
+			stride = old_buffer.size // old_n_particles
+			if n_kept:
+				self.__record('copy', cl.enqueue_copy(self.queue, new_buffer, old_buffer, byte_count=n_kept * stride))
+			if n_particles > n_kept:
+				# Zero lifetime, so new particles are dead
+				self.__record('copy', cl.enqueue_fill_buffer(self.queue, new_buffer, np.uint32(0),
+					n_kept * stride, (n_particles - n_kept) * stride))
+		self.__release()
+		if old_gl_buffers:
+			self.__record('release', cl.enqueue_release_gl_objects(self.queue, old_gl_buffers))
+		self.queue.finish()
+
+		for buffer in old_gl_buffers:
+			buffer.release()
+		self.__compact()
+
+	# Live particles after the last step, as drawn. Waits for the step.
+	def get_live_count(self):
+		if self.dead_rank is None:
+			return self.n_particles
+
+		count = np.empty(1, dtype=np.uint32)
+		self.__acquire()
+		cl.enqueue_copy(self.queue, count, self.draw_buffers[1], is_blocking=False)
+		self.__release()
+		self.queue.finish()
+		return int(count[0])
+
+	# Write the particle indices into the element buffer farthest first, for the view matrix row view_z.
+	# Without full, refines the last order with n_passes odd-even passes. Dead particles go last.
+	# With is_culled, only keeps the order for cull() to draw from.
+	def sort_by_depth(self, view_z, full=True, n_passes=0, is_culled=False):
+		if self.depth_sort is None:
+			from depth_sort import DepthSort
+
+			self.depth_sort = DepthSort(self.context, program_cache)
+		self.__init_draw_buffers()
+
+		self.__acquire()
+		event = self.depth_sort(self.queue, *self.__get_draw_geometry(), self.n_particles, view_z,
+			None if is_culled else self.draw_buffers[0], full, n_passes)
+		self.__record('kernel', event)
+		self.__release()
+		return event
+
+	# Write the indices of the particles on screen, and their count, into the indirect draw, in depth sorted
+	# order when is_sorted. The view volume is grown by point_size pixels of a viewport (width, height).
+	# A lod_budget thins screen tiles to about that many particles, 0 keeps them all.
+	def cull(self, view_projection, viewport, point_size=1.0, lod_budget=0, is_sorted=False):
+		if self.frustum_cull is None:
+			if self.prefix_sum is None:
+				self.prefix_sum = PrefixSum(self.context, program_cache)
+			from frustum_cull import FrustumCull
+
+			self.frustum_cull = FrustumCull(self.context, program_cache, self.prefix_sum)
+		self.__init_draw_buffers()
+
+		self.__acquire()
+		event = self.frustum_cull(self.queue, *self.__get_draw_geometry(), self.n_particles, view_projection, viewport,
+			point_size, lod_budget, *self.draw_buffers, self.depth_sort.order if is_sorted else None)
+		self.__record('kernel', event)
+		self.__release()
+		return event
+
+	def __update_particles(self, n_substeps):
+		if self.emission_rate is not None and self.dead_rank is None:
+			self.__compact()
+		self.__upload_emitters(n_substeps)
+
+		self.__acquire()
+		event = self.__enqueue('update', ( *self.particle_buffers, self.previous_position_buffer, self.dead_rank, self.emitter_index ),
+			self.emitter_buffer,
+			*self.__next_frame(),
+			np.float32(self.time_step),
+			np.int32(n_substeps),
+			np.int32(self.is_decaying),
+			np.int32(self.is_gravity_on),
+			*self.__get_force_field_args(),
+			*self.__get_trail_args())
+		self.__release()
+		return event
+
+	# The field's image and (strength, 1 / extent), force_field.py is only imported once a field is set
+	def __get_force_field_args(self):
+		if self.force_field is None:
+			return None, cl.cltypes.make_float4(0.0, 0.0, 0.0, 0.0)
+
+		from force_field import ForceFieldCache, FIELD_EXTENT, DEFAULT_STRENGTH
+
+		if self.force_fields is None:
+			self.force_fields = ForceFieldCache(self.context)
+		strength = DEFAULT_STRENGTH if self.force_strength is None else self.force_strength
+		return self.force_fields.get_image(self.force_field), cl.cltypes.make_float4(strength, 1.0 / FIELD_EXTENT, 0.0, 0.0)
+
+	# Next slot of the trail ring, for the update about to run
+	def __advance_trail(self):
+		if not self.trail_length:
+			return
+		if self.partitions is not None:
+			raise ParticleSystemException('Trails need the particles on a single device, not partitioned')
+		if self.trail_buffer is None or self.trail_buffer.size != self.trail_length * self.n_particles * TRAIL_SAMPLE_BYTES:
+			# Zero lifetimes, so the slots not written yet draw nothing
+			self.trail_buffer = cl.Buffer(self.context, cl.mem_flags.READ_WRITE,
+				self.trail_length * self.n_particles * TRAIL_SAMPLE_BYTES)
+			self.__record('copy', cl.enqueue_fill_buffer(self.queue, self.trail_buffer, np.uint32(0), 0, self.trail_buffer.size))
+		self.trail_head = (self.trail_head + 1) % self.trail_length
+
+	def __get_trail_args(self):
+		if not self.trail_length:
+			return ( None, np.uint32(0) )
+		return ( self.trail_buffer, np.uint32(self.trail_head * self.n_particles) )
+
+	# Modes that don't step through update copy their positions into the trail after their last step.
+	# Returns the copy's event, or the step's without trails.
+	def __record_trail(self, event):
+		if not self.trail_length:
+			return event
+		self.__acquire()
+		event = self.__get_kernels()['record_trail'](self.queue, (self.n_particles,), None,
+			*self.particle_buffers, *self.__get_trail_args())
+		self.__record('kernel', event)
+		self.__release()
+		return event
+
+	def change_color(self):
+		self.__upload_emitters()
+		self.__acquire()
+		event = self.__enqueue('change_color', ( self.render_buffers[0] if self.compact else self.render_buffers[1], self.emitter_index ),
+			self.emitter_buffer,
+			*self.__next_frame())
+		self.__release()
+		return event
+
+	# Run n_steps of update() and return elapsed wall time in seconds
+	def run(self, n_steps):
+		self.queue.finish()
+		start = time.perf_counter()
+		for _ in range(n_steps):
+			self.update()
+		self.queue.finish()
+		return time.perf_counter() - start
+
+	def finish(self):
+		self.queue.finish()
+
+	# Bodies that attract in N-body mode
+	def get_n_bodies(self):
+		if self.n_bodies <= 0:
+			return self.n_particles
+		return min(self.n_bodies, self.n_particles)
+
+	# Accelerations of every particle from the current body positions, without moving anything.
+	# Returns the event of the force kernel, for benchmarking.
+	def compute_nbody_forces(self):
+		if self.accelerations is None:
+			self.__init_nbody()
+
+		self.__acquire()
+		event = self.__enqueue_nbody_forces(self.__get_kernels())
+		self.__release()
+		return event
+
+	def pop_events(self):
+		events = self.events
+		self.events = []
+		return events
+
+	# Copy the particle state into VBO set `index` for the renderer, without waiting for it
+	def publish(self, index):
+		gl_buffers = self.gl_buffer_sets[index]
+		self.__record('acquire', cl.enqueue_acquire_gl_objects(self.queue, gl_buffers))
+		for destination, source in zip(gl_buffers, self.render_buffers):
+			self.__record('copy', cl.enqueue_copy(self.queue, destination, source))
+		event = cl.enqueue_release_gl_objects(self.queue, gl_buffers)
+		self.__record('release', event)
+		self.queue.flush()
+		return event
+
+	# Copy particle state back to host, as numpy arrays
+	def read_state(self):
+		host_buffers = [ np.empty(size // 4, dtype=np.float32) for size in self.get_state_buffer_sizes() ]
+
+		self.enqueue_read_state(host_buffers)
+		self.queue.finish()
+		return self.unpack_state(host_buffers)
+
+	# Start copying the particle state into float32 host arrays of get_state_buffer_sizes() bytes,
+	# and the velocity into host_velocity, without waiting. Returns the copy events.
+	def enqueue_read_state(self, host_buffers, host_velocity=None):
+		events = []
+		self.__acquire()
+		for host_buffer, render_buffer in zip(host_buffers, self.render_buffers):
+			events.append(cl.enqueue_copy(self.queue, host_buffer, render_buffer, is_blocking=False))
+		if host_velocity is not None:
+			events.append(cl.enqueue_copy(self.queue, host_velocity, self.velocity_buffer, is_blocking=False))
+		self.__release()
+		self.queue.flush()
+		return events
+
+	# Particle state bytes per buffer, in the order of render_buffers
+	def get_state_buffer_sizes(self):
+		if self.compact:
+			return ( self.n_particles * VERTEX_FLOATS * 4, )
+		return ( self.n_particles * 4 * 4, self.n_particles * 4 * 4, self.n_particles * 4 )
+
+	def get_velocity_buffer_size(self):
+		return self.n_particles * 4 * (2 if self.compact else 4)						# buffer of half4 or float4
+
+	def unpack_velocity(self, host_velocity):
+		if self.compact:
+			return host_velocity.view(np.float16).reshape(-1, 4).astype(np.float32)
+		return host_velocity.view(np.float32).reshape(-1, 4)
+
+	# Host copies of the state buffers to position, color and lifetime arrays
+	def unpack_state(self, host_buffers):
+		if not self.compact:
+			position, color, lifetime = host_buffers
+			return position.reshape(-1, 4), color.reshape(-1, 4), lifetime
+
+		# Unpack { position.xyz, lifetime, RGBA8 color } vertices
+		vertex = host_buffers[0].reshape(-1, VERTEX_FLOATS)
+		position = np.ones((self.n_particles, 4), dtype=np.float32)
+		position[:, :3] = vertex[:, :3]
+		color = vertex[:, 4:].view(np.uint8).astype(np.float32) / 255.0
+		return position, color, vertex[:, 3].copy()
+
+	# Interacting modes rebuild the grid before every substep: count particles per bucket,
+	# scan the counts into bucket starts, scatter sorted copies, then interact. Partitions don't apply,
+	# every particle may need any other, so all of it runs on self.queue.
+	def __update_interacting(self, n_substeps):
+		if self.bucket_counts is None:
+			self.__init_grid()
+
+		kernels = self.__get_kernels()
+		n = (self.n_particles,)
+		cell_size = np.float32(INTERACTION_RADIUS)
+		n_buckets = np.uint32(self.n_buckets)
+		frame, random_seed = self.__next_frame()
+		event = None
+
+		self.__acquire()
+		step_start = cl.enqueue_marker(self.queue)
+		for substep in range(n_substeps):
+			self.__record('kernel', cl.enqueue_fill_buffer(self.queue, self.bucket_counts, np.uint32(0), 0, self.n_buckets * 4))
+			self.__record('kernel', kernels['count_cells'](self.queue, n, None,
+				*self.particle_buffers, cell_size, n_buckets, self.particle_bucket, self.particle_rank, self.bucket_counts))
+			self.__record('kernel', self.prefix_sum(self.queue, self.bucket_counts, self.bucket_starts, self.n_buckets))
+			self.__record('kernel', kernels['scatter_particles'](self.queue, n, None,
+				*self.particle_buffers, self.particle_bucket, self.particle_rank, self.bucket_starts,
+				self.sorted_position, self.sorted_velocity))
+			if self.particle_mode_id == SPH_MODE:
+				self.__record('kernel', kernels['compute_density'](self.queue, n, None,
+					cell_size, n_buckets, self.bucket_starts, self.bucket_counts, self.sorted_position, self.sorted_density))
+
+			event = kernels['interact'](self.queue, n, None,
+				*self.particle_buffers,
+				self.previous_position_buffer,
+				frame,
+				random_seed,
+				np.float32(self.time_step),
+				np.uint32(substep),
+				self.generator_position,
+				np.int32(self.spawn_in_cube),
+				np.int32(self.is_decaying),
+				np.int32(self.is_gravity_on),
+				np.int32(self.particle_mode_id),
+				np.int32(self.color_profile_id),
+				cell_size,
+				n_buckets,
+				self.particle_bucket, self.particle_rank, self.bucket_starts, self.bucket_counts,
+				self.sorted_position, self.sorted_velocity, self.sorted_density)
+			self.__record('kernel', event)
+		self.__release()
+		return EventSpan(step_start, event) if event is not None else None
+
+	# N-body runs like the interacting modes, on self.queue: forces from the bodies, then integration
+	def __update_nbody(self, n_substeps):
+		if self.accelerations is None:
+			self.__init_nbody()
+
+		kernels = self.__get_kernels()
+		frame, random_seed = self.__next_frame()
+		event = None
+
+		self.__acquire()
+		step_start = cl.enqueue_marker(self.queue)
+		for substep in range(n_substeps):
+			self.__enqueue_nbody_forces(kernels)
+			event = kernels['integrate_nbody'](self.queue, (self.n_particles,), None,
+				*self.particle_buffers,
+				self.previous_position_buffer,
+				frame,
+				random_seed,
+				np.float32(self.time_step),
+				np.uint32(substep),
+				self.generator_position,
+				np.int32(self.spawn_in_cube),
+				np.int32(self.is_decaying),
+				np.int32(self.is_gravity_on),
+				np.int32(self.particle_mode_id),
+				np.int32(self.color_profile_id),
+				self.accelerations)
+			self.__record('kernel', event)
+		self.__release()
+		return EventSpan(step_start, event) if event is not None else None
+
+	def __enqueue_nbody_forces(self, kernels):
+		n_bodies = self.get_n_bodies()
+		body_mass = np.float32(1.0 / n_bodies)
+
+		if not self.barnes_hut:
+			kernel = kernels['nbody_tiled']
+			work_group_size = self.__get_nbody_work_group_size(kernel)
+			global_size = (self.n_particles + work_group_size - 1) // work_group_size * work_group_size
+
+			self.__record('kernel', kernels['gather_bodies'](self.queue, (n_bodies,), None,
+				*self.particle_buffers, body_mass, self.bodies))
+			event = kernel(self.queue, (global_size,), (work_group_size,),
+				*self.particle_buffers, np.uint32(self.n_particles), np.uint32(n_bodies), self.bodies, self.accelerations,
+				cl.LocalMemory(work_group_size * 4 * 4))
+			self.__record('kernel', event)
+			return event
+
+		# Barnes-Hut: sort the bodies into octree leaves like the grid sorts particles into cells,
+		# then sum masses from the leaves up to the root
+		n_leaves = 8 ** NBODY_TREE_DEPTH
+		self.__record('kernel', cl.enqueue_fill_buffer(self.queue, self.leaf_counts, np.uint32(0), 0, n_leaves * 4))
+		self.__record('kernel', kernels['bin_bodies'](self.queue, (n_bodies,), None,
+			*self.particle_buffers, self.generator_position, self.body_leaf, self.body_rank, self.leaf_counts))
+		self.__record('kernel', self.prefix_sum(self.queue, self.leaf_counts, self.leaf_starts, n_leaves))
+		self.__record('kernel', kernels['scatter_bodies'](self.queue, (n_bodies,), None,
+			*self.particle_buffers, body_mass, self.body_leaf, self.body_rank, self.leaf_starts, self.bodies))
+		self.__record('kernel', kernels['sum_leaves'](self.queue, (n_leaves,), None,
+			self.leaf_starts, self.leaf_counts, self.bodies, self.nodes))
+		for level in reversed(range(NBODY_TREE_DEPTH)):
+			self.__record('kernel', kernels['sum_children'](self.queue, (8 ** level,), None, np.uint32(level), self.nodes))
+
+		event = kernels['nbody_barnes_hut'](self.queue, (self.n_particles,), None,
+			*self.particle_buffers, self.leaf_starts, self.leaf_counts, self.bodies, self.nodes, self.accelerations)
+		self.__record('kernel', event)
+		return event
+
+	# Bodies per tile of the direct sum, within what the kernel and local memory allow
+	def __get_nbody_work_group_size(self, kernel):
+		device = self.context.devices[0]
+		limit = min(kernel.get_work_group_info(cl.kernel_work_group_info.WORK_GROUP_SIZE, device),
+			device.local_mem_size // (4 * 4))
+
+		if self.nbody_work_group_size is None:
+			limit = min(limit, MAX_NBODY_WORK_GROUP_SIZE)
+			return 1 << (limit.bit_length() - 1)
+		if not 0 < self.nbody_work_group_size <= limit:
+			raise ParticleSystemException('N-body work-group size %d is not in 1..%d on %s'
+				% (self.nbody_work_group_size, limit, device.name))
+		return self.nbody_work_group_size
+
+	# The emitter table for a dispatch over n_substeps: the generator's current settings, the particles due
+	# for respawning when emitting, and the particle ranges, rewritten into emitter_index when emitters change.
+	# Non-blocking copies keep their host arrays alive until done.
+	def __upload_emitters(self, n_substeps=0):
+		self.emitters.sync_generator(self)
+		if self.emission_rate is not None:
+			self.n_emit = self.emitters.next_emission(self.time_step * n_substeps)
+
+		assignment_key = self.emitters.get_assignment_key(self.n_particles)
+		if assignment_key != self.emitter_assignment_key:
+			self.__record('copy', cl.enqueue_copy(self.queue, self.emitter_index, self.emitters.assign(self.n_particles),
+				is_blocking=False))
+			self.emitter_assignment_key = assignment_key
+		self.__record('copy', cl.enqueue_copy(self.queue, self.emitter_buffer, self.emitters.get_table().copy(),
+			is_blocking=False))
+
+	# Rank the dead particles for the next emission, and pack the live ones into the indirect draw
+	def __compact(self):
+		if self.emission_rate is None:
+			return
+		if self.partitions is not None:
+			raise ParticleSystemException('Emission needs the particles on a single device, not partitioned')
+		if self.dead_rank is None:
+			self.__init_pool()
+
+		kernels = self.__get_kernels()
+		n = (self.n_particles,)
+		self.__acquire()
+		self.__record('kernel', kernels['flag_dead'](self.queue, n, None, *self.particle_buffers, self.is_dead))
+		self.__record('kernel', self.prefix_sum(self.queue, self.is_dead, self.dead_rank, self.n_particles))
+		self.__record('kernel', kernels['compact_live'](self.queue, n, None,
+			np.uint32(self.n_particles), self.is_dead, self.dead_rank, *self.draw_buffers))
+		self.__release()
+
+	# Run kernel `name` over every particle, or over each partition's range on its device.
+	# buffers are indexed by particle, None stays None.
+	def __enqueue(self, name, buffers, *args):
+		kernel = self.__get_kernels()[name]
+		if self.partitions is None:
+			event = kernel(self.queue, (self.n_particles,), None, *buffers, *args)
+			self.__record('kernel', event)
+			return event
+
+		# Partitions start once everything enqueued so far is done, and self.queue waits for all of them
+		start_marker = cl.enqueue_marker(self.queue)
+		self.queue.flush()
+		events = []
+		for queue, start, count in self.partitions.get_ranges():
+			sub_buffers = [ None if buffer is None else
+				self.partitions.get_sub_buffer(buffer, buffer.size // self.n_particles, start, count) for buffer in buffers ]
+			event = kernel(queue, (count,), None, *sub_buffers, *args, global_offset=(start,), wait_for=[start_marker])
+			queue.flush()
+			self.__record('kernel', event)
+			events.append(event)
+
+		if name == 'update':
+			self.partitions.record(events)
+		return cl.enqueue_marker(self.queue, wait_for=events)
+
+	# Random stream arguments (frame, random_seed) for the next dispatch
+	def __next_frame(self):
+		self.frame = (self.frame + 1) & 0xFFFFFFFF
+		return np.uint32(self.frame), np.uint32(self.random_seed)
+
+	def __record(self, phase, event):
+		if self.profiling:
+			self.events.append((phase, event))
+
+	def __acquire(self):
+		if self.gl_buffers:
+			self.__record('acquire', cl.enqueue_acquire_gl_objects(self.queue, self.gl_buffers))
+
+	def __release(self):
+		if self.gl_buffers:
+			self.__record('release', cl.enqueue_release_gl_objects(self.queue, self.gl_buffers))
+
+	# Particle state the renderer draws from, plus the float3 positions before the last substep when interpolating
+	def __render_buffer_sizes(self):
+		if self.interpolate:
+			return ( *self.get_state_buffer_sizes(), self.n_particles * 3 * 4 )
+		return self.get_state_buffer_sizes()
+
+	def __init_buffers(self, gl_vbo_sets, partition, gl_draw_buffers, gl_trail_buffer):
+		# Make OpenCL buffers, one for each OpenGL VBO
+		self.gl_buffer_sets = [
+			tuple(cl.GLBuffer(self.context, cl.mem_flags.READ_WRITE, int(vbo)) for vbo in gl_vbos)
+			for gl_vbos in (gl_vbo_sets or ())
+			]
+
+		if len(self.gl_buffer_sets) == 1 and not partition:
+			# A single VBO set is the particle state itself, updated in place
+			self.render_buffers = self.gl_buffer_sets[0]
+			self.gl_buffers = self.gl_buffer_sets[0]
+		else:
+			# Particle state lives in plain device buffers, and is published to a VBO set when rendering.
+			# Partitions need plain buffers too, for their sub-buffers.
+			self.render_buffers = tuple(cl.Buffer(self.context, cl.mem_flags.READ_WRITE, size)
+				for size in self.__render_buffer_sizes())
+			self.gl_buffers = ()
+
+		# The element and indirect command buffers drawn from, written by __compact() when emitting
+		self.draw_buffers = None
+		if gl_draw_buffers is not None:
+			self.draw_buffers = tuple(cl.GLBuffer(self.context, cl.mem_flags.READ_WRITE, int(buffer)) for buffer in gl_draw_buffers)
+			self.gl_buffers = ( *self.gl_buffers, *self.draw_buffers )
+
+		# The trail ring, allocated on the first update with trails when there is no renderer's
+		self.trail_buffer = None
+		if gl_trail_buffer is not None:
+			self.trail_buffer = cl.GLBuffer(self.context, cl.mem_flags.READ_WRITE, int(gl_trail_buffer))
+			self.gl_buffers = ( *self.gl_buffers, self.trail_buffer )
+
+		# Make other OpenCL buffers
+		self.velocity_buffer = cl.Buffer(self.context, cl.mem_flags.READ_WRITE, self.get_velocity_buffer_size())
+		self.emitter_buffer = cl.Buffer(self.context, cl.mem_flags.READ_ONLY, MAX_EMITTERS * EMITTER_DTYPE.itemsize)
+		self.emitter_index = cl.Buffer(self.context, cl.mem_flags.READ_ONLY, self.n_particles)
+		self.emitter_assignment_key = None
+		n_state_buffers = len(self.get_state_buffer_sizes())
+		self.particle_buffers = ( *self.render_buffers[:n_state_buffers], self.velocity_buffer )
+		self.previous_position_buffer = self.render_buffers[n_state_buffers] if self.interpolate else None
+
+	def __init_grid(self):
+		# About one bucket per particle, a power of two so hashing is a mask
+		self.n_buckets = max(MIN_GRID_BUCKETS, 1 << (self.n_particles - 1).bit_length())
+
+		def make_buffer(size):
+			return cl.Buffer(self.context, cl.mem_flags.READ_WRITE, size)
+
+		self.particle_bucket = make_buffer(self.n_particles * 4)
+		self.particle_rank = make_buffer(self.n_particles * 4)
+		self.bucket_counts = make_buffer(self.n_buckets * 4)
+		self.bucket_starts = make_buffer(self.n_buckets * 4)
+		self.sorted_position = make_buffer(self.n_particles * 4 * 4)
+		self.sorted_velocity = make_buffer(self.n_particles * 4 * 4)
+		self.sorted_density = make_buffer(self.n_particles * 4)
+		if self.prefix_sum is None:
+			self.prefix_sum = PrefixSum(self.context, program_cache)
+
+	def __init_nbody(self):
+		n_leaves = 8 ** NBODY_TREE_DEPTH
+		n_nodes = (8 ** (NBODY_TREE_DEPTH + 1) - 1) // 7
+
+		def make_buffer(size):
+			return cl.Buffer(self.context, cl.mem_flags.READ_WRITE, size)
+
+		# Sized for every particle, so n_bodies can change at any time
+		self.bodies = make_buffer(self.n_particles * 4 * 4)
+		self.accelerations = make_buffer(self.n_particles * 4 * 4)
+		self.body_leaf = make_buffer(self.n_particles * 4)
+		self.body_rank = make_buffer(self.n_particles * 4)
+		self.leaf_counts = make_buffer(n_leaves * 4)
+		self.leaf_starts = make_buffer(n_leaves * 4)
+		self.nodes = make_buffer(n_nodes * 4 * 4)
+		if self.prefix_sum is None:
+			self.prefix_sum = PrefixSum(self.context, program_cache)
+
+	# Headless, plain buffers stand in for the renderer's element and indirect command buffers
+	def __init_draw_buffers(self):
+		if self.draw_buffers is None:
+			self.draw_buffers = tuple(cl.Buffer(self.context, cl.mem_flags.READ_WRITE, size)
+				for size in (self.n_particles * 4, DRAW_COMMAND_UINTS * 4))
+
+	# Positions, lifetimes and their strides in floats, as the sort and cull kernels read them
+	def __get_draw_geometry(self):
+		if self.compact:
+			return ( self.render_buffers[0], self.render_buffers[0], VERTEX_FLOATS, 3, VERTEX_FLOATS )
+		return ( self.render_buffers[0], self.render_buffers[2], 4, 0, 1 )
+
+	def __init_pool(self):
+		def make_buffer(size):
+			return cl.Buffer(self.context, cl.mem_flags.READ_WRITE, size)
+
+		self.is_dead = make_buffer(self.n_particles * 4)
+		self.dead_rank = make_buffer(self.n_particles * 4)
+		self.__init_draw_buffers()
+		if self.prefix_sum is None:
+			self.prefix_sum = PrefixSum(self.context, program_cache)
+
+	# Kernels specialized for the current mode, color profile and flags, or the generic ones
+	def __get_kernels(self):
+		# Modes registered since the program was built need a new one
+		if self.custom_modes_version != custom_modes.version:
+			self.__init_variants()
+
+		try:
+			return self.variants.get(self.__get_variant_key())
+		except cl.RuntimeError as e:
+			names = ', '.join(PROGRAM_FILENAMES) + ''.join(', custom mode ' + name for name in custom_modes.get_names())
+			raise ParticleSystemException('Error compiling ' + names + '\n' + str(e))
+
+	# Builds the variant the current state needs on a startup worker thread, the next dispatch waits for it
+	def prebuild_kernels(self, startup):
+		if self.custom_modes_version != custom_modes.version:
+			self.__init_variants()
+		self.variants.prebuild(self.__get_variant_key(), startup)
+
+	def __get_variant_key(self):
+		# Only mode and color profile, the branches they remove are worth a build each. The spawn, decay and
+		# gravity flags stay kernel arguments, fixing them too would make 8 times as many variants.
+		key = ()
+		if self.specialize and len(self.emitters) == 1:
+			key = (
+				('FIXED_PARTICLE_MODE', self.particle_mode_id),
+				('FIXED_COLOR_PROFILE', self.color_profile_id),
+				)
+		if self.compact:
+			key += (('COMPACT_LAYOUT', 1),)
+		if self.interpolate:
+			key += (('INTERPOLATE', 1),)
+		if self.emission_rate is not None:
+			key += (('EMISSION', 1),)
+		if self.trail_length:
+			key += (('TRAILS', 1),)
+		if self.force_field is not None:
+			key += (('FORCE_FIELD', 1),)
+		return key
+
+	# Unless defer_build, compile the starting variant now, so errors surface at startup.
+	# Deferred, the owner sets the state up first and calls prebuild_kernels().
+	def __init_program(self, defer_build):
+		self.__init_variants()
+		if not defer_build:
+			self.__get_kernels()
+
+	# The grid, N-body and pool kernels build on the particle helpers and layout macros of kernel.cl,
+	# custom modes are spliced into it
+	def __init_variants(self):
+		program_src = '\n'.join(file_to_string(filename) for filename in PROGRAM_FILENAMES)
+		self.variants = KernelVariants(self.context, custom_modes.splice(program_src), program_cache)
+		self.custom_modes_version = custom_modes.version
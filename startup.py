@@ -0,0 +1,55 @@
+import contextlib
+import time
+from concurrent.futures import ThreadPoolExecutor
+from colorama import Style
+
+N_WORKERS = 2					# kernel build and texture decode, both release the GIL in C
+
+
+# Times the startup phases up to the first frame, and runs the ones that don't need the GL thread on workers.
+# Phases on the main thread follow each other, background phases overlap them.
+class StartupTimer:
+
+	def __init__(self):
+		self.start = time.perf_counter()
+		self.phases = []				# (name, seconds) on the main thread, in order
+		self.background_phases = []		# (name, seconds) on workers, in completion order
+		self.__executor = ThreadPoolExecutor(max_workers=N_WORKERS, thread_name_prefix='startup')
+		self.__last_end = self.start
+
+	# with startup.phase('window'): ...
+	@contextlib.contextmanager
+	def phase(self, name):
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.__last_end = time.perf_counter()
+			self.phases.append((name, self.__last_end - start))
+
+	# Runs function(*args) on a worker, returns its future
+	def submit(self, name, function, *args):
+		def run():
+			start = time.perf_counter()
+			try:
+				return function(*args)
+			finally:
+				self.background_phases.append((name, time.perf_counter() - start))
+
+		return self.__executor.submit(run)
+
+	# The result of a future from submit(), time spent waiting for it is a phase of its own
+	def wait(self, name, future):
+		with self.phase(name):
+			return future.result()
+
+	# Call once the first frame is drawn, whatever ran since the last phase counts as drawing it
+	def report(self):
+		end = time.perf_counter()
+		phases = self.phases + [ ('first frame', end - self.__last_end) ]
+		print(Style.BRIGHT + 'Startup: \t' + Style.RESET_ALL, '%.0f ms to first frame' % ((end - self.start) * 1e3))
+		print('\t\t', ', '.join('%s %.0f ms' % (name, seconds * 1e3) for name, seconds in phases))
+		if self.background_phases:
+			print('\t\t', 'in the background: ' +
+				', '.join('%s %.0f ms' % (name, seconds * 1e3) for name, seconds in self.background_phases))
+		self.__executor.shutdown(wait=False)
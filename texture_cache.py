@@ -0,0 +1,107 @@
+import numpy as np
+import hashlib
+import os
+import struct
+
+import disk_cache
+
+CACHE_DIRECTORY = disk_cache.get_cache_directory('textures')
+MAX_CACHE_BYTES = 64 << 20		# least recently used entries beyond it are evicted, a 512x512 texture is 1.4 MB
+
+# Entry file: magic, sha256 of the rest, then the source file's size and mtime, the image size,
+# and the RGBA8 mipmap levels one after the other
+CACHE_MAGIC = b'PSTEX001'
+CACHE_HEADER = struct.Struct('<qqII')
+CACHE_SUFFIX = '.tex'
+
+
+# PIL is only imported when an entry has to be built
+def decode(filename):
+	from PIL import Image
+
+	with Image.open(filename) as image:
+		return np.asarray(image.convert('RGBA'), dtype=np.uint8)
+
+# (width, height) of every mipmap level, down to 1x1
+def get_level_sizes(width, height):
+	sizes = [ (width, height) ]
+	while sizes[-1] != (1, 1):
+		width, height = sizes[-1]
+		sizes.append((max(width // 2, 1), max(height // 2, 1)))
+	return sizes
+
+# Every texel of a level is the mean of the 2x2 texels it covers one level up, an odd last row or column is dropped
+def build_mipmaps(pixels):
+	height, width = pixels.shape[:2]
+	levels = [ pixels ]
+	for level_width, level_height in get_level_sizes(width, height)[1:]:
+		previous = levels[-1].astype(np.uint16)
+		if previous.shape[0] == 1:
+			previous = np.repeat(previous, 2, axis=0)
+		if previous.shape[1] == 1:
+			previous = np.repeat(previous, 2, axis=1)
+		blocks = previous[:2 * level_height, :2 * level_width].reshape(level_height, 2, level_width, 2, 4)
+		levels.append(((blocks.sum(axis=(1, 3)) + 2) // 4).astype(np.uint8))
+	return levels
+
+def pack_levels(signature, levels):
+	height, width = levels[0].shape[:2]
+	payload = CACHE_HEADER.pack(*signature, width, height) + b''.join(level.tobytes() for level in levels)
+	return CACHE_MAGIC + hashlib.sha256(payload).digest() + payload
+
+# Returns None if the entry is truncated, its checksum doesn't match or it was built from another file
+def unpack_levels(data, signature):
+	header_size = len(CACHE_MAGIC) + 32
+	if len(data) < header_size + CACHE_HEADER.size or not data.startswith(CACHE_MAGIC):
+		return None
+	payload = memoryview(data)[header_size:]
+	if hashlib.sha256(payload).digest() != data[len(CACHE_MAGIC):header_size]:
+		return None
+
+	size, mtime, width, height = CACHE_HEADER.unpack_from(payload, 0)
+	if (size, mtime) != signature:
+		return None
+	offset = CACHE_HEADER.size
+	levels = []
+	for level_width, level_height in get_level_sizes(width, height):
+		length = level_width * level_height * 4
+		if offset + length > len(payload):
+			return None
+		levels.append(np.frombuffer(payload, np.uint8, length, offset).reshape(level_height, level_width, 4))
+		offset += length
+	return levels if offset == len(payload) else None
+
+
+# RGBA8 textures with their mipmaps, decoded once and kept on disk as raw levels ready for glTexImage2D.
+# An entry is rebuilt when its image file changes size or modification time.
+class TextureCache:
+
+	def __init__(self, directory=CACHE_DIRECTORY, max_bytes=MAX_CACHE_BYTES):
+		self.directory = directory
+		self.max_bytes = max_bytes
+
+	# Mipmap levels of the image, largest first, as (height, width, 4) uint8 arrays with the top row first
+	def load(self, filename):
+		stat = os.stat(filename)
+		signature = (stat.st_size, stat.st_mtime_ns)
+		entry_path = os.path.join(self.directory, hashlib.sha256(os.path.abspath(filename).encode()).hexdigest() + CACHE_SUFFIX)
+
+		try:
+			with open(entry_path, 'rb') as file:
+				levels = unpack_levels(file.read(), signature)
+			if levels is not None:
+				disk_cache.touch(entry_path)
+				return levels
+		except OSError:
+			pass
+
+		levels = build_mipmaps(decode(filename))
+		self.__store(entry_path, pack_levels(signature, levels))
+		return levels
+
+	def __store(self, entry_path, data):
+		try:
+			disk_cache.write_atomically(entry_path, data)
+			disk_cache.evict(self.directory, CACHE_SUFFIX, self.max_bytes)
+		except OSError:
+			pass